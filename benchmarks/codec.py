@@ -0,0 +1,91 @@
+""" Micro benchmarks of MilterEncoder and MilterDecoder, per command """
+from __future__ import division
+
+from txmilter import message
+from txmilter.codec import MilterDecoder
+from txmilter.codec import MilterEncoder
+from txmilter.constants import ProtocolFamily
+
+from .common import allocations, throughput, timer
+from .decoder import body_stream, FRAGMENT_SIZES
+
+
+SAMPLES = [
+    message.Abort(),
+    message.Body(b'x' * 4096),
+    message.Connect(b'mail.example.com', ProtocolFamily.SMFIA_INET, 25000,
+                    b'192.0.2.1'),
+    message.BodyEob(),
+    message.Helo(b'mail.example.com'),
+    message.Header(b'Subject', b'Benchmarking the milter codec'),
+    message.Mail([b'<sender@example.com>', b'SIZE=12345']),
+    message.Eoh(),
+    message.Optneg(6, 0x1ff, 0x1fffff),
+    message.Rcpt([b'<rcpt@example.com>']),
+    message.Data(),
+    message.Quit(),
+    message.AddRcpt(b'<rcpt@example.com>'),
+    message.DelRcpt(b'<rcpt@example.com>'),
+    message.Accept(),
+    message.Continue(),
+    message.AddHeader(b'X-Spam-Score', b'1.5'),
+    message.ChgHeader(1, b'Subject', b'[SPAM] Benchmarking'),
+    message.Quarantine(b'spam'),
+    message.ReplyCode(b'550', b'5.7.1 Rejected'),
+]
+
+
+def bench_encode(msg, count):
+    encode = MilterEncoder().encode
+    start = timer()
+    for _ in range(count):
+        data = encode(msg)
+    elapsed = timer() - start
+    return throughput(elapsed, count, len(data) * count)
+
+
+def bench_decode(msg, count):
+    frame = MilterEncoder().encode(msg)
+    stream = frame * count
+
+    def run():
+        decoder = MilterDecoder()
+        decoder.feed(stream)
+        return list(decoder.decode())
+
+    start = timer()
+    run()
+    elapsed = timer() - start
+    result = throughput(elapsed, count, len(stream))
+    result.update(allocations(run, count))
+    return result
+
+
+def bench_fragmented(size, fragment):
+    stream = body_stream(size)
+
+    def run():
+        decoder = MilterDecoder()
+        frames = 0
+        for i in range(0, len(stream), fragment):
+            decoder.feed(stream[i:i + fragment])
+            for _ in decoder.decode():
+                frames += 1
+        return frames
+
+    start = timer()
+    frames = run()
+    return throughput(timer() - start, frames, len(stream))
+
+
+def run(count=20000, size=1024 * 1024):
+    results = {}
+    for msg in SAMPLES:
+        results['encode.%s' % msg.cmd] = bench_encode(msg, count)
+        results['decode.%s' % msg.cmd] = bench_decode(msg, count)
+    for fragment in FRAGMENT_SIZES:
+        # keep the 1 byte run short
+        total = size if fragment > 1 else size // 16
+        results['decode.fragmented.%d' % fragment] = bench_fragmented(
+                total, fragment)
+    return results
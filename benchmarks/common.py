@@ -0,0 +1,90 @@
+""" Helpers shared by the benchmarks """
+from __future__ import division
+
+import gc
+import json
+import platform
+import subprocess
+import sys
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    # python 2
+    tracemalloc = None
+
+
+timer = getattr(time, 'perf_counter', time.time)
+
+
+def percentile(values, pct):
+    """ Return the pct-th percentile of values (nearest rank) """
+    if not values:
+        return None
+    values = sorted(values)
+    rank = max(int(round(pct / 100.0 * len(values))) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+def latencies(samples):
+    """ Summary of a list of latencies, in microseconds """
+    return {'count': len(samples),
+            'p50_us': percentile(samples, 50) * 1e6 if samples else None,
+            'p99_us': percentile(samples, 99) * 1e6 if samples else None}
+
+
+def throughput(elapsed, frames, nbytes):
+    elapsed = max(elapsed, 1e-9)
+    return {'seconds': elapsed,
+            'frames': frames,
+            'frames_per_sec': frames / elapsed,
+            'bytes_per_sec': nbytes / elapsed}
+
+
+def allocations(func, messages):
+    """ Memory allocated while running func(), per message.
+
+        Returns the blocks still allocated when func() returns (e.g. the
+        decoded messages) and the peak memory used, both divided by
+        messages. Needs tracemalloc (python 3), None otherwise.
+    """
+    if tracemalloc is None:
+        return {'blocks_per_msg': None, 'peak_bytes_per_msg': None}
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        result = func()
+        after = tracemalloc.take_snapshot()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    blocks = sum(s.count_diff for s in after.compare_to(before, 'filename'))
+    del result
+    return {'blocks_per_msg': blocks / messages,
+            'peak_bytes_per_msg': peak / messages}
+
+
+def metadata():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                         stderr=subprocess.STDOUT)
+        commit = commit.decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'python': sys.version.split()[0],
+            'implementation': platform.python_implementation(),
+            'commit': commit,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+
+def save(path, results):
+    with open(path, 'w') as f:
+        json.dump({'meta': metadata(), 'results': results}, f, indent=2,
+                  sort_keys=True)
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)['results']
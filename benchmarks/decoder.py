@@ -0,0 +1,93 @@
+""" Regression benchmark for MilterDecoder.
+
+    Feeds a stream of SMFIC_BODY frames to the decoder split in fragments of
+    1 byte, 4 KiB and 64 KiB and reports the decoding throughput. Decoding
+    time must grow linearly with the stream size: doubling --size should
+    roughly double the reported times.
+
+    With --min-rate, exits with status 1 if any fragment size decodes
+    slower than that many KiB/s, and with --check-linear if decoding 8
+    times more data takes much more than 8 times longer, so that it can
+    gate a CI job.
+
+    Usage: python -m benchmarks.decoder [--size BYTES] [--min-rate KIBS]
+                                        [--check-linear]
+"""
+from __future__ import print_function
+
+import argparse
+import struct
+import sys
+import time
+
+from txmilter.codec import MilterDecoder
+
+
+FRAGMENT_SIZES = (1, 4 * 1024, 64 * 1024)
+
+
+def body_stream(size, chunk=64 * 1024):
+    """ Return size bytes worth of SMFIC_BODY frames of chunk bytes each """
+    frames = []
+    total = 0
+    while total < size:
+        payload = b'x' * min(chunk, size - total)
+        frames.append(struct.pack('!Ic', len(payload) + 1, b'B') + payload)
+        total += len(payload)
+    return b''.join(frames)
+
+
+def run(stream, fragment):
+    decoder = MilterDecoder()
+    frames = 0
+    start = time.time()
+    for i in range(0, len(stream), fragment):
+        decoder.feed(stream[i:i + fragment])
+        for _ in decoder.decode():
+            frames += 1
+    return time.time() - start, frames
+
+
+def isLinear(stream, fragment):
+    """ Return whether decoding 8 times stream does not take much more than
+        8 times longer (a quadratic decoder takes 64 times longer) """
+    # best of a few runs, to smooth out the noise
+    small = min(run(stream, fragment)[0] for _ in range(3))
+    large = min(run(stream * 8, fragment)[0] for _ in range(3))
+    print('fragment %6d: %8.3fs for %d bytes, %8.3fs for 8 times more'
+          % (fragment, small, len(stream), large))
+    return large < 24 * max(small, 0.001)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--size', type=int, default=4 * 1024 * 1024,
+                        help='stream size in bytes (default: 4 MiB)')
+    parser.add_argument('--min-rate', type=float,
+                        help='fail below this throughput, in KiB/s')
+    parser.add_argument('--check-linear', action='store_true',
+                        help='fail if decoding time grows faster than the '
+                        'stream size')
+    args = parser.parse_args()
+
+    stream = body_stream(args.size)
+    slow = False
+    for fragment in FRAGMENT_SIZES:
+        elapsed, frames = run(stream, fragment)
+        rate = len(stream) / 1024.0 / max(elapsed, 1e-9)
+        print('fragment %6d: %5d frames, %8.3fs, %10.1f KiB/s'
+              % (fragment, frames, elapsed, rate))
+        if args.min_rate is not None and rate < args.min_rate:
+            slow = True
+    if slow:
+        print('decoding slower than %.1f KiB/s' % args.min_rate)
+        sys.exit(1)
+    if args.check_linear:
+        stream = body_stream(512 * 1024)
+        if not all([isLinear(stream, fragment) for fragment in (64, 4096)]):
+            print('decoding time is not linear in the stream size')
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+""" Runs the txmilter benchmark suite.
+
+    Usage: python -m benchmarks.run [--output FILE] [--compare FILE]
+
+    Results are printed and, with --output, stored as JSON so that runs
+    from different commits can be compared with --compare.
+"""
+from __future__ import division, print_function
+
+import argparse
+
+from . import codec
+from . import common
+from . import session
+
+
+def show(results, baseline=None):
+    for name in sorted(results):
+        metrics = results[name]
+        line = []
+        for key in sorted(metrics):
+            value = metrics[key]
+            if not isinstance(value, (int, float)) or key == 'count':
+                continue
+            text = '%s=%.4g' % (key, value)
+            old = (baseline or {}).get(name, {}).get(key)
+            if old:
+                text += ' (%+.1f%%)' % ((value - old) / old * 100)
+            line.append(text)
+        print('%-40s %s' % (name, ' '.join(line)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--output', help='store the results as JSON')
+    parser.add_argument('--compare', help='JSON results to compare with')
+    parser.add_argument('--count', type=int, default=20000,
+                        help='frames per codec benchmark')
+    parser.add_argument('--sessions', type=int, default=200,
+                        help='sessions per session benchmark')
+    parser.add_argument('--no-loopback', action='store_true',
+                        help='skip the loopback TCP benchmark')
+    args = parser.parse_args()
+
+    results = codec.run(count=args.count)
+    results.update(session.run(sessions=args.sessions,
+                               loopback=not args.no_loopback))
+
+    show(results, common.load(args.compare) if args.compare else None)
+    if args.output:
+        common.save(args.output, results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+""" Macro benchmarks: full milter sessions replayed through MilterProtocol,
+    over an in-memory transport and over a loopback TCP connection.
+"""
+from __future__ import division
+
+import collections
+
+from twisted.internet import defer, protocol, reactor
+from twisted.test import proto_helpers
+
+from txmilter import MilterFactory
+from txmilter import MilterProtocol
+from txmilter import message
+from txmilter.codec import MilterDecoder
+from txmilter.codec import MilterEncoder
+from txmilter.constants import ProtocolFamily
+from txmilter.protocol import ACCEPT, CONTINUE
+
+from .common import latencies, throughput, timer
+
+
+class BenchMilter(MilterProtocol):
+    """ Milter with every callback overridden, so the MTA sends them all """
+
+    def onConnect(self, hostname, family, port, address):
+        return CONTINUE
+
+    def onHelo(self, helo):
+        return CONTINUE
+
+    def onMail(self, args):
+        return CONTINUE
+
+    def onRcpt(self, args):
+        return CONTINUE
+
+    def onData(self):
+        return CONTINUE
+
+    def onUnknown(self, data):
+        return CONTINUE
+
+    def onHeader(self, name, value):
+        return CONTINUE
+
+    def onEoh(self):
+        return CONTINUE
+
+    def onBody(self, buf):
+        return CONTINUE
+
+    def onEom(self):
+        return ACCEPT
+
+
+def session(rcpts=5, headers=30, body_size=64 * 1024):
+    """ Return the frames of a synthetic session """
+    msgs = [message.Optneg(6, 0x1ff, 0x1fffff),
+            message.Connect(b'mail.example.com', ProtocolFamily.SMFIA_INET,
+                            25000, b'192.0.2.1'),
+            message.Helo(b'mail.example.com'),
+            message.Mail([b'<sender@example.com>'])]
+    msgs.extend(message.Rcpt([b'<rcpt%d@example.com>' % i])
+                for i in range(rcpts))
+    msgs.append(message.Data())
+    msgs.extend(message.Header(b'X-Header-%d' % i, b'value %d' % i)
+                for i in range(headers))
+    msgs.append(message.Eoh())
+    chunk = b'x' * 65535
+    for i in range(0, body_size, len(chunk)):
+        msgs.append(message.Body(chunk[:body_size - i]))
+    msgs.extend([message.BodyEob(), message.Quit()])
+    encode = MilterEncoder().encode
+    return [(m.cmd, encode(m)) for m in msgs]
+
+
+def bench_memory(frames, sessions):
+    factory = MilterFactory()
+    factory.protocol = BenchMilter
+    per_cmd = collections.defaultdict(list)
+    nbytes = sum(len(f) for _, f in frames) * sessions
+
+    start = timer()
+    for _ in range(sessions):
+        proto = factory.buildProtocol(None)
+        proto.makeConnection(proto_helpers.StringTransport())
+        for cmd, frame in frames:
+            t0 = timer()
+            proto.dataReceived(frame)
+            per_cmd[cmd].append(timer() - t0)
+        proto.connectionLost(None)
+    elapsed = timer() - start
+
+    results = {'session.memory': throughput(elapsed,
+                                            len(frames) * sessions, nbytes)}
+    for cmd, samples in per_cmd.items():
+        results['session.memory.%s' % cmd] = latencies(samples)
+    return results
+
+
+class ReplayClient(protocol.Protocol):
+    """ Plays the MTA: sends a frame and waits for its reply """
+
+    def __init__(self, frames, per_cmd, done):
+        self.frames = list(frames)
+        self.per_cmd = per_cmd
+        self.done = done
+        self.decoder = MilterDecoder()
+
+    def connectionMade(self):
+        self.sendNext()
+
+    def sendNext(self):
+        self.cmd, frame = self.frames.pop(0)
+        self.sent = timer()
+        self.transport.write(frame)
+        if self.cmd == 'SMFIC_QUIT':
+            self.transport.loseConnection()
+
+    def dataReceived(self, data):
+        for reply in self.decoder.feed(data).decode():
+            self.per_cmd[self.cmd].append(timer() - self.sent)
+            if self.frames:
+                self.sendNext()
+
+    def connectionLost(self, reason):
+        self.done.callback(None)
+
+
+@defer.inlineCallbacks
+def _loopback(frames, sessions, concurrency, per_cmd):
+    factory = MilterFactory()
+    factory.protocol = BenchMilter
+    port = reactor.listenTCP(0, factory, interface='127.0.0.1')
+    address = port.getHost()
+    remaining = [sessions]
+
+    @defer.inlineCallbacks
+    def worker():
+        while remaining[0] > 0:
+            remaining[0] -= 1
+            done = defer.Deferred()
+            creator = protocol.ClientCreator(reactor, ReplayClient, frames,
+                                             per_cmd, done)
+            yield creator.connectTCP(address.host, address.port)
+            yield done
+
+    try:
+        yield defer.gatherResults([worker() for _ in range(concurrency)])
+    finally:
+        yield port.stopListening()
+
+
+def bench_loopback(frames, sessions, concurrency=10):
+    """ Runs the reactor: must be the last benchmark of the process """
+    per_cmd = collections.defaultdict(list)
+    nbytes = sum(len(f) for _, f in frames) * sessions
+    outcome = []
+
+    def finished(result):
+        outcome.append(result)
+        reactor.stop()
+
+    start = timer()
+    reactor.callWhenRunning(
+            lambda: _loopback(frames, sessions, concurrency,
+                              per_cmd).addBoth(finished))
+    reactor.run()
+    elapsed = timer() - start
+    if outcome and hasattr(outcome[0], 'raiseException'):
+        outcome[0].raiseException()
+
+    results = {'session.loopback': throughput(elapsed,
+                                              len(frames) * sessions, nbytes)}
+    for cmd, samples in per_cmd.items():
+        results['session.loopback.%s' % cmd] = latencies(samples)
+    return results
+
+
+def run(sessions=200, loopback=True):
+    frames = session()
+    results = bench_memory(frames, sessions)
+    if loopback:
+        results.update(bench_loopback(frames, sessions))
+    return results
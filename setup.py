@@ -26,6 +26,9 @@ setup(name='txmilter',
           'Intended Audience :: Developers',
           'License :: OSI Approved :: MIT License',
           'Programming Language :: Python',
+          'Programming Language :: Python :: 2',
+          'Programming Language :: Python :: 2.7',
+          'Programming Language :: Python :: 3',
           'Framework :: Twisted',
           'Topic :: Communications :: Email',
           'Topic :: Communications :: Email :: Filters',
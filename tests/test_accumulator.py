@@ -0,0 +1,102 @@
+import unittest
+
+from twisted.test import proto_helpers
+
+from txmilter import MilterFactory
+from txmilter import MilterProtocol
+from txmilter import constants
+from txmilter import message
+from txmilter.accumulator import MessageAccumulatorMixin
+from txmilter.accumulator import MessageState
+from txmilter.codec import MilterDecoder
+from txmilter.codec import MilterEncoder
+from txmilter.protocol import ACCEPT, CONTINUE
+
+
+class AccumulatingMilter(MessageAccumulatorMixin, MilterProtocol):
+    collectBody = True
+
+    def onBody(self, buf):
+        return CONTINUE
+
+    def onEom(self):
+        self.seen = self.message
+        pos = self.message.headerPositions(b'x-spam')[-1]
+        self.changeHeader(pos, b'')
+        return ACCEPT
+
+
+class MessageStateTest(unittest.TestCase):
+    def test_headers(self):
+        state = MessageState()
+        state.addHeader(b'To', b'a')
+        state.addHeader(b'Received', b'1')
+        self.assertEquals(state.getHeaders(b'received'), [b'1'])
+        # the index is kept up to date once built
+        state.addHeader(b'RECEIVED', b'2')
+        self.assertEquals(state.getHeaders(b'Received'), [b'1', b'2'])
+        self.assertEquals(state.getHeader(b'to'), b'a')
+        self.assertEquals(state.getHeader(b'cc', b'x'), b'x')
+        self.assertTrue(b'TO' in state)
+        self.assertEquals(state.headerIndex(2), 2)
+        self.assertEquals(state.headerIndex(0), 1)
+
+
+class MessageAccumulatorTest(unittest.TestCase):
+    def setUp(self):
+        factory = MilterFactory()
+        factory.protocol = AccumulatingMilter
+        self.proto = factory.buildProtocol(None)
+        self.transport = proto_helpers.StringTransport()
+        self.proto.makeConnection(self.transport)
+        self.encode = MilterEncoder().encode
+
+    def send(self, *msgs):
+        self.proto.dataReceived(b''.join(self.encode(m) for m in msgs))
+
+    def test_protocol_mask(self):
+        mask = self.proto.protocol_mask()
+        self.assertEquals(mask & (constants.SMFIP_NR_CONN
+                                  | constants.SMFIP_NR_RCPT
+                                  | constants.SMFIP_NR_HDR
+                                  | constants.SMFIP_NOBODY),
+                          constants.SMFIP_NR_CONN | constants.SMFIP_NR_RCPT
+                          | constants.SMFIP_NR_HDR)
+
+    def test_message(self):
+        self.send(message.Connect(b'host', constants.ProtocolFamily.SMFIA_INET,
+                                  25, b'1.2.3.4'),
+                  message.Helo(b'me'),
+                  message.Mail([b'<a@b>', b'SIZE=10']),
+                  message.Rcpt([b'<c@d>']),
+                  message.Rcpt([b'<e@f>', b'NOTIFY=NEVER']),
+                  message.Header(b'X-Spam', b'yes'),
+                  message.Header(b'Subject', b'hi'),
+                  message.Header(b'X-SPAM', b'no'),
+                  message.Body(b'body'),
+                  message.BodyEob())
+        self.assertEquals((self.proto.hostname, self.proto.address,
+                           self.proto.helo), (b'host', b'1.2.3.4', b'me'))
+        state = self.proto.seen
+        self.assertEquals((state.sender, state.mailArgs),
+                          (b'<a@b>', [b'SIZE=10']))
+        self.assertEquals(state.recipients, [b'<c@d>', b'<e@f>'])
+        self.assertEquals(state.rcptArgs, [[], [b'NOTIFY=NEVER']])
+        self.assertEquals(state.getHeaders(b'x-spam'), [b'yes', b'no'])
+        self.assertEquals((state.body, state.bodySize), (b'body', 4))
+
+        replies = list(MilterDecoder().feed(self.transport.value()).decode())
+        self.assertEquals(replies[-2:], [message.ChgHeader(2, b'X-SPAM', b''),
+                                         ACCEPT])
+
+    def test_commands_without_handler_are_recorded(self):
+        self.proto._handlers['SMFIC_MAIL'] = None
+        self.send(message.Mail([b'<a@b>']))
+        self.assertEquals(self.proto.message.sender, b'<a@b>')
+
+    def test_abort_resets_the_message(self):
+        self.send(message.Mail([b'<a@b>']), message.Header(b'a', b'b'),
+                  message.Abort())
+        self.assertEquals(self.proto.message, None)
+        self.send(message.Mail([b'<c@d>']))
+        self.assertEquals(self.proto.message.headers, [])
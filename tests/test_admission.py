@@ -0,0 +1,128 @@
+from twisted.internet import defer, error
+from twisted.python.failure import Failure
+from twisted.test import proto_helpers
+from twisted.trial import unittest
+
+from txmilter import MilterFactory
+from txmilter import MilterProtocol
+from txmilter.admission import AdmissionControl
+from txmilter.metrics import MetricsInstrumentation
+from txmilter.metrics import MetricsRegistry
+from txmilter.protocol import ACCEPT, CONTINUE, TEMPFAIL
+
+
+HELO = b'\x00\x00\x00\x04Hme\x00'
+HEADER = b'\x00\x00\x00\x06Lto\x00x\x00'
+BODY = b'\x00\x00\x00\x05Bbody'
+ABORT = b'\x00\x00\x00\x01A'
+
+
+class SlowMilter(MilterProtocol):
+    def connectionMade(self):
+        MilterProtocol.connectionMade(self)
+        self.pending = []
+
+    def onHelo(self, helo):
+        d = defer.Deferred()
+        self.pending.append(d)
+        return d
+
+    def onHeader(self, name, value):
+        return self.onHelo(name)
+
+    def onBody(self, buf):
+        return CONTINUE
+
+    def onAbort(self):
+        self.pending.append('abort')
+        return CONTINUE
+
+
+class AdmissionTest(unittest.TestCase):
+    def setUp(self):
+        self.registry = MetricsRegistry()
+        self.factory = MilterFactory(
+                instrumentation=MetricsInstrumentation(self.registry))
+        self.factory.protocol = SlowMilter
+
+    def connect(self, **limits):
+        if self.factory.admission is None:
+            self.factory.admission = AdmissionControl(**limits)
+        proto = self.factory.buildProtocol(None)
+        proto.makeConnection(proto_helpers.StringTransport())
+        return proto
+
+    def test_sessions_beyond_the_limit_are_shed(self):
+        first = self.connect(maxSessions=1, verdict=ACCEPT)
+        second = self.connect()
+        second.dataReceived(HELO + ABORT)
+        self.assertEquals(second.transport.value(), ACCEPT.wire)
+        # commands without reply still reach their handlers
+        self.assertEquals(second.pending, ['abort'])
+        admission = self.factory.admission
+        self.assertEquals(admission.shedSessions, 1)
+        self.assertEquals(admission.shed['sessions'], 1)
+        self.assertEquals(self.registry.metrics['txmilter_shed_total']
+                          .get(('SMFIC_HELO', 'sessions')), 1)
+
+        first.connectionLost(Failure(error.ConnectionDone()))
+        second.connectionLost(Failure(error.ConnectionDone()))
+        self.assertEquals(admission.sessions, 0)
+        third = self.connect()
+        third.dataReceived(HELO)
+        self.assertEquals(len(third.pending), 1)
+
+    def test_session_in_flight_limit(self):
+        proto = self.connect(maxSessionInFlight=1)
+        proto.dataReceived(HELO + HEADER)
+        self.assertEquals(len(proto.pending), 1)
+        self.assertEquals(self.factory.admission.inFlight, 1)
+        # the reply of the shed command waits for the previous one
+        self.assertEquals(proto.transport.value(), b'')
+        proto.pending[0].callback(CONTINUE)
+        self.assertEquals(proto.transport.value(),
+                          CONTINUE.wire + TEMPFAIL.wire)
+        self.assertEquals(self.factory.admission.inFlight, 0)
+        self.assertEquals(self.factory.admission.shed['session_inflight'], 1)
+
+    def test_global_in_flight_limit(self):
+        first = self.connect(maxInFlight=1)
+        second = self.connect()
+        first.dataReceived(HELO)
+        second.dataReceived(HELO)
+        self.assertEquals(second.transport.value(), TEMPFAIL.wire)
+        first.pending[0].callback(CONTINUE)
+        second.dataReceived(HEADER)
+        self.assertEquals(len(second.pending), 1)
+
+    def test_buffered_limit(self):
+        proto = self.connect(maxSessionBuffered=20)
+        proto.dataReceived(HELO + HEADER)
+        self.assertEquals(self.factory.admission.buffered, 8 + 10)
+        # the commands held go over the limit with the next one
+        proto.dataReceived(HEADER * 2)
+        self.assertEquals(len(proto.pending), 2)
+        self.assertEquals(self.factory.admission.shed['session_buffered'], 2)
+        self.assertEquals(self.factory.admission.buffered, 8 + 10)
+        proto.pending[1].callback(CONTINUE)
+        proto.dataReceived(HEADER)
+        self.assertEquals(len(proto.pending), 3)
+
+    def test_shed_no_reply_commands_continue(self):
+        proto = self.connect(maxSessionInFlight=0, verdict=TEMPFAIL)
+        proto._noReplyCmds = proto._noReplyCmds | set(['SMFIC_BODY'])
+        proto.dataReceived(BODY)
+        self.assertEquals(proto.transport.value(), b'')
+        self.assertEquals(self.factory.admission.shed['session_inflight'], 1)
+
+    def test_counters_are_released_on_disconnection(self):
+        proto = self.connect(maxSessions=10)
+        proto.dataReceived(HELO + HEADER)
+        admission = self.factory.admission
+        self.assertEquals((admission.inFlight, admission.buffered), (2, 18))
+        proto.connectionLost(Failure(error.ConnectionDone()))
+        self.assertEquals((admission.sessions, admission.inFlight,
+                           admission.buffered), (0, 0, 0))
+        # late results do not count twice
+        proto.pending[0].callback(CONTINUE)
+        self.assertEquals(admission.inFlight, 0)
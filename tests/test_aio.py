@@ -0,0 +1,191 @@
+from twisted.trial import unittest
+
+from txmilter import constants
+from txmilter import message
+from txmilter.codec import MilterDecoder
+from txmilter.codec import MilterEncoder
+from txmilter.protocol import ACCEPT, CONTINUE, REJECT, TEMPFAIL
+from txmilter.protocol import noreply
+
+try:
+    import asyncio
+    from txmilter.aio import AsyncMilterFactory
+    from txmilter.aio import AsyncMilterProtocol
+    Protocol = asyncio.Protocol
+except ImportError:
+    asyncio = None
+    AsyncMilterProtocol = Protocol = object
+
+
+encode = MilterEncoder().encode
+
+OPTNEG = encode(message.Optneg(6, 2**9 - 1, 2**21 - 1))
+HELO = encode(message.Helo(b'me'))
+MAIL = encode(message.Mail([b'<a@b>']))
+RCPT = encode(message.Rcpt([b'<c@d>']))
+HEADER = encode(message.Header(b'to', b'x'))
+EOM = encode(message.BodyEob())
+QUIT = encode(message.Quit())
+
+
+class Milter(AsyncMilterProtocol):
+    def onHelo(self, helo):
+        # a coroutine, replying after the next commands
+        return asyncio.sleep(0.01, CONTINUE)
+
+    def onMail(self, args):
+        return CONTINUE
+
+    def onRcpt(self, args):
+        return asyncio.sleep(0, REJECT if args[0] == b'<spam@d>' else
+                             CONTINUE)
+
+    @noreply
+    def onHeader(self, name, value):
+        self.headers.append(name)
+
+    def onEom(self):
+        self.addHeader(b'X-Seen', b'yes')
+        future = asyncio.get_event_loop().create_future()
+        future.set_result(ACCEPT)
+        return future
+
+    def connection_made(self, transport):
+        AsyncMilterProtocol.connection_made(self, transport)
+        self.headers = []
+
+
+class Broken(Milter):
+    def onMail(self, args):
+        return 1 / 0
+
+
+class Transport(object):
+    def __init__(self):
+        self.written = []
+        self.aborted = False
+        self.reading = True
+
+    def write(self, data):
+        self.written.append(data)
+
+    def writelines(self, seq):
+        self.written.extend(seq)
+
+    def abort(self):
+        self.aborted = True
+
+    def pause_reading(self):
+        self.reading = False
+
+    def resume_reading(self):
+        self.reading = True
+
+    def replies(self):
+        data, self.written = b''.join(self.written), []
+        return list(MilterDecoder().feed(data).decode())
+
+
+class MTA(Protocol):
+    def __init__(self, done, count):
+        self.done = done
+        self.count = count
+        self.decoder = MilterDecoder()
+        self.replies = []
+
+    def data_received(self, data):
+        self.replies.extend(self.decoder.feed(data).decode())
+        if len(self.replies) >= self.count and not self.done.done():
+            self.done.set_result(self.replies)
+
+
+class AsyncMilterTest(unittest.TestCase):
+    if asyncio is None:
+        skip = 'asyncio is not available'
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.addCleanup(asyncio.set_event_loop, None)
+        self.addCleanup(self.loop.close)
+        self.factory = AsyncMilterFactory(Milter,
+                                          actions=constants.SMFIF_ADDHDRS)
+
+    def connect(self):
+        proto = self.factory()
+        proto.connection_made(Transport())
+        return proto
+
+    def settle(self):
+        self.loop.run_until_complete(asyncio.sleep(0.05))
+
+    def test_options_are_negotiated(self):
+        proto = self.connect()
+        proto.data_received(OPTNEG)
+        optneg, = proto.transport.replies()
+        self.assertEquals(optneg.actions, constants.SMFIF_ADDHDRS)
+        self.assertTrue(optneg.protocol & constants.SMFIP_NOCONNECT)
+        self.assertTrue(optneg.protocol & constants.SMFIP_NR_HDR)
+        self.assertFalse(optneg.protocol & constants.SMFIP_NOHELO)
+
+    def test_replies_are_in_command_order(self):
+        proto = self.connect()
+        proto.data_received(OPTNEG + HELO + MAIL + RCPT)
+        self.assertEquals(proto.transport.replies()[1:], [])
+        self.settle()
+        self.assertEquals(proto.transport.replies(),
+                          [CONTINUE, CONTINUE, CONTINUE])
+
+    def test_modifications_go_with_the_reply(self):
+        proto = self.connect()
+        proto.data_received(OPTNEG + MAIL + HEADER + HEADER + EOM)
+        self.settle()
+        self.assertEquals(proto.transport.replies()[1:],
+                          [CONTINUE, message.AddHeader(b'X-Seen', b'yes'),
+                           ACCEPT])
+        self.assertEquals(proto.headers, [b'to', b'to'])
+
+    def test_failing_handler(self):
+        self.factory.protocol = Broken
+        proto = self.connect()
+        with self.assertLogs('txmilter.aio', 'ERROR'):
+            proto.data_received(OPTNEG + MAIL + RCPT)
+        self.settle()
+        # the failed command is replied failureVerdict
+        self.assertEquals(proto.transport.replies()[1:], [TEMPFAIL, CONTINUE])
+
+    def test_invalid_data_aborts(self):
+        proto = self.connect()
+        with self.assertLogs('txmilter.aio', 'ERROR'):
+            proto.data_received(b'\x00\x00\x00\x01Z')
+        self.assertTrue(proto.transport.aborted)
+
+    def test_pending_handlers_are_cancelled(self):
+        proto = self.connect()
+        proto.data_received(OPTNEG + HELO)
+        proto.transport.replies()
+        proto.connection_lost(None)
+        self.settle()
+        self.assertEquals(proto.transport.replies(), [])
+
+    def test_reading_is_paused_with_writing(self):
+        proto = self.connect()
+        proto.pause_writing()
+        self.assertFalse(proto.transport.reading)
+        proto.resume_writing()
+        self.assertTrue(proto.transport.reading)
+
+    def test_server(self):
+        done = self.loop.create_future()
+        server = self.loop.run_until_complete(
+                self.loop.create_server(self.factory, '127.0.0.1', 0))
+        self.addCleanup(server.close)
+        port = server.sockets[0].getsockname()[1]
+        spam = encode(message.Rcpt([b'<spam@d>']))
+        transport, _ = self.loop.run_until_complete(
+                self.loop.create_connection(lambda: MTA(done, 4),
+                                            '127.0.0.1', port))
+        transport.write(OPTNEG + HELO + MAIL + spam + QUIT)
+        replies = self.loop.run_until_complete(done)
+        transport.close()
+        self.assertEquals(replies[1:], [CONTINUE, CONTINUE, REJECT])
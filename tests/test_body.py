@@ -0,0 +1,107 @@
+import unittest
+
+from zope.interface import implementer
+from twisted.internet.interfaces import IConsumer
+from twisted.test import proto_helpers
+
+from txmilter import MilterFactory
+from txmilter import MilterProtocol
+from txmilter.body import BodySpool, BodyStreamMixin
+from txmilter.protocol import ACCEPT, CONTINUE
+
+
+@implementer(IConsumer)
+class SlowConsumer(object):
+    def __init__(self):
+        self.data = []
+        self.producer = None
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def unregisterProducer(self):
+        self.producer = None
+
+    def write(self, data):
+        self.data.append(data.tobytes())
+        self.producer.pauseProducing()
+
+
+class SpoolingMilter(BodyStreamMixin, MilterProtocol):
+    spoolThreshold = 8
+
+    def onEom(self):
+        self.eomBody = self.body.file.read()
+        return ACCEPT
+
+
+class StreamingMilter(BodyStreamMixin, MilterProtocol):
+    def bodyConsumer(self):
+        self.consumer = SlowConsumer()
+        return self.consumer
+
+
+def body(data):
+    return b'\x00\x00\x00' + bytearray([len(data) + 1]) + b'B' + data
+
+
+EOM = b'\x00\x00\x00\x01E'
+
+
+class BodyStreamTest(unittest.TestCase):
+    def connect(self, protocol):
+        factory = MilterFactory()
+        factory.protocol = protocol
+        proto = factory.buildProtocol(None)
+        transport = proto_helpers.StringTransport()
+        proto.makeConnection(transport)
+        return proto, transport
+
+    def test_body_is_spooled(self):
+        proto, transport = self.connect(SpoolingMilter)
+
+        proto.dataReceived(body(b'0123') + body(b'456789'))
+        self.assertTrue(proto.body.file._rolled)
+
+        proto.dataReceived(EOM)
+        self.assertEquals(proto.eomBody, b'0123456789')
+        self.assertEquals(transport.value(),
+                          CONTINUE.wire + CONTINUE.wire + ACCEPT.wire)
+
+    def test_small_body_stays_in_memory(self):
+        spool = BodySpool(8)
+        spool.write(b'0123')
+        self.assertFalse(spool.file._rolled)
+
+    def test_slow_consumer_pauses_transport(self):
+        proto, transport = self.connect(StreamingMilter)
+
+        proto.dataReceived(body(b'0123'))
+        self.assertEquals(transport.producerState, 'paused')
+
+        proto.consumer.producer.resumeProducing()
+        self.assertEquals(transport.producerState, 'producing')
+
+        proto.dataReceived(body(b'4567') + EOM)
+        self.assertEquals(proto.consumer.data, [b'0123', b'4567'])
+        self.assertEquals(proto.consumer.producer, None)
+        self.assertEquals(transport.producerState, 'producing')
+
+    def test_stopped_consumer_skips_body(self):
+        proto, transport = self.connect(StreamingMilter)
+
+        proto.dataReceived(body(b'0123'))
+        proto.consumer.producer.stopProducing()
+        proto.dataReceived(body(b'4567'))
+
+        self.assertEquals(proto.consumer.data, [b'0123'])
+        self.assertEquals(transport.producerState, 'producing')
+
+    def test_abort_discards_body(self):
+        proto, transport = self.connect(SpoolingMilter)
+
+        proto.dataReceived(body(b'0123'))
+        spool = proto.body
+        proto.dataReceived(b'\x00\x00\x00\x01A')
+        self.assertEquals(proto.body, None)
+        self.assertTrue(spool.file.closed)
@@ -0,0 +1,150 @@
+from twisted.internet import defer, task
+from twisted.test import proto_helpers
+from twisted.trial import unittest
+
+from txmilter import MilterFactory
+from txmilter import MilterProtocol
+from txmilter import constants
+from txmilter.cache import VerdictCache
+from txmilter.cache import cached
+from txmilter.protocol import CONTINUE, REJECT, TEMPFAIL
+
+
+class LookupFailed(Exception):
+    pass
+
+
+class CacheTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.cache = VerdictCache(maxSize=2, ttl=10, clock=self.clock,
+                                  verdictTtls={'SMFIR_TEMPFAIL': 1})
+        self.calls = []
+
+    def lookup(self, result):
+        self.calls.append(result)
+        return result
+
+    def resultOf(self, d):
+        results = []
+        d.addBoth(results.append)
+        return results[0]
+
+    def test_hit_until_expired(self):
+        self.assertEquals(self.resultOf(self.cache.get('a', self.lookup,
+                                                       REJECT)), REJECT)
+        self.assertEquals(self.resultOf(self.cache.get('a', self.lookup,
+                                                       CONTINUE)), REJECT)
+        self.assertEquals((self.cache.hits, self.cache.misses), (1, 1))
+        self.clock.advance(10)
+        self.assertEquals(self.resultOf(self.cache.get('a', self.lookup,
+                                                       CONTINUE)), CONTINUE)
+        self.assertEquals(self.calls, [REJECT, CONTINUE])
+
+    def test_verdict_ttl(self):
+        self.cache.get('a', self.lookup, TEMPFAIL)
+        self.clock.advance(1)
+        self.cache.get('a', self.lookup, TEMPFAIL)
+        self.assertEquals(self.cache.misses, 2)
+
+    def test_lru_eviction(self):
+        self.cache.get('a', self.lookup, REJECT)
+        self.cache.get('b', self.lookup, REJECT)
+        self.cache.get('a', self.lookup, REJECT)
+        self.cache.get('c', self.lookup, REJECT)
+        self.assertEquals(len(self.cache), 2)
+        self.assertEquals(self.cache.evictions, 1)
+        self.cache.get('a', self.lookup, REJECT)
+        self.cache.get('b', self.lookup, REJECT)
+        self.assertEquals(self.calls, [REJECT] * 4)
+
+    def test_failures(self):
+        def fail():
+            self.calls.append(None)
+            raise LookupFailed()
+        self.failureResultOf(self.cache.get('a', fail), LookupFailed)
+        self.failureResultOf(self.cache.get('a', fail), LookupFailed)
+        self.assertEquals(len(self.calls), 2)
+
+        self.cache.negativeTtl = 5
+        self.failureResultOf(self.cache.get('b', fail), LookupFailed)
+        self.failureResultOf(self.cache.get('b', fail), LookupFailed)
+        self.assertEquals(len(self.calls), 3)
+
+    def test_pending_calls_are_coalesced(self):
+        pending = defer.Deferred()
+        first = self.cache.get('a', self.lookup, pending)
+        second = self.cache.get('a', self.lookup, None)
+        self.assertNoResult(first)
+        self.assertEquals(self.cache.coalesced, 1)
+        pending.callback(REJECT)
+        self.assertEquals(self.successResultOf(first), REJECT)
+        self.assertEquals(self.successResultOf(second), REJECT)
+        self.assertEquals(len(self.calls), 1)
+
+    def test_pending_failures_are_shared(self):
+        pending = defer.Deferred()
+        first = self.cache.get('a', lambda: pending)
+        second = self.cache.get('a', lambda: pending)
+        pending.errback(LookupFailed())
+        self.failureResultOf(first, LookupFailed)
+        self.failureResultOf(second, LookupFailed)
+
+    def test_invalidate(self):
+        self.cache.get('a', self.lookup, REJECT)
+        self.cache.get('b', self.lookup, REJECT)
+        self.cache.invalidate('a')
+        self.assertEquals(len(self.cache), 1)
+        self.cache.invalidate()
+        self.assertEquals(len(self.cache), 0)
+
+
+cache = VerdictCache(clock=task.Clock())
+
+
+class CachedMilter(MilterProtocol):
+    lookups = []
+
+    @cached(cache)
+    def onConnect(self, hostname, family, port, address):
+        self.lookups.append(address)
+        return REJECT if address == b'10.0.0.1' else CONTINUE
+
+    @cached(cache)
+    def onRcpt(self, args):
+        self.lookups.append(args[0])
+        return CONTINUE
+
+
+class CachedHandlerTest(unittest.TestCase):
+    def setUp(self):
+        cache.invalidate()
+        del CachedMilter.lookups[:]
+        self.factory = MilterFactory()
+        self.factory.protocol = CachedMilter
+
+    def connect(self):
+        proto = self.factory.buildProtocol(None)
+        proto.makeConnection(proto_helpers.StringTransport())
+        return proto
+
+    def test_sessions_share_the_cache(self):
+        connect = (b'\x00\x00\x00\x18Cmx.example\x004\x00\x19'
+                   b'10.0.0.1\x00')
+        for _ in range(3):
+            proto = self.connect()
+            proto.dataReceived(connect)
+            self.assertEquals(proto.transport.value(), REJECT.wire)
+        self.assertEquals(CachedMilter.lookups, [b'10.0.0.1'])
+
+    def test_envelope_keys_ignore_case(self):
+        proto = self.connect()
+        proto.dataReceived(b'\x00\x00\x00\x0bR<A@b.org>\x00'
+                           b'\x00\x00\x00\x0bR<a@B.org>\x00')
+        self.assertEquals(proto.transport.value(), CONTINUE.wire * 2)
+        self.assertEquals(CachedMilter.lookups, [b'<A@b.org>'])
+
+    def test_protocol_mask(self):
+        # cached handlers are still seen as overridden
+        self.assertFalse(self.connect().protocol_mask()
+                         & (constants.SMFIP_NORCPT | constants.SMFIP_NR_RCPT))
@@ -0,0 +1,210 @@
+from twisted.internet import defer
+from twisted.test import proto_helpers
+from twisted.trial import unittest
+
+from txmilter import MilterFactory
+from txmilter import MilterProtocol
+from txmilter import constants
+from txmilter import message
+from txmilter.accumulator import MessageAccumulatorMixin
+from txmilter.chain import MilterChainFactory
+from txmilter.chain import mergeSymlists
+from txmilter.codec import MilterDecoder
+from txmilter.codec import MilterEncoder
+from txmilter.protocol import ACCEPT, CONTINUE, DISCARD, REJECT, SKIP
+from txmilter.protocol import TEMPFAIL
+from txmilter.protocol import noreply
+
+
+encode = MilterEncoder().encode
+
+OPTNEG = encode(message.Optneg(6, 2**9 - 1, 2**21 - 1))
+HELO = b'\x00\x00\x00\x04Hme\x00'
+MAIL = b'\x00\x00\x00\x07M<a@b>\x00'
+HEADER = b'\x00\x00\x00\x06Lto\x00x\x00'
+BODY = b'\x00\x00\x00\x05Bbody'
+EOM = b'\x00\x00\x00\x01E'
+
+
+class Filter(MilterProtocol):
+    verdicts = {}
+
+    def connectionMade(self):
+        MilterProtocol.connectionMade(self)
+        self.calls = []
+
+    def verdict(self, name):
+        self.calls.append(name)
+        return self.verdicts.get(name, CONTINUE)
+
+    def onHelo(self, helo):
+        return self.verdict('helo')
+
+    def onMail(self, args):
+        return self.verdict('mail')
+
+    def onHeader(self, name, value):
+        return self.verdict('header')
+
+    def onBody(self, buf):
+        return self.verdict('body')
+
+    def onEom(self):
+        return self.verdict('eom')
+
+
+class Signer(Filter):
+    def onEom(self):
+        self.addHeader(b'X-Signed', b'yes')
+        return self.verdict('eom')
+
+
+class Scorer(Filter):
+    @noreply
+    def onHeader(self, name, value):
+        return self.verdict('header')
+
+    def onEom(self):
+        self.addHeader(b'X-Score', b'1')
+        self.pending = defer.Deferred()
+        return self.pending
+
+
+class Broken(Filter):
+    def onMail(self, args):
+        return 1 / 0
+
+
+class Accumulating(MessageAccumulatorMixin, Filter):
+    def onEom(self):
+        self.addHeader(b'X-From', self.message.sender)
+        return self.verdict('eom')
+
+
+def filterFactory(cls, verdicts=None, actions=constants.SMFIF_ADDHDRS):
+    factory = MilterFactory(actions=actions)
+    factory.protocol = type(cls.__name__, (cls,),
+                            {'verdicts': verdicts or {}})
+    return factory
+
+
+class ChainTest(unittest.TestCase):
+    def connect(self, *factories):
+        proto = MilterChainFactory(factories).buildProtocol(None)
+        proto.makeConnection(proto_helpers.StringTransport())
+        return proto
+
+    def replies(self, proto):
+        value = proto.transport.value()
+        proto.transport.clear()
+        return list(MilterDecoder().feed(value).decode())
+
+    def test_options_are_merged(self):
+        proto = self.connect(filterFactory(Signer), filterFactory(Scorer))
+        proto.dataReceived(OPTNEG)
+        optneg, = self.replies(proto)
+        self.assertEquals(optneg.actions, constants.SMFIF_ADDHDRS)
+        # both want headers, only one of them no reply to them
+        self.assertFalse(optneg.protocol & constants.SMFIP_NOHDRS)
+        self.assertFalse(optneg.protocol & constants.SMFIP_NR_HDR)
+        # none of them wants connect
+        self.assertTrue(optneg.protocol & constants.SMFIP_NOCONNECT)
+        self.assertTrue(optneg.protocol & constants.SMFIP_SKIP)
+
+    def test_frames_go_to_every_filter(self):
+        proto = self.connect(filterFactory(Filter), filterFactory(Filter))
+        proto.dataReceived(OPTNEG + HELO + MAIL + HEADER)
+        self.assertEquals(self.replies(proto)[1:], [CONTINUE] * 3)
+        for f in proto.filters:
+            self.assertEquals(f.calls, ['helo', 'mail', 'header'])
+
+    def test_most_restrictive_verdict_wins(self):
+        proto = self.connect(filterFactory(Filter, {'mail': TEMPFAIL}),
+                             filterFactory(Filter, {'mail': REJECT}),
+                             filterFactory(Filter, {'mail': DISCARD}))
+        proto.dataReceived(OPTNEG + MAIL)
+        self.assertEquals(self.replies(proto)[1:], [REJECT])
+
+    def test_reply_code_counts_as_its_class(self):
+        code = message.ReplyCode(b'550', b'no')
+        proto = self.connect(filterFactory(Filter, {'mail': code}),
+                             filterFactory(Filter, {'mail': TEMPFAIL}))
+        proto.dataReceived(OPTNEG + MAIL)
+        self.assertEquals(self.replies(proto)[1:], [code])
+
+    def test_accepting_filters_are_dropped(self):
+        accepting = filterFactory(Filter, {'mail': ACCEPT})
+        proto = self.connect(accepting, filterFactory(Filter))
+        proto.dataReceived(OPTNEG + MAIL + HEADER)
+        self.assertEquals(self.replies(proto)[1:], [CONTINUE] * 2)
+        self.assertEquals(proto.filters[0].calls, ['mail'])
+        self.assertEquals(proto.filters[1].calls, ['mail', 'header'])
+        # back for the next message
+        proto.dataReceived(MAIL)
+        self.assertEquals(proto.filters[0].calls, ['mail', 'mail'])
+
+    def test_accept_when_all_filters_accepted(self):
+        proto = self.connect(filterFactory(Filter, {'helo': ACCEPT}),
+                             filterFactory(Filter, {'mail': ACCEPT}))
+        proto.dataReceived(OPTNEG + HELO + MAIL)
+        self.assertEquals(self.replies(proto)[1:], [CONTINUE, ACCEPT])
+        # the connection stays accepted by the first one
+        proto.dataReceived(MAIL)
+        self.assertEquals(proto.filters[0].calls, ['helo'])
+
+    def test_skip_when_all_filters_skipped(self):
+        proto = self.connect(filterFactory(Filter, {'body': SKIP}),
+                             filterFactory(Filter))
+        proto.dataReceived(OPTNEG + MAIL + BODY + BODY + EOM)
+        self.assertEquals(self.replies(proto)[1:],
+                          [CONTINUE, CONTINUE, CONTINUE, CONTINUE])
+        self.assertEquals(proto.filters[0].calls, ['mail', 'body', 'eom'])
+
+        proto = self.connect(filterFactory(Filter, {'body': SKIP}),
+                             filterFactory(Filter, {'body': SKIP}))
+        proto.dataReceived(OPTNEG + MAIL + BODY)
+        self.assertEquals(self.replies(proto)[1:], [CONTINUE, SKIP])
+
+    def test_modifications_are_merged(self):
+        proto = self.connect(filterFactory(Signer), filterFactory(Scorer))
+        proto.dataReceived(OPTNEG + MAIL + EOM)
+        self.assertEquals(self.replies(proto)[1:], [CONTINUE])
+        proto.filters[1].pending.callback(ACCEPT)
+        # the other filter did not accept
+        self.assertEquals(self.replies(proto),
+                          [message.AddHeader(b'X-Signed', b'yes'),
+                           message.AddHeader(b'X-Score', b'1'),
+                           CONTINUE])
+
+    def test_modifications_are_dropped_on_reject(self):
+        proto = self.connect(filterFactory(Signer, {'eom': REJECT}),
+                             filterFactory(Scorer))
+        proto.dataReceived(OPTNEG + MAIL + EOM)
+        proto.filters[1].pending.callback(CONTINUE)
+        self.assertEquals(self.replies(proto)[1:], [CONTINUE, REJECT])
+
+    def test_failing_filter_replies_its_failure_verdict(self):
+        proto = self.connect(filterFactory(Broken), filterFactory(Filter))
+        proto.dataReceived(OPTNEG + MAIL)
+        self.assertEquals(self.replies(proto)[1:], [TEMPFAIL])
+        self.assertEquals(len(self.flushLoggedErrors(ZeroDivisionError)), 1)
+
+        proto = self.connect(filterFactory(Broken), filterFactory(Filter))
+        proto.filters[0].failureVerdict = CONTINUE
+        proto.dataReceived(OPTNEG + MAIL)
+        self.assertEquals(self.replies(proto)[1:], [CONTINUE])
+        self.assertEquals(len(self.flushLoggedErrors(ZeroDivisionError)), 1)
+
+    def test_mixin_filters(self):
+        proto = self.connect(filterFactory(Accumulating),
+                             filterFactory(Filter))
+        proto.dataReceived(OPTNEG + MAIL + HEADER + EOM)
+        self.assertEquals(self.replies(proto)[1:],
+                          [CONTINUE, CONTINUE,
+                           message.AddHeader(b'X-From', b'<a@b>'), CONTINUE])
+
+    def test_merge_symlists(self):
+        self.assertEquals(mergeSymlists([{0: [b'j'], 1: [b'i']},
+                                         {0: [b'{auth}', b'j']}]),
+                          {0: [b'j', b'{auth}']})
+        self.assertEquals(mergeSymlists([]), {})
@@ -0,0 +1,180 @@
+import random
+
+from twisted.internet import defer, endpoints, reactor
+from twisted.test import proto_helpers
+from twisted.trial import unittest
+
+from txmilter import MilterFactory
+from txmilter import MilterProtocol
+from txmilter import constants
+from txmilter import message
+from txmilter.client import MilterClientProtocol
+from txmilter.codec import MilterEncoder
+from txmilter.protocol import ACCEPT, CONTINUE, REJECT
+from txmilter.recorder import SessionRecorder
+from txmilter.simulator import Histogram
+from txmilter.simulator import LoadGenerator
+from txmilter.simulator import Stats
+from txmilter.simulator import parseDistribution
+from txmilter.simulator import recordedSessions
+from txmilter.simulator import runSession
+from txmilter.simulator import syntheticSessions
+
+
+class HeaderMilter(MilterProtocol):
+    def onHeader(self, name, value):
+        if name == b'X-Reject':
+            return REJECT
+        return CONTINUE
+
+    def onEom(self):
+        self.addHeader(b'X-Seen', b'yes')
+        return ACCEPT
+
+
+class MilterClientTest(unittest.TestCase):
+    def setUp(self):
+        self.client = MilterClientProtocol()
+        self.transport = proto_helpers.StringTransport()
+        self.client.makeConnection(self.transport)
+        self.encode = MilterEncoder().encode
+
+    def test_reply(self):
+        replies = []
+        self.client.send(message.Helo(b'me')).addCallback(replies.append)
+        self.assertEquals(self.transport.value(),
+                          self.encode(message.Helo(b'me')))
+        self.client.dataReceived(CONTINUE.wire)
+        self.assertEquals(replies, [CONTINUE])
+
+    def test_negotiation(self):
+        self.client.negotiate()
+        self.client.dataReceived(self.encode(message.Optneg(
+                6, 0, constants.SMFIP_NOHELO | constants.SMFIP_NR_HDR)))
+        self.transport.clear()
+
+        replies = []
+        self.client.send(message.Helo(b'me')).addCallback(replies.append)
+        self.client.send(message.Header(b'a', b'b')).addCallback(
+                replies.append)
+        self.assertEquals(replies, [None, None])
+        self.assertEquals(self.transport.value(),
+                          self.encode(message.Header(b'a', b'b')))
+
+    def test_modifications(self):
+        replies = []
+        self.client.send(message.BodyEob()).addCallback(replies.append)
+        self.client.dataReceived(
+                b'\x00\x00\x00\x01p'
+                + self.encode(message.AddHeader(b'X-Seen', b'yes'))
+                + ACCEPT.wire)
+        self.assertEquals(replies, [ACCEPT])
+        self.assertEquals(self.client.modifications,
+                          [message.AddHeader(b'X-Seen', b'yes')])
+
+
+class SimulatorTest(unittest.TestCase):
+    def test_distributions(self):
+        rng = random.Random(0)
+        self.assertEquals(parseDistribution('fixed:10')(rng), 10)
+        self.assertTrue(1 <= parseDistribution('uniform:1:5')(rng) <= 5)
+        self.assertTrue(parseDistribution('choice:3,4')(rng) in (3, 4))
+        self.assertTrue(parseDistribution('lognormal:5:1')(rng) >= 0)
+        self.assertRaises(ValueError, parseDistribution, 'fixed:x')
+        self.assertRaises(ValueError, parseDistribution, 'nonexistant:1')
+
+    def test_recorded_sessions(self):
+        session = next(syntheticSessions(parseDistribution('fixed:100000'),
+                                         parseDistribution('fixed:2'),
+                                         parseDistribution('fixed:3')))
+        encode = MilterEncoder().encode
+        path = self.mktemp()
+        with open(path, 'wb') as f:
+            f.write(b''.join(encode(m) for m in session) * 2)
+        self.assertEquals(recordedSessions(path), [session, session])
+
+    def test_recorder_logs(self):
+        path = self.mktemp()
+        recorder = SessionRecorder(path)
+        factory = MilterFactory(recorder=recorder)
+        factory.protocol = HeaderMilter
+        encode = MilterEncoder().encode
+        session = [message.Helo(b'me'), message.Header(b'to', b'x'),
+                   message.Body(b'body'), message.BodyEob(), message.Quit()]
+        proto = factory.buildProtocol(None)
+        proto.makeConnection(proto_helpers.StringTransport())
+        for msg in session:
+            proto.dataReceived(encode(msg))
+        proto.connectionLost(None)
+        recorder.close()
+        self.assertEquals(recordedSessions(path), [session])
+
+    def test_failed_sessions_are_closed(self):
+        transports = []
+
+        class Endpoint(object):
+            def connect(self, factory):
+                client = factory.buildProtocol(None)
+                transports.append(proto_helpers.StringTransport())
+                client.makeConnection(transports[-1])
+                return defer.succeed(client)
+
+        # the header cannot be encoded
+        sessions = [[message.Header(b'to', 1)]]
+        stats = self.successResultOf(LoadGenerator(Endpoint(), sessions,
+                                                   count=1).run())
+        self.assertEquals(stats.failed, 1)
+        self.assertTrue(transports[0].disconnecting)
+
+    def test_histogram(self):
+        hist = Histogram()
+        for us in range(1, 1001):
+            hist.add(us / 1e6)
+        self.assertEquals(len(hist), 1000)
+        for pct in (50, 90, 99):
+            exact = pct * 10 / 1e6
+            self.assertTrue(exact <= hist.percentile(pct) <= exact * 2**0.125)
+        self.assertEquals(Histogram().percentile(50), None)
+
+    def test_session_ending_on_a_verdict_quits(self):
+        client = MilterClientProtocol()
+        transport = proto_helpers.StringTransport()
+        client.makeConnection(transport)
+        d = runSession(client, [message.Mail([b'<a@b>']),
+                                message.Header(b'to', b'x'),
+                                message.Quit()], Stats())
+        client.dataReceived(REJECT.wire)
+        self.successResultOf(d)
+        encode = MilterEncoder().encode
+        self.assertEquals(transport.value(),
+                          encode(message.Mail([b'<a@b>']))
+                          + encode(message.Quit()))
+        self.assertTrue(transport.disconnecting)
+
+    def test_load(self):
+        factory = MilterFactory()
+        factory.protocol = HeaderMilter
+        server = endpoints.TCP4ServerEndpoint(reactor, 0,
+                                              interface='127.0.0.1')
+
+        def listening(port):
+            self.addCleanup(port.stopListening)
+            client = endpoints.TCP4ClientEndpoint(reactor, '127.0.0.1',
+                                                  port.getHost().port)
+            sessions = syntheticSessions(parseDistribution('fixed:70000'),
+                                         parseDistribution('uniform:1:3'),
+                                         parseDistribution('fixed:5'))
+            return LoadGenerator(client, sessions, concurrency=3,
+                                 count=10).run()
+
+        def check(stats):
+            self.assertEquals(stats.sessions, 10)
+            self.assertEquals(stats.failed, 0)
+            self.assertEquals(stats.verdicts, {'SMFIR_ACCEPT': 10})
+            self.assertEquals(len(stats.latency['SMFIC_HEADER']), 60)
+            # the milter asked not to be called for the other commands
+            self.assertFalse('SMFIC_HELO' in stats.latency)
+            self.assertFalse('SMFIC_BODY' in stats.latency)
+
+        return server.listen(factory).addCallback(listening).addCallback(
+                check)
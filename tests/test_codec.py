@@ -1,66 +1,91 @@
+import io
+import struct
 import unittest
 
 from txmilter import MilterMessage
 from txmilter.codec import MilterEncoder
 from txmilter.codec import MilterDecoder
+from txmilter.codec import MilterCodecError
+from txmilter.codec import ConstantReply
 from txmilter.constants import ProtocolFamily
+from txmilter.constants import VALID_CMDS
+from txmilter.message import MESSAGE_TYPES
+from txmilter.message import Abort, AddHeader, ChgFrom, Header, Mail, Rcpt
+from txmilter.message import ChgHeader
 
 
 class MilterCodecTest(unittest.TestCase):
-    msgs = [( MilterMessage('SMFIC_ABORT'), '\x00\x00\x00\x01A' ),
-            ( MilterMessage('SMFIC_BODY', dict(buf='mybody')),
-              '\x00\x00\x00\x07Bmybody' ),
+    msgs = [( MilterMessage('SMFIC_ABORT'), b'\x00\x00\x00\x01A' ),
+            ( MilterMessage('SMFIC_BODY', dict(buf=b'mybody')),
+              b'\x00\x00\x00\x07Bmybody' ),
             ( MilterMessage('SMFIC_CONNECT',
-                            dict(hostname='example.com',
+                            dict(hostname=b'example.com',
                                  family=ProtocolFamily.SMFIA_INET, port=1234,
-                                 address='127.0.0.1')),
-              '\x00\x00\x00\x1aCexample.com\x004\x04\xd2127.0.0.1\x00' ),
-            ( MilterMessage('SMFIC_BODYEOB'), '\x00\x00\x00\x01E' ),
-            ( MilterMessage('SMFIC_HEADER', dict(name='to', value='me')),
-              '\x00\x00\x00\x07Lto\x00me\x00' ),
-            ( MilterMessage('SMFIC_HELO', dict(helo='me')),
-              '\x00\x00\x00\x04Hme\x00' ),
-            ( MilterMessage('SMFIC_MAIL', dict(args=['one', 'two'])),
-              '\x00\x00\x00\tMone\x00two\x00' ),
-            ( MilterMessage('SMFIC_EOH'), '\x00\x00\x00\x01N' ),
-            ( MilterMessage('SMFIC_RCPT', dict(args=['one', 'two'])),
-              '\x00\x00\x00\tRone\x00two\x00' ),
-            ( MilterMessage('SMFIC_QUIT'), '\x00\x00\x00\x01Q' ),
+                                 address=b'127.0.0.1')),
+              b'\x00\x00\x00\x1aCexample.com\x004\x04\xd2127.0.0.1\x00' ),
+            ( MilterMessage('SMFIC_BODYEOB'), b'\x00\x00\x00\x01E' ),
+            ( MilterMessage('SMFIC_HEADER', dict(name=b'to', value=b'me')),
+              b'\x00\x00\x00\x07Lto\x00me\x00' ),
+            ( MilterMessage('SMFIC_HELO', dict(helo=b'me')),
+              b'\x00\x00\x00\x04Hme\x00' ),
+            ( MilterMessage('SMFIC_MAIL', dict(args=[b'one', b'two'])),
+              b'\x00\x00\x00\tMone\x00two\x00' ),
+            ( MilterMessage('SMFIC_EOH'), b'\x00\x00\x00\x01N' ),
+            ( MilterMessage('SMFIC_RCPT', dict(args=[b'one', b'two'])),
+              b'\x00\x00\x00\tRone\x00two\x00' ),
+            ( MilterMessage('SMFIC_QUIT'), b'\x00\x00\x00\x01Q' ),
+            ( MilterMessage('SMFIC_MACRO',
+                            dict(cmdcode=b'C',
+                                 nameval=[b'j', b'mx', b'{auth}', b''])),
+              b'\x00\x00\x00\x0fDCj\x00mx\x00{auth}\x00\x00' ),
+            ( MilterMessage('SMFIC_QUIT_NC'), b'\x00\x00\x00\x01K' ),
 
             ( MilterMessage('SMFIR_ADDRCPT',
-                            dict(rcpt='test@example.com')),
-              '\x00\x00\x00\x12+test@example.com\x00' ),
+                            dict(rcpt=b'test@example.com')),
+              b'\x00\x00\x00\x12+test@example.com\x00' ),
             ( MilterMessage('SMFIR_DELRCPT',
-                            dict(rcpt='test@example.com')),
-              '\x00\x00\x00\x12-test@example.com\x00' ),
-            ( MilterMessage('SMFIR_ACCEPT'), '\x00\x00\x00\x01a' ),
+                            dict(rcpt=b'test@example.com')),
+              b'\x00\x00\x00\x12-test@example.com\x00' ),
+            ( MilterMessage('SMFIR_ACCEPT'), b'\x00\x00\x00\x01a' ),
             ( MilterMessage('SMFIR_REPLBODY',
-                            dict(buf='new\nbody\n')),
-              '\x00\x00\x00\nbnew\nbody\n' ),
-            ( MilterMessage('SMFIR_CONTINUE'), '\x00\x00\x00\x01c' ),
-            ( MilterMessage('SMFIR_DISCARD'), '\x00\x00\x00\x01d' ),
+                            dict(buf=b'new\nbody\n')),
+              b'\x00\x00\x00\nbnew\nbody\n' ),
+            ( MilterMessage('SMFIR_CONTINUE'), b'\x00\x00\x00\x01c' ),
+            ( MilterMessage('SMFIR_DISCARD'), b'\x00\x00\x00\x01d' ),
             ( MilterMessage('SMFIR_ADDHEADER',
-                            dict(name='to', value='test@example.com')),
-              '\x00\x00\x00\x15hto\x00test@example.com\x00' ),
+                            dict(name=b'to', value=b'test@example.com')),
+              b'\x00\x00\x00\x15hto\x00test@example.com\x00' ),
             ( MilterMessage('SMFIR_CHGHEADER',
                             dict(index=1,
-                                 name='to',
-                                 value='test@example.com')),
-              '\x00\x00\x00\x19m\x00\x00\x00\x01to\x00test@example.com\x00'
+                                 name=b'to',
+                                 value=b'test@example.com')),
+              b'\x00\x00\x00\x19m\x00\x00\x00\x01to\x00test@example.com\x00'
             ),
-            ( MilterMessage('SMFIR_PROGRESS'), '\x00\x00\x00\x01p' ),
+            ( MilterMessage('SMFIR_PROGRESS'), b'\x00\x00\x00\x01p' ),
             ( MilterMessage('SMFIR_QUARANTINE',
-                            dict(reason='reason')),
-              '\x00\x00\x00\x08qreason\x00' ),
-            ( MilterMessage('SMFIR_REJECT'), '\x00\x00\x00\x01r' ),
-            ( MilterMessage('SMFIR_TEMPFAIL'), '\x00\x00\x00\x01t' ),
+                            dict(reason=b'reason')),
+              b'\x00\x00\x00\x08qreason\x00' ),
+            ( MilterMessage('SMFIR_REJECT'), b'\x00\x00\x00\x01r' ),
+            ( MilterMessage('SMFIR_TEMPFAIL'), b'\x00\x00\x00\x01t' ),
+            ( MilterMessage('SMFIR_SKIP'), b'\x00\x00\x00\x01s' ),
+            ( MilterMessage('SMFIR_CHGFROM',
+                            {'from': b'a@b', 'esmtp_arg': b'X'}),
+              b'\x00\x00\x00\x07ea@b\x00X\x00' ),
             ( MilterMessage('SMFIR_REPLYCODE',
-                            dict(smtpcode='333', text='text')),
-              '\x00\x00\x00\ny333 text\x00' ),
+                            dict(smtpcode=b'333', text=b'text')),
+              b'\x00\x00\x00\ny333 text\x00' ),
             ( MilterMessage('SMFIC_OPTNEG',
                             dict(version=1, actions=2, protocol=3)),
-              '\x00\x00\x00\rO\x00\x00\x00\x01'
-              '\x00\x00\x00\x02\x00\x00\x00\x03' ),
+              b'\x00\x00\x00\rO\x00\x00\x00\x01'
+              b'\x00\x00\x00\x02\x00\x00\x00\x03' ),
+            ( MilterMessage('SMFIC_OPTNEG',
+                            dict(version=6, actions=256, protocol=0,
+                                 symlists={0: [b'j', b'{daemon_name}'],
+                                           3: [b'i']})),
+              b'\x00\x00\x00\x27O\x00\x00\x00\x06'
+              b'\x00\x00\x01\x00\x00\x00\x00\x00'
+              b'\x00\x00\x00\x00j {daemon_name}\x00'
+              b'\x00\x00\x00\x03i\x00' ),
            ]
 
 
@@ -90,6 +115,54 @@ class MilterMessageTest(unittest.TestCase):
                                            {'value': 'you', 'name': 'to'}))
 
 
+class TypedMessageTest(unittest.TestCase):
+    def test_data_compatibility(self):
+        self.assertEquals(Header('to', 'me').data,
+                          {'name': 'to', 'value': 'me'})
+        self.assertEquals(ChgFrom(b'a@b', b'X').data,
+                          {'from': b'a@b', 'esmtp_arg': b'X'})
+
+    def test_equals_milter_message(self):
+        self.assertEquals(Header('to', 'me'),
+                          MilterMessage('SMFIC_HEADER',
+                                        {'name': 'to', 'value': 'me'}))
+        self.assertEquals(MilterMessage('SMFIC_ABORT'), Abort())
+
+    def test_different_commands_are_not_equal(self):
+        self.assertNotEquals(Mail(['a']), Rcpt(['a']))
+
+    def test_no_instance_dict(self):
+        self.assertRaises(AttributeError, setattr, Header('a', 'b'), 'x', 1)
+
+    def test_text_is_decoded_on_demand(self):
+        msg = Header(b'Subject', b'caf\xc3\xa9')
+        self.assertEquals(msg.value, b'caf\xc3\xa9')
+        self.assertEquals(msg.text('value'), u'caf\xe9')
+        self.assertEquals(Mail([b'<a@b>', b'SIZE=1']).text('args'),
+                          [u'<a@b>', u'SIZE=1'])
+
+    def test_message_types(self):
+        self.assertEquals(set(MESSAGE_TYPES), VALID_CMDS)
+
+
+class ConstantReplyTest(unittest.TestCase):
+    def test_wire_is_precomputed(self):
+        reply = ConstantReply('SMFIR_CONTINUE')
+        self.assertEquals(reply.wire, b'\x00\x00\x00\x01c')
+        self.assertEquals(MilterEncoder().encode(reply), reply.wire)
+
+    def test_equals_plain_message(self):
+        self.assertEquals(ConstantReply('SMFIR_ACCEPT'),
+                          MilterMessage('SMFIR_ACCEPT'))
+
+    def test_immutable(self):
+        reply = ConstantReply('SMFIR_ACCEPT')
+        self.assertRaises(AttributeError, setattr, reply, 'cmd',
+                          'SMFIR_REJECT')
+        reply.data['foo'] = 'bar'
+        self.assertEquals(reply.data, {})
+
+
 class MilterProtocolFamilyTest(unittest.TestCase):
     def test_lookupByName_returns_unknown_by_default(self):
         self.assertTrue(ProtocolFamily.lookupByName('NONEXISTANT')
@@ -109,9 +182,15 @@ class MilterDecoderTest(MilterCodecTest):
             self.decoder.feed(encoded)
             self.assertEquals(next(self.decoder.decode()), msg)
 
+    def test_decode_typed_messages(self):
+        self.decoder.feed(b'\x00\x00\x00\x07Lto\x00me\x00')
+        msg = next(self.decoder.decode())
+        self.assertTrue(isinstance(msg, Header))
+        self.assertEquals(tuple(msg), (b'to', b'me'))
+
     def test_multiple_messages(self):
         messages = [ x[0] for x in self.msgs ]
-        self.decoder.feed(''.join(x[1] for x in self.msgs))
+        self.decoder.feed(b''.join(x[1] for x in self.msgs))
 
         res = []
         for m in self.decoder.decode():
@@ -120,7 +199,7 @@ class MilterDecoderTest(MilterCodecTest):
         self.assertEquals(messages, res)
 
     def test_chunked_messages(self):
-        chunks = ('\x00\x00\x00\x07Bmy', 'body')
+        chunks = (b'\x00\x00\x00\x07Bmy', b'body')
 
         decoded = []
         for chunk in chunks:
@@ -131,15 +210,67 @@ class MilterDecoderTest(MilterCodecTest):
                 pass
         self.assertEquals(len(decoded), 1)
         self.assertEquals(decoded[0],
-                          MilterMessage('SMFIC_BODY', dict(buf='mybody')))
+                          MilterMessage('SMFIC_BODY', dict(buf=b'mybody')))
+
+    def test_byte_by_byte_messages(self):
+        encoded = b''.join(x[1] for x in self.msgs)
+
+        decoded = []
+        for i in range(len(encoded)):
+            self.decoder.feed(encoded[i:i + 1])
+            decoded.extend(self.decoder.decode())
+        self.assertEquals(decoded, [ x[0] for x in self.msgs ])
+
+    def test_body_is_not_copied(self):
+        self.decoder.feed(b'\x00\x00\x00\x07Bmybody')
+        msg = next(self.decoder.decode())
+        self.assertTrue(isinstance(msg.data['buf'], memoryview))
+        self.assertEquals(msg.data['buf'].tobytes(), b'mybody')
+
+    def test_feed_while_holding_body(self):
+        # a handler keeping a body chunk must not prevent further decoding
+        # nor see its chunk change
+        self.decoder.feed(b'\x00\x00\x00\x07Bmybody\x00\x00')
+        body = next(self.decoder.decode()).data['buf']
+        self.decoder.feed(b'\x00\x01A')
+        self.assertEquals(next(self.decoder.decode()),
+                          MilterMessage('SMFIC_ABORT'))
+        self.assertEquals(body.tobytes(), b'mybody')
+
+    def test_buffer_is_compacted(self):
+        self.decoder.compactThreshold = 16
+        frame = b'\x00\x00\x00\x07Bmybody'
+        for _ in range(100):
+            self.decoder.feed(frame)
+            list(self.decoder.decode())
+        self.assertTrue(len(self.decoder._buf) <= 2 * len(frame))
+
+    def test_invalid_command_raises(self):
+        self.decoder.feed(b'\x00\x00\x00\x01Z\x00\x00\x00\x01A')
+        self.assertRaises(MilterCodecError, next, self.decoder.decode())
+        # the invalid frame is left in the buffer, like the other errors
+        self.assertRaises(MilterCodecError, next, self.decoder.decode())
+
+    def test_invalid_frames_are_left_in_the_buffer(self):
+        for frame in (b'\x00\x00\x00\x00',
+                      b'\x00\x00\x00\x02Cx'):
+            decoder = MilterDecoder().feed(frame + b'\x00\x00\x00\x01A')
+            self.assertRaises(MilterCodecError, next, decoder.decode())
+            self.assertRaises(MilterCodecError, next, decoder.decode())
 
     def test_smfic_header_decode_with_empty_value(self):
         # test SMFIC_HEADER decoding when header has an empty value
-        msg = MilterMessage('SMFIC_HEADER', dict(name='to', value=''))
-        encoded = '\x00\x00\x00\x05Lto\x00\x00'
+        msg = MilterMessage('SMFIC_HEADER', dict(name=b'to', value=b''))
+        encoded = b'\x00\x00\x00\x05Lto\x00\x00'
         self.decoder.feed(encoded)
         self.assertEquals(next(self.decoder.decode()), msg)
 
+    def test_smfir_header_decode_with_empty_value(self):
+        self.decoder.feed(b'\x00\x00\x00\x05hto\x00\x00'
+                          b'\x00\x00\x00\x09m\x00\x00\x00\x01to\x00\x00')
+        self.assertEquals(list(self.decoder.decode()),
+                          [AddHeader(b'to', b''), ChgHeader(1, b'to', b'')])
+
 
 class MilterEncoderTest(MilterCodecTest):
     def setUp(self):
@@ -148,3 +279,47 @@ class MilterEncoderTest(MilterCodecTest):
     def test_encode_messages(self):
         for msg, encoded in self.msgs:
             self.assertEquals(self.encoder.encode(msg), encoded)
+
+    def replbody(self, body, chunkSize):
+        seq = self.encoder.encodeReplBody(body, chunkSize=chunkSize)
+        frames = []
+        for header, payload in zip(seq[::2], seq[1::2]):
+            self.assertEquals(header,
+                              struct.pack('!Ic', len(payload) + 1, b'b'))
+            frames.append(payload)
+        return frames
+
+    def test_replbody_splits_large_body(self):
+        self.assertEquals(self.replbody(b'0123456789', 4),
+                          [b'0123', b'4567', b'89'])
+
+    def test_replbody_coalesces_small_chunks(self):
+        self.assertEquals(self.replbody([b'01', b'2', b'345678', b'9'], 4),
+                          [b'0123', b'4567', b'89'])
+
+    def test_replbody_reads_files(self):
+        self.assertEquals(self.replbody(io.BytesIO(b'0123456789'), 4),
+                          [b'0123', b'4567', b'89'])
+
+    def test_replbody_does_not_copy_large_chunks(self):
+        body = bytearray(b'0123456789')
+        payloads = self.encoder.encodeReplBody(body, chunkSize=4)[1::2]
+        body[0:1] = b'x'
+        self.assertEquals(payloads[0], b'x123')
+
+    def test_replbody_empty_body(self):
+        self.assertEquals(self.encoder.encodeReplBody(b''),
+                          [b'\x00\x00\x00\x01b'])
+
+    def test_text_is_encoded(self):
+        self.assertEquals(self.encoder.encode(AddHeader(u'X-Caf\xe9', u'ok')),
+                          b'\x00\x00\x00\x0chX-Caf\xc3\xa9\x00ok\x00')
+
+    def test_non_string_raises(self):
+        self.assertRaises(MilterCodecError, self.encoder.encode,
+                          AddHeader(1, b'ok'))
+
+    def test_invalid_command_raises(self):
+        msg = MilterMessage('SMFIC_ABORT')
+        msg.cmd = 'NONEXISTANT'
+        self.assertRaises(MilterCodecError, self.encoder.encode, msg)
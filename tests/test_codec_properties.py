@@ -0,0 +1,265 @@
+""" Property based conformance tests of the codec.
+
+    Messages of every command are generated at random (from fixed seeds, so
+    failures can be reproduced), and must survive an encode/decode round
+    trip however the stream is fragmented. Garbage must only ever make the
+    decoder raise MilterCodecError, without buffering more than a frame.
+"""
+import random
+import struct
+import unittest
+
+from txmilter import constants
+from txmilter import message
+from txmilter.codec import MilterCodecError
+from txmilter.codec import MilterDecoder
+from txmilter.codec import MilterEncoder
+from txmilter.constants import ProtocolFamily
+
+
+SEEDS = range(20)
+
+
+def _bytes(rnd, minSize=0, maxSize=64, nul=False):
+    # random bytes, without NUL unless asked for
+    low = 0 if nul else 1
+    return bytes(bytearray(rnd.randint(low, 255)
+                           for _ in range(rnd.randint(minSize, maxSize))))
+
+
+def _strs(rnd):
+    return [_bytes(rnd, 1) for _ in range(rnd.randint(1, 5))]
+
+
+def _u32(rnd):
+    return rnd.randint(0, 2**32 - 1)
+
+
+def _name(rnd):
+    # macro names: printable, without spaces
+    return bytes(bytearray(rnd.randint(33, 126)
+                           for _ in range(rnd.randint(1, 16))))
+
+
+def _symlists(rnd):
+    return dict((stage, [_name(rnd) for _ in range(rnd.randint(1, 4))])
+                for stage in rnd.sample(range(7), rnd.randint(1, 3)))
+
+
+def _macro(rnd):
+    nameval = []
+    for _ in range(rnd.randint(0, 4)):
+        nameval.extend([_bytes(rnd, 1, 16), _bytes(rnd, 0, 32)])
+    return message.Macro(rnd.choice(list(constants.MACRO_STAGES)), nameval)
+
+
+def _optneg(rnd):
+    if rnd.random() < 0.5:
+        return message.Optneg(_u32(rnd), _u32(rnd), _u32(rnd))
+    return message.OptnegSymlist(_u32(rnd), _u32(rnd), _u32(rnd),
+                                 _symlists(rnd))
+
+
+def _connect(rnd):
+    family = rnd.choice([ProtocolFamily.SMFIA_INET, ProtocolFamily.SMFIA_INET6,
+                         ProtocolFamily.SMFIA_UNIX,
+                         ProtocolFamily.SMFIA_UNKNOWN])
+    if family is ProtocolFamily.SMFIA_UNKNOWN:
+        # no port nor address
+        return message.Connect(_bytes(rnd), family, None, None)
+    return message.Connect(_bytes(rnd), family, rnd.randint(0, 65535),
+                           _bytes(rnd))
+
+
+# command -> function returning a random message of that command
+GENERATORS = {
+    'SMFIC_BODY': lambda rnd: message.Body(_bytes(rnd, 0, 4096, nul=True)),
+    'SMFIC_CONNECT': _connect,
+    'SMFIC_MACRO': _macro,
+    'SMFIC_HELO': lambda rnd: message.Helo(_bytes(rnd)),
+    'SMFIC_HEADER': lambda rnd: message.Header(_bytes(rnd, 1),
+                                               _bytes(rnd, 0, 512)),
+    'SMFIC_MAIL': lambda rnd: message.Mail(_strs(rnd)),
+    'SMFIC_OPTNEG': _optneg,
+    'SMFIC_RCPT': lambda rnd: message.Rcpt(_strs(rnd)),
+    'SMFIC_UNKNOWN': lambda rnd: message.Unknown(_bytes(rnd)),
+    'SMFIR_ADDRCPT': lambda rnd: message.AddRcpt(_bytes(rnd)),
+    'SMFIR_DELRCPT': lambda rnd: message.DelRcpt(_bytes(rnd)),
+    'SMFIR_ADDRCPT_PAR': lambda rnd: message.AddRcptPar(_bytes(rnd),
+                                                        _bytes(rnd)),
+    'SMFIR_REPLBODY': lambda rnd: message.ReplBody(
+            _bytes(rnd, 0, 4096, nul=True)),
+    'SMFIR_CHGFROM': lambda rnd: message.ChgFrom(_bytes(rnd), _bytes(rnd)),
+    'SMFIR_ADDHEADER': lambda rnd: message.AddHeader(_bytes(rnd, 1),
+                                                     _bytes(rnd)),
+    'SMFIR_CHGHEADER': lambda rnd: message.ChgHeader(_u32(rnd),
+                                                     _bytes(rnd, 1),
+                                                     _bytes(rnd)),
+    'SMFIR_QUARANTINE': lambda rnd: message.Quarantine(_bytes(rnd, 1)),
+    'SMFIR_REPLYCODE': lambda rnd: message.ReplyCode(
+            str(rnd.randint(200, 599)).encode('ascii'), _bytes(rnd, 1)),
+}
+
+
+def randomMessage(rnd, cmd):
+    generator = GENERATORS.get(cmd)
+    if generator is None:
+        # commands without arguments
+        return message.MESSAGE_TYPES[cmd]()
+    return generator(rnd)
+
+
+def fragments(rnd, data):
+    """ Split data in fragments of random sizes, from 1 byte to a few
+        frames """
+    pos = 0
+    while pos < len(data):
+        size = rnd.choice([1, rnd.randint(1, 16), rnd.randint(1, 8192)])
+        yield data[pos:pos + size]
+        pos += size
+
+
+class RoundTripTest(unittest.TestCase):
+    def setUp(self):
+        self.encoder = MilterEncoder()
+
+    def stream(self, rnd, count=200):
+        cmds = sorted(constants.VALID_CMDS)
+        msgs = [randomMessage(rnd, rnd.choice(cmds)) for _ in range(count)]
+        return msgs, b''.join(self.encoder.encode(m) for m in msgs)
+
+    def test_generators_cover_every_command(self):
+        rnd = random.Random(0)
+        for cmd in constants.VALID_CMDS:
+            self.assertEquals(randomMessage(rnd, cmd).cmd, cmd)
+
+    def test_every_command_round_trips(self):
+        for seed in SEEDS:
+            rnd = random.Random(seed)
+            for cmd in sorted(constants.VALID_CMDS):
+                msg = randomMessage(rnd, cmd)
+                decoder = MilterDecoder().feed(self.encoder.encode(msg))
+                self.assertEquals(list(decoder.decode()), [msg],
+                                  'seed %d, %r' % (seed, msg))
+
+    def test_fragmented_streams(self):
+        for seed in SEEDS:
+            rnd = random.Random(seed)
+            msgs, data = self.stream(rnd)
+            decoder = MilterDecoder()
+            decoded = []
+            for fragment in fragments(rnd, data):
+                decoder.feed(fragment)
+                decoded.extend(decoder.decode())
+            self.assertEquals(decoded, msgs, 'seed %d' % seed)
+
+    def test_reencoding_is_stable(self):
+        for seed in SEEDS:
+            rnd = random.Random(seed)
+            _, data = self.stream(rnd, count=50)
+            decoded = MilterDecoder().feed(data).decode()
+            self.assertEquals(b''.join(self.encoder.encode(m)
+                                       for m in decoded), data)
+
+
+class GarbageTest(unittest.TestCase):
+    def decodeAll(self, decoder):
+        """ Decode what can be, skipping the invalid frames. Return the
+            decoder to go on with: a new one after a framing error, as the
+            connection would be dropped. """
+        while True:
+            pos = decoder._pos
+            try:
+                for _ in decoder.decode():
+                    pass
+                return decoder
+            except MilterCodecError:
+                if decoder._pos == pos:
+                    fresh = MilterDecoder()
+                    fresh.maxFrameSize = decoder.maxFrameSize
+                    return fresh
+
+    def test_garbage_only_raises_codec_errors(self):
+        for seed in SEEDS:
+            rnd = random.Random(seed)
+            decoder = MilterDecoder()
+            decoder.maxFrameSize = 4096
+            for fragment in fragments(rnd, _bytes(rnd, 0, 20000, nul=True)):
+                decoder.feed(fragment)
+                decoder = self.decodeAll(decoder)
+                self.assertTrue(len(decoder._buf) - decoder._pos
+                                <= 4096 + 4 + 8192)
+
+    def test_mutated_frames_only_raise_codec_errors(self):
+        encoder = MilterEncoder()
+        codes = sorted(constants.CMD_CODES.values())
+        for seed in SEEDS:
+            rnd = random.Random(seed)
+            for cmd in sorted(constants.VALID_CMDS):
+                frame = bytearray(encoder.encode(randomMessage(rnd, cmd)))
+                payload = frame[5:]
+                if payload and rnd.random() < 0.5:
+                    # truncate the payload, keeping a consistent length
+                    payload = payload[:rnd.randint(0, len(payload) - 1)]
+                for _ in range(rnd.randint(0, 3)):
+                    if payload:
+                        payload[rnd.randrange(len(payload))] = \
+                                rnd.randint(0, 255)
+                frame = (struct.pack('!Ic', len(payload) + 1,
+                                     rnd.choice(codes)) + bytes(payload))
+                self.decodeAll(MilterDecoder().feed(frame))
+
+    def test_zero_length_raises(self):
+        decoder = MilterDecoder().feed(b'\x00\x00\x00\x00A')
+        self.assertRaises(MilterCodecError, list, decoder.decode())
+
+    def test_huge_length_is_not_buffered(self):
+        decoder = MilterDecoder()
+        decoder.feed(b'\xff\xff\xff\xffB')
+        self.assertRaises(MilterCodecError, list, decoder.decode())
+        # the stream cannot be resynchronized
+        decoder.feed(b'\x00\x00\x00\x01A')
+        self.assertRaises(MilterCodecError, list, decoder.decode())
+
+    def test_truncated_connect_raises(self):
+        for data in (b'Chost', b'Chost\x004', b'Chost\x004\x00',
+                     b'Chost\x004\x00\x19', b'Chost\x004\x00\x19addr'):
+            decoder = MilterDecoder().feed(struct.pack('!I', len(data))
+                                           + data)
+            self.assertRaises(MilterCodecError, list, decoder.decode())
+
+    def test_connect_of_unknown_family(self):
+        # as sent by Postfix when it does not know the client address
+        decoder = MilterDecoder().feed(b'\x00\x00\x00\x0cClocalhost\x00U')
+        self.assertEquals(list(decoder.decode()), [message.Connect(
+                b'localhost', ProtocolFamily.SMFIA_UNKNOWN, None, None)])
+
+    def test_truncated_fields_raise(self):
+        for data in (b'm\x00\x00', b'y33', b'O\x00\x00\x00\x06',
+                     b'O' + b'\x00' * 12 + b'\x00\x00\x00\x01j'):
+            decoder = MilterDecoder().feed(struct.pack('!I', len(data))
+                                           + data)
+            self.assertRaises(MilterCodecError, list, decoder.decode())
+
+
+class BufferingTest(unittest.TestCase):
+    """ Buffering must stay bounded by the largest frame, however the
+        stream is fragmented (the cost of decoding is gated by
+        benchmarks/decoder.py --check-linear). """
+
+    def stream(self, size, chunk=constants.MILTER_CHUNK_SIZE):
+        frame = struct.pack('!Ic', chunk + 1, b'B') + b'x' * chunk
+        return frame * (size // chunk)
+
+    def test_buffering_is_bounded(self):
+        data = self.stream(4 * 1024 * 1024)
+        decoder = MilterDecoder()
+        maxBuffered = 0
+        for i in range(0, len(data), 1000):
+            decoder.feed(data[i:i + 1000])
+            for _ in decoder.decode():
+                pass
+            maxBuffered = max(maxBuffered, len(decoder._buf))
+        self.assertTrue(maxBuffered <= (MilterDecoder.compactThreshold
+                                        + 2 * constants.MILTER_CHUNK_SIZE
+                                        + 1000), maxBuffered)
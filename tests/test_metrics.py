@@ -0,0 +1,145 @@
+import unittest
+
+from twisted.internet import defer
+from twisted.trial import unittest as trial
+from twisted.test import proto_helpers
+from twisted.web.test.requesthelper import DummyRequest
+
+from txmilter import MilterFactory
+from txmilter import MilterProtocol
+from txmilter.metrics import Instrumentation
+from txmilter.metrics import MetricsInstrumentation
+from txmilter.metrics import MetricsRegistry
+from txmilter.metrics import MetricsResource
+from txmilter.protocol import ACCEPT, CONTINUE
+
+
+class RecordingInstrumentation(Instrumentation):
+    def __init__(self):
+        self.events = []
+
+    def sessionStarted(self, proto):
+        self.events.append(('started',))
+
+    def sessionEnded(self, proto):
+        self.events.append(('ended',))
+
+    def callbackStarted(self, proto, cmd, queueWait):
+        self.events.append(('callback', cmd))
+
+    def callbackFinished(self, proto, cmd, duration, failed):
+        self.events.append(('finished', cmd, failed))
+
+    def replySent(self, proto, cmd, reply):
+        self.events.append(('reply', cmd, reply.cmd))
+
+
+class SlowMilter(MilterProtocol):
+    def onHelo(self, helo):
+        if helo == b'fail':
+            raise ValueError(helo)
+        self.pending = defer.Deferred()
+        return self.pending
+
+    def onEom(self):
+        return ACCEPT
+
+
+class InstrumentationTest(trial.TestCase):
+    def connect(self, instrumentation):
+        factory = MilterFactory(instrumentation=instrumentation)
+        factory.protocol = SlowMilter
+        proto = factory.buildProtocol(None)
+        transport = proto_helpers.StringTransport()
+        proto.makeConnection(transport)
+        return proto, transport
+
+    def test_hooks(self):
+        instr = RecordingInstrumentation()
+        proto, transport = self.connect(instr)
+
+        proto.dataReceived(b'\x00\x00\x00\x06Hhelo\x00'
+                           b'\x00\x00\x00\x01E')
+        self.assertEquals(instr.events, [('started',),
+                                         ('callback', 'SMFIC_HELO')])
+        proto.pending.callback(CONTINUE)
+        proto.connectionLost(None)
+        self.assertEquals(instr.events,
+                          [('started',), ('callback', 'SMFIC_HELO'),
+                           ('finished', 'SMFIC_HELO', False),
+                           ('reply', 'SMFIC_HELO', 'SMFIR_CONTINUE'),
+                           ('callback', 'SMFIC_BODYEOB'),
+                           ('finished', 'SMFIC_BODYEOB', False),
+                           ('reply', 'SMFIC_BODYEOB', 'SMFIR_ACCEPT'),
+                           ('ended',)])
+
+    def test_failed_callback(self):
+        instr = RecordingInstrumentation()
+        proto, transport = self.connect(instr)
+
+        proto.dataReceived(b'\x00\x00\x00\x06Hfail\x00')
+        self.assertEquals(instr.events[-2:],
+                          [('finished', 'SMFIC_HELO', True),
+                           ('reply', 'SMFIC_HELO', 'SMFIR_TEMPFAIL')])
+        self.assertEquals(len(self.flushLoggedErrors(ValueError)), 1)
+
+    def test_metrics(self):
+        registry = MetricsRegistry()
+        proto, transport = self.connect(MetricsInstrumentation(registry))
+
+        proto.dataReceived(b'\x00\x00\x00\x06Hhelo\x00'
+                           b'\x00\x00\x00\x01E')
+        instr = proto.factory.instrumentation
+        self.assertEquals(instr.activeSessions.get(), 1)
+        self.assertEquals(instr.inFlight.get(), 1)
+        self.assertEquals(instr.received.get(), 15)
+        self.assertEquals(instr.decode.count(), 2)
+        proto.pending.callback(CONTINUE)
+        proto.connectionLost(None)
+
+        self.assertEquals(instr.sessions.get(), 1)
+        self.assertEquals(instr.activeSessions.get(), 0)
+        self.assertEquals(instr.inFlight.get(), 0)
+        self.assertEquals(instr.sent.get(), len(transport.value()))
+        self.assertEquals(instr.callbacks.count(('SMFIC_HELO',)), 1)
+        self.assertEquals(instr.queueWait.count(('SMFIC_BODYEOB',)), 1)
+        self.assertEquals(instr.replies.get(('SMFIC_BODYEOB',
+                                             'SMFIR_ACCEPT')), 1)
+
+
+class MetricsRegistryTest(unittest.TestCase):
+    def test_exposition(self):
+        registry = MetricsRegistry()
+        registry.counter('requests_total', 'Requests', ['code']).inc(
+                2, ('a"b',))
+        hist = registry.histogram('latency_seconds', 'Latency',
+                                  buckets=(0.1, 1))
+        hist.observe(0.05)
+        hist.observe(0.5)
+        hist.observe(2)
+
+        self.assertEquals(registry.exposition(), '\n'.join([
+            '# HELP latency_seconds Latency',
+            '# TYPE latency_seconds histogram',
+            'latency_seconds_bucket{le="0.1"} 1',
+            'latency_seconds_bucket{le="1"} 2',
+            'latency_seconds_bucket{le="+Inf"} 3',
+            'latency_seconds_sum 2.55',
+            'latency_seconds_count 3',
+            '# HELP requests_total Requests',
+            '# TYPE requests_total counter',
+            'requests_total{code="a\\"b"} 2',
+        ]) + '\n')
+
+    def test_metrics_are_registered_once(self):
+        registry = MetricsRegistry()
+        counter = registry.counter('c', 'C')
+        self.assertIs(registry.counter('c', 'C'), counter)
+        self.assertRaises(ValueError, registry.gauge, 'c', 'C')
+
+    def test_resource(self):
+        registry = MetricsRegistry()
+        registry.gauge('g', 'G').set(3)
+        request = DummyRequest([b''])
+        body = MetricsResource(registry).render_GET(request)
+        self.assertEquals(body, b'# HELP g G\n# TYPE g gauge\ng 3\n')
@@ -0,0 +1,113 @@
+import threading
+
+from twisted.internet import defer
+from twisted.test import proto_helpers
+from twisted.trial import unittest
+
+from txmilter import MilterFactory
+from txmilter import MilterProtocol
+from txmilter.offload import PoolFull
+from txmilter.offload import ProcessOffloadPool
+from txmilter.offload import ThreadOffloadPool
+from txmilter.offload import offload
+from txmilter.protocol import ACCEPT, CONTINUE, TEMPFAIL
+
+try:
+    from concurrent import futures
+except ImportError:
+    futures = None
+
+
+pool = ThreadOffloadPool(size=1, maxQueue=0)
+
+
+class OffloadedMilter(MilterProtocol):
+    def connectionMade(self):
+        MilterProtocol.connectionMade(self)
+        self.threads = []
+        self.release = threading.Event()
+
+    @offload(pool)
+    def onHelo(self, helo):
+        self.threads.append(threading.current_thread())
+        self.release.wait(10)
+        return CONTINUE
+
+    @offload(pool)
+    def onEom(self):
+        self.addHeader(b'X-Scanned', b'yes')
+        return ACCEPT
+
+
+class OffloadTest(unittest.TestCase):
+    def setUp(self):
+        self.factory = MilterFactory()
+        self.factory.protocol = OffloadedMilter
+        self.protos = []
+
+    def tearDown(self):
+        for proto in self.protos:
+            proto.release.set()
+        return self.flush()
+
+    def connect(self):
+        proto = self.factory.buildProtocol(None)
+        proto.makeConnection(proto_helpers.StringTransport())
+        self.protos.append(proto)
+        return proto
+
+    def flush(self):
+        # wait for the replies of all the handlers
+        return defer.gatherResults([proto.whenIdle()
+                                    for proto in self.protos])
+
+    @defer.inlineCallbacks
+    def test_handlers_run_in_the_pool(self):
+        proto = self.connect()
+        proto.release.set()
+        proto.dataReceived(b'\x00\x00\x00\x04Hme\x00')
+        yield self.flush()
+        self.assertEquals(len(proto.threads), 1)
+        self.assertNotEqual(proto.threads[0], threading.current_thread())
+        self.assertEquals(proto.transport.value(), CONTINUE.wire)
+
+    @defer.inlineCallbacks
+    def test_modifications_are_sent_before_the_reply(self):
+        proto = self.connect()
+        proto.dataReceived(b'\x00\x00\x00\x01E')
+        yield self.flush()
+        self.assertEquals(proto.transport.value(),
+                          b'\x00\x00\x00\x0fhX-Scanned\x00yes\x00'
+                          + ACCEPT.wire)
+
+    @defer.inlineCallbacks
+    def test_full_pool_falls_back(self):
+        busy = self.connect()
+        busy.dataReceived(b'\x00\x00\x00\x04Hme\x00')
+        self.assertEquals(pool.pending, 1)
+        self.assertTrue(pool.full)
+
+        proto = self.connect()
+        proto.dataReceived(b'\x00\x00\x00\x04Hme\x00')
+        self.assertEquals(proto.transport.value(), TEMPFAIL.wire)
+        self.assertEquals(pool.rejected, 1)
+
+        busy.release.set()
+        yield self.flush()
+        self.assertEquals(busy.transport.value(), CONTINUE.wire)
+        self.assertEquals(pool.pending, 0)
+
+
+class ProcessOffloadTest(unittest.TestCase):
+    if not futures:
+        skip = 'concurrent.futures is not available'
+
+    @defer.inlineCallbacks
+    def test_submit(self):
+        processes = ProcessOffloadPool(size=1, maxQueue=0)
+        self.addCleanup(processes.stop)
+        d = processes.submit(pow, 2, 10)
+        yield self.assertFailure(processes.submit(pow, 2, 1), PoolFull)
+        result = yield d
+        self.assertEquals(result, 1024)
+        self.assertEquals(processes.pending, 0)
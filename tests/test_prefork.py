@@ -0,0 +1,153 @@
+import io
+import json
+import os
+
+from twisted.internet import defer, endpoints, reactor, task
+from twisted.python import log
+from twisted.test import proto_helpers
+from twisted.trial import unittest
+
+from txmilter import MilterFactory
+from txmilter import MilterProtocol
+from txmilter import message
+from txmilter.client import MilterClientProtocol
+from txmilter.metrics import MetricsInstrumentation
+from txmilter.metrics import MetricsRegistry
+from txmilter.prefork import Master
+from txmilter.prefork import Worker
+from txmilter.protocol import ACCEPT
+from txmilter.protocol import REJECT
+
+
+class PidMilter(MilterProtocol):
+    def onHelo(self, helo):
+        return REJECT
+
+    def onEom(self):
+        self.addHeader(b'X-Pid', str(os.getpid()).encode('ascii'))
+        return ACCEPT
+
+
+def makeFactory():
+    factory = MilterFactory(
+            instrumentation=MetricsInstrumentation(MetricsRegistry()))
+    factory.protocol = PidMilter
+    return factory
+
+
+class WorkerTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.out = io.StringIO() if str is not bytes else io.BytesIO()
+
+    def connect(self, worker):
+        proto = worker.factory.buildProtocol(None)
+        transport = proto_helpers.StringTransport()
+        proto.makeConnection(transport)
+        return proto
+
+    def test_recycling(self):
+        worker = Worker(makeFactory(), maxSessions=2, out=self.out,
+                        reactor=self.clock)
+        p1 = self.connect(worker)
+        self.assertFalse(worker.retiring)
+        p2 = self.connect(worker)
+        self.assertTrue(worker.retiring)
+
+        p1.connectionLost(None)
+        self.assertFalse(worker.done.called)
+        p2.connectionLost(None)
+        self.assertEquals(self.successResultOf(worker.done), 2)
+
+        report = json.loads(self.out.getvalue())
+        self.assertEquals(report['sessions'], 2)
+        registry = MetricsRegistry()
+        registry.merge(report['metrics'])
+        self.assertEquals(
+                registry.counter('txmilter_sessions_total', '').get(), 2)
+
+    def test_drain_timeout(self):
+        worker = Worker(makeFactory(), drainTimeout=10, reactor=self.clock)
+        proto = self.connect(worker)
+        worker.retire()
+        self.clock.advance(9)
+        self.assertFalse(worker.done.called)
+        self.clock.advance(1)
+        self.assertTrue(proto.transport.disconnecting)
+        self.assertEquals(self.successResultOf(worker.done), 1)
+
+    def test_periodic_reports(self):
+        worker = Worker(makeFactory(), metricsInterval=5, out=self.out,
+                        reactor=self.clock)
+        self.clock.advance(5)
+        self.clock.advance(5)
+        self.assertEquals(len(self.out.getvalue().splitlines()), 2)
+        worker.retire()
+        self.assertEquals(len(self.out.getvalue().splitlines()), 3)
+
+
+class MergeTest(unittest.TestCase):
+    def test_merge(self):
+        r1 = MetricsRegistry()
+        r1.counter('c', 'C', ['l']).inc(2, ('a',))
+        r1.gauge('g', 'G').set(1)
+        r1.histogram('h', 'H', buckets=(1,)).observe(0.5)
+        r2 = MetricsRegistry()
+        r2.counter('c', 'C', ['l']).inc(3, ('a',))
+        r2.histogram('h', 'H', buckets=(1,)).observe(2)
+
+        total = MetricsRegistry()
+        total.merge(json.loads(json.dumps(r1.snapshot())), gauges=False)
+        total.merge(r2.snapshot())
+        self.assertEquals(total.counter('c', 'C').get(('a',)), 5)
+        self.assertNotIn('g', total.metrics)
+        self.assertEquals(total.metrics['h'].values[()], [1, 1, 2.5])
+
+
+class MasterTest(unittest.TestCase):
+    timeout = 60
+
+    @defer.inlineCallbacks
+    def session(self, port):
+        endpoint = endpoints.TCP4ClientEndpoint(reactor, '127.0.0.1', port)
+        client = yield endpoints.connectProtocol(endpoint,
+                                                 MilterClientProtocol())
+        reply = yield client.send(message.Helo(b'me'))
+        yield client.send(message.BodyEob())
+        client.transport.loseConnection()
+        defer.returnValue((reply, client.modifications[0].value))
+
+    @defer.inlineCallbacks
+    def test_workers(self):
+        master = Master('tests.test_prefork.makeFactory', 'tcp:0:127.0.0.1',
+                        workers=2, maxSessions=1, drainTimeout=1,
+                        metricsInterval=0.1)
+        master.respawnDelay = 0
+        exited = defer.Deferred()
+
+        def observe(event):
+            text = ''.join(event.get('message', ()))
+            if 'exited after' in text and not exited.called:
+                exited.callback(text)
+        log.addObserver(observe)
+        self.addCleanup(log.removeObserver, observe)
+        master.start()
+        self.addCleanup(master.stop)
+        port = master.socket.getsockname()[1]
+
+        pids = set()
+        for _ in range(4):
+            reply, pid = yield self.session(port)
+            self.assertEquals(reply, REJECT)
+            pids.add(pid)
+        # each worker served a single session before being replaced
+        self.assertEquals(len(pids), 4)
+        text = yield exited
+        self.assertIn(int(text.split()[1]), [int(pid) for pid in pids])
+
+        yield master.stop()
+        self.assertEquals(master.workers, set())
+        self.assertIsNone(master.socket)
+        registry = master.registry()
+        self.assertEquals(
+                registry.counter('txmilter_sessions_total', '').get(), 4)
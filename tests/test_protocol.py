@@ -0,0 +1,432 @@
+import io
+import struct
+import unittest
+
+from twisted.internet import defer, task
+from twisted.test import proto_helpers
+from twisted.trial import unittest as trial
+
+from txmilter import MilterFactory
+from txmilter import MilterProtocol
+from txmilter import constants
+from txmilter.codec import MilterCodecError
+from txmilter.codec import MilterDecoder
+from txmilter.message import AddHeader, ChgFrom, ChgHeader, Optneg
+from txmilter.message import OptnegSymlist
+from txmilter.protocol import CONTINUE, ACCEPT, PROGRESS, REJECT, SKIP
+from txmilter.protocol import TEMPFAIL
+from txmilter.protocol import noreply
+
+
+class RecordingProtocol(MilterProtocol):
+    def connectionMade(self):
+        MilterProtocol.connectionMade(self)
+        self.calls = []
+        self.pending = {}
+        # called with the protocol at eom, to request modifications
+        self.modify = None
+        self.eomVerdict = ACCEPT
+
+    def onHelo(self, helo):
+        self.calls.append(('helo', helo))
+        return CONTINUE
+
+    def onHeader(self, name, value):
+        self.calls.append(('header', name))
+        if name == b'slow':
+            d = self.pending[name] = defer.Deferred()
+            return d
+        return CONTINUE
+
+    def onEom(self):
+        self.calls.append(('eom',))
+        if self.modify is not None:
+            self.modify(self)
+        return self.eomVerdict
+
+
+class NoReplyProtocol(MilterProtocol):
+    @noreply
+    def onHeader(self, name, value):
+        return CONTINUE
+
+    def onBody(self, buf):
+        return SKIP
+
+
+class SlowEomProtocol(MilterProtocol):
+    progressInterval = 10
+    callbackDeadline = 25
+
+    def onEom(self):
+        self.addHeader(b'a', b'b')
+        self.pending = defer.Deferred()
+        return self.pending
+
+
+class MacroProtocol(MilterProtocol):
+    symbolList = {constants.SMFIM_CONNECT: ['j', 'client_addr']}
+
+    def onRcpt(self, args):
+        self.seen = (self.getsymval('i'), self.getsymval('{rcpt_addr}'),
+                     self.getsymval('client_addr'))
+        return CONTINUE
+
+
+class FailingProtocol(MilterProtocol):
+    def onHelo(self, helo):
+        return 1 / 0
+
+
+ALL_PROTOCOLS = 2**21 - 1
+
+
+class MilterProtocolTest(unittest.TestCase):
+    def setUp(self):
+        self.factory = MilterFactory()
+        self.factory.protocol = RecordingProtocol
+
+    def connect(self):
+        proto = self.factory.buildProtocol(None)
+        transport = proto_helpers.StringTransport()
+        proto.makeConnection(transport)
+        return proto, transport
+
+    def test_connections_have_their_own_decoder(self):
+        p1, t1 = self.connect()
+        p2, t2 = self.connect()
+
+        p1.dataReceived(b'\x00\x00\x00\x06Hon')
+        p2.dataReceived(b'\x00\x00\x00\x06Hth')
+        p1.dataReceived(b'e1\x00')
+        p2.dataReceived(b'e2\x00')
+
+        self.assertEquals(p1.calls, [('helo', b'one1')])
+        self.assertEquals(p2.calls, [('helo', b'the2')])
+        self.assertEquals(t1.value(), b'\x00\x00\x00\x01c')
+        self.assertEquals(t2.value(), b'\x00\x00\x00\x01c')
+
+    def test_replies_are_sent_in_command_order(self):
+        proto, transport = self.connect()
+
+        proto.dataReceived(b'\x00\x00\x00\x08Lslow\x00a\x00'
+                           b'\x00\x00\x00\x08Lfast\x00b\x00')
+        # the second handler already ran but its reply waits for the first
+        self.assertEquals(proto.calls, [('header', b'slow'),
+                                        ('header', b'fast')])
+        self.assertEquals(transport.value(), b'')
+
+        proto.pending[b'slow'].callback(ACCEPT)
+        self.assertEquals(transport.value(),
+                          b'\x00\x00\x00\x01a\x00\x00\x00\x01c')
+
+    def test_no_reply_to_macro_abort_and_quit(self):
+        proto, transport = self.connect()
+        proto.dataReceived(b'\x00\x00\x00\x07DMi\x00Q1\x00'
+                           b'\x00\x00\x00\x01A'
+                           b'\x00\x00\x00\x01Q')
+        self.assertEquals(transport.value(), b'')
+
+    def test_when_idle(self):
+        proto, transport = self.connect()
+        idle = []
+        proto.whenIdle().addCallback(idle.append)
+        self.assertEquals(idle, [None])
+
+        proto.dataReceived(b'\x00\x00\x00\x08Lslow\x00a\x00'
+                           b'\x00\x00\x00\x01E')
+        proto.whenIdle().addCallback(idle.append)
+        self.assertEquals(idle, [None])
+        proto.pending[b'slow'].callback(CONTINUE)
+        # the barrier command was handled too
+        self.assertEquals(idle, [None, None])
+        self.assertEquals(proto.calls[-1], ('eom',))
+
+    def test_barrier_waits_for_previous_replies(self):
+        proto, transport = self.connect()
+
+        proto.dataReceived(b'\x00\x00\x00\x08Lslow\x00a\x00'
+                           b'\x00\x00\x00\x01E'
+                           b'\x00\x00\x00\x04Hme\x00')
+        self.assertEquals(proto.calls, [('header', b'slow')])
+
+        proto.pending[b'slow'].callback(CONTINUE)
+        self.assertEquals(proto.calls, [('header', b'slow'), ('eom',),
+                                        ('helo', b'me')])
+        self.assertEquals(transport.value(),
+                          b'\x00\x00\x00\x01c\x00\x00\x00\x01a'
+                          b'\x00\x00\x00\x01c')
+
+    def test_constant_replies_are_not_encoded(self):
+        proto, transport = self.connect()
+        self.factory.encoder = None
+
+        proto.dataReceived(b'\x00\x00\x00\x04Hme\x00')
+        self.assertEquals(transport.value(), CONTINUE.wire)
+
+    def negotiate(self, proto, transport, protocols=ALL_PROTOCOLS):
+        proto.dataReceived(b'\x00\x00\x00\x0dO\x00\x00\x00\x06'
+                           b'\x00\x00\x00\x3f'
+                           + struct.pack('!I', protocols))
+        reply = next(MilterDecoder().feed(transport.value()).decode())
+        transport.clear()
+        return reply
+
+    def test_protocol_mask(self):
+        self.factory.protocol = NoReplyProtocol
+        proto, _ = self.connect()
+        mask = proto.protocol_mask()
+
+        self.assertTrue(mask & constants.SMFIP_NR_HDR)
+        self.assertFalse(mask & constants.SMFIP_NOHDRS)
+        self.assertFalse(mask & constants.SMFIP_NOBODY)
+        self.assertTrue(mask & constants.SMFIP_SKIP)
+        self.assertTrue(mask & constants.SMFIP_NOCONNECT)
+        self.assertTrue(mask & constants.SMFIP_NOHELO)
+
+    def test_optneg_requests_protocol_mask(self):
+        self.factory.protocol = NoReplyProtocol
+        proto, transport = self.connect()
+
+        reply = self.negotiate(proto, transport)
+        self.assertEquals(reply, Optneg(6, 0, proto.protocol_mask()))
+
+        proto, transport = self.connect()
+        reply = self.negotiate(proto, transport, protocols=0)
+        self.assertEquals(reply, Optneg(6, 0, 0))
+
+    def test_no_reply_negotiated(self):
+        self.factory.protocol = NoReplyProtocol
+        proto, transport = self.connect()
+        self.negotiate(proto, transport)
+
+        proto.dataReceived(b'\x00\x00\x00\x07Lto\x00me\x00'
+                           b'\x00\x00\x00\x02Bx')
+        self.assertEquals(transport.value(), SKIP.wire)
+
+    def test_no_reply_not_negotiated(self):
+        self.factory.protocol = NoReplyProtocol
+        proto, transport = self.connect()
+        self.negotiate(proto, transport,
+                       protocols=ALL_PROTOCOLS & ~(constants.SMFIP_NR_HDR
+                                                   | constants.SMFIP_SKIP))
+
+        proto.dataReceived(b'\x00\x00\x00\x07Lto\x00me\x00'
+                           b'\x00\x00\x00\x02Bx')
+        # without SMFIP_SKIP the body reply falls back to continue
+        self.assertEquals(transport.value(), CONTINUE.wire + CONTINUE.wire)
+
+    def test_replace_body(self):
+        proto, transport = self.connect()
+        proto.modify = lambda proto: proto.replaceBody(b'x' * 70000)
+        proto.dataReceived(b'\x00\x00\x00\x01E')
+
+        frames = list(MilterDecoder().feed(transport.value()).decode())
+        self.assertEquals([len(f.buf) for f in frames[:-1]], [65535, 4465])
+        self.assertEquals(frames[-1], ACCEPT)
+
+    def test_replace_body_from_a_file(self):
+        body = io.BytesIO(b'x' * 70000)
+        proto, transport = self.connect()
+        writes = []
+        transport.writeSequence = writes.append
+        proto.modify = lambda proto: proto.replaceBody(body)
+        proto.eomVerdict = defer.Deferred()
+        proto.dataReceived(b'\x00\x00\x00\x01E')
+        # the file is only read when the reply is sent
+        self.assertEquals(body.tell(), 0)
+        proto.eomVerdict.callback(ACCEPT)
+
+        # a chunk at a time
+        self.assertEquals(len(writes), 3)
+        frames = list(MilterDecoder().feed(
+                b''.join(b''.join(seq) for seq in writes)).decode())
+        self.assertEquals([len(f.buf) for f in frames[:-1]], [65535, 4465])
+        self.assertEquals(frames[-1], ACCEPT)
+
+    def test_progress_keepalives(self):
+        self.factory.protocol = SlowEomProtocol
+        proto, transport = self.connect()
+        proto.clock = task.Clock()
+        proto.dataReceived(b'\x00\x00\x00\x01E')
+        transport.clear()
+
+        proto.clock.advance(10)
+        proto.clock.advance(10)
+        proto.pending.callback(ACCEPT)
+        proto.clock.advance(10)
+        # the modifications are sent with the verdict
+        self.assertEquals(transport.value(),
+                          PROGRESS.wire + PROGRESS.wire
+                          + b'\x00\x00\x00\x05ha\x00b\x00' + ACCEPT.wire)
+        self.assertEquals(proto.clock.getDelayedCalls(), [])
+
+    def test_callback_deadline(self):
+        self.factory.protocol = SlowEomProtocol
+        proto, transport = self.connect()
+        proto.clock = task.Clock()
+        proto.dataReceived(b'\x00\x00\x00\x01E')
+        transport.clear()
+
+        proto.clock.pump([10, 10, 5])
+        self.assertEquals(transport.value(),
+                          PROGRESS.wire + PROGRESS.wire + TEMPFAIL.wire)
+        self.assertEquals(proto.clock.getDelayedCalls(), [])
+        # the late result and modifications are dropped
+        proto.addHeader(b'c', b'd')
+        proto.pending.callback(ACCEPT)
+        self.assertEquals(transport.value(),
+                          PROGRESS.wire + PROGRESS.wire + TEMPFAIL.wire)
+
+    def test_expired_handler_does_not_drop_later_modifications(self):
+        self.factory.protocol = type('SlowRcpt', (SlowEomProtocol,), {
+                'onRcpt': lambda self, args: defer.Deferred()})
+        proto, transport = self.connect()
+        proto.clock = task.Clock()
+        proto.dataReceived(b'\x00\x00\x00\x03Ra\x00')
+        proto.clock.advance(25)
+        self.assertEquals(transport.value(), TEMPFAIL.wire)
+        transport.clear()
+
+        # onRcpt is still running, but onEom can modify the message
+        proto.dataReceived(b'\x00\x00\x00\x01E')
+        proto.pending.callback(ACCEPT)
+        self.assertEquals(transport.value(),
+                          b'\x00\x00\x00\x05ha\x00b\x00' + ACCEPT.wire)
+
+    def test_macros(self):
+        self.factory.protocol = MacroProtocol
+        proto, transport = self.connect()
+        proto.dataReceived(b'\x00\x00\x00\x18DC{client_addr}\x001.2.3.4\x00'
+                           b'\x00\x00\x00\x07DMi\x00Q1\x00'
+                           b'\x00\x00\x00\x10DR{rcpt_addr}\x00a\x00'
+                           b'\x00\x00\x00\x03Ra\x00')
+        self.assertEquals(proto.seen, (b'Q1', b'a', b'1.2.3.4'))
+        self.assertEquals(transport.value(), CONTINUE.wire)
+
+        # the macros of the message are forgotten on abort, whatever
+        # command they were sent for
+        proto.dataReceived(b'\x00\x00\x00\x07DLx\x00hd\x00'
+                           b'\x00\x00\x00\x07DUu\x00un\x00')
+        self.assertEquals(proto.getsymval('x'), b'hd')
+        proto.dataReceived(b'\x00\x00\x00\x01A')
+        self.assertEquals(proto.getsymval('i'), None)
+        self.assertEquals(proto.getsymval('x'), None)
+        self.assertEquals(proto.getsymval('u'), None)
+        self.assertEquals(proto.getsymval('{client_addr}'), b'1.2.3.4')
+        # and the ones of the following stages on new macros
+        proto.dataReceived(b'\x00\x00\x00\x09DC{j}\x00mx\x00')
+        self.assertEquals(len(proto.macros), 1)
+
+    def test_optneg_symbol_lists(self):
+        self.factory.protocol = MacroProtocol
+        proto, transport = self.connect()
+        proto.setsymlist(constants.SMFIM_ENVRCPT, [b'{rcpt_addr}'])
+        proto.dataReceived(struct.pack('!IcIII', 13, b'O', 6,
+                                       constants.SMFIF_SETSYMLIST,
+                                       ALL_PROTOCOLS))
+        reply = next(MilterDecoder().feed(transport.value()).decode())
+        self.assertEquals(reply, OptnegSymlist(
+                6, constants.SMFIF_SETSYMLIST, reply.protocol,
+                {constants.SMFIM_CONNECT: [b'j', b'{client_addr}'],
+                 constants.SMFIM_ENVRCPT: [b'{rcpt_addr}']}))
+        # the macros of the skipped stages are still wanted
+        self.assertFalse(reply.protocol & constants.SMFIP_NOCONNECT)
+
+    def test_optneg_instance_symbol_lists(self):
+        proto, transport = self.connect()
+        proto.setsymlist(constants.SMFIM_CONNECT, [b'{client_addr}'])
+        reply = self.negotiate(proto, transport)
+        # the connect macros are sent, without waiting for a reply
+        self.assertFalse(reply.protocol & constants.SMFIP_NOCONNECT)
+        self.assertTrue(reply.protocol & constants.SMFIP_NR_CONN)
+
+        proto, transport = self.connect()
+        reply = self.negotiate(proto, transport)
+        self.assertTrue(reply.protocol & constants.SMFIP_NOCONNECT)
+
+    def test_modifications_are_batched(self):
+        self.factory.actions = (constants.SMFIF_ADDHDRS
+                                | constants.SMFIF_CHGHDRS
+                                | constants.SMFIF_ADDRCPT)
+        proto, transport = self.connect()
+        proto.dataReceived(struct.pack('!IcIII', 13, b'O', 6,
+                                       constants.SMFIF_ADDHDRS
+                                       | constants.SMFIF_CHGHDRS,
+                                       ALL_PROTOCOLS))
+        transport.clear()
+        writes = []
+        transport.writeSequence = writes.append
+
+        def modify(proto):
+            proto.chgHeader(1, b'Subject', b'a')
+            proto.addHeader(b'X-A', b'1')
+            proto.addRcpt(b'<x@y>')
+            proto.chgHeader(1, b'subject', b'b')
+        proto.modify = modify
+        proto.dataReceived(b'\x00\x00\x00\x01E')
+
+        self.assertEquals(len(writes), 1)
+        frames = list(MilterDecoder().feed(b''.join(writes[0])).decode())
+        # the recipient action was not negotiated, and the first header
+        # change is overridden by the second one
+        self.assertEquals(frames, [AddHeader(b'X-A', b'1'),
+                                   ChgHeader(1, b'subject', b'b'), ACCEPT])
+
+    def test_rejected_message_modifications_are_dropped(self):
+        proto, transport = self.connect()
+        proto.modify = lambda proto: proto.addHeader(b'X-A', b'1')
+        proto.eomVerdict = REJECT
+        proto.dataReceived(b'\x00\x00\x00\x01E')
+        self.assertEquals(transport.value(), REJECT.wire)
+
+    def test_chgfrom_without_esmtp_arguments(self):
+        proto, transport = self.connect()
+        proto.modify = lambda proto: proto.chgfrom(b'<x@y>')
+        proto.dataReceived(b'\x00\x00\x00\x01E')
+        self.assertEquals(transport.value(),
+                          b'\x00\x00\x00\x07e<x@y>\x00' + ACCEPT.wire)
+        frames = list(MilterDecoder().feed(transport.value()).decode())
+        self.assertEquals(frames, [ChgFrom(b'<x@y>', None), ACCEPT])
+
+    def test_invalid_modifications_raise_in_the_caller(self):
+        proto, transport = self.connect()
+        errors = []
+
+        def modify(proto):
+            try:
+                proto.addHeader(b'X-A', None)
+            except MilterCodecError as e:
+                errors.append(e)
+        proto.modify = modify
+        proto.dataReceived(b'\x00\x00\x00\x01E')
+        self.assertEquals(len(errors), 1)
+        self.assertEquals(transport.value(), ACCEPT.wire)
+
+    def test_modifications_outside_eom_are_dropped(self):
+        proto, transport = self.connect()
+        proto.addHeader(b'X-A', b'1')
+        proto.dataReceived(b'\x00\x00\x00\x07Lto\x00me\x00')
+        self.assertEquals(transport.value(), CONTINUE.wire)
+        proto.dataReceived(b'\x00\x00\x00\x01E')
+        self.assertEquals(transport.value(), CONTINUE.wire + ACCEPT.wire)
+
+
+class HandlerFailureTest(trial.TestCase):
+    def setUp(self):
+        self.factory = MilterFactory()
+        self.factory.protocol = FailingProtocol
+
+    def test_failing_handler_replies_failure_verdict(self):
+        proto = self.factory.buildProtocol(None)
+        transport = proto_helpers.StringTransport()
+        proto.makeConnection(transport)
+        proto.dataReceived(b'\x00\x00\x00\x04Hme\x00')
+        self.assertEquals(transport.value(), TEMPFAIL.wire)
+        self.assertEquals(len(self.flushLoggedErrors(ZeroDivisionError)), 1)
+
+        transport.clear()
+        proto.failureVerdict = REJECT
+        proto.dataReceived(b'\x00\x00\x00\x04Hme\x00')
+        self.assertEquals(transport.value(), REJECT.wire)
+        self.assertEquals(len(self.flushLoggedErrors(ZeroDivisionError)), 1)
@@ -0,0 +1,212 @@
+from twisted.internet import defer, error, task
+from twisted.python.failure import Failure
+from twisted.test import proto_helpers
+from twisted.trial import unittest
+
+from txmilter import MilterFactory
+from txmilter import MilterProtocol
+from txmilter import constants
+from txmilter import message
+from txmilter.codec import MilterDecoder
+from txmilter.codec import MilterEncoder
+from txmilter.protocol import ACCEPT, CONTINUE, PROGRESS, REJECT, TEMPFAIL
+from txmilter.proxy import MilterClientPool
+from txmilter.proxy import MilterProxyFactory
+from txmilter.proxy import NoBackendAvailable
+
+
+encode = MilterEncoder().encode
+
+OPTNEG = encode(message.Optneg(6, 2**9 - 1, 2**21 - 1))
+CONNECT = encode(message.Connect(b'mx', constants.ProtocolFamily.SMFIA_INET,
+                                 25, b'10.0.0.1'))
+MAIL = encode(message.Mail([b'<a@b>']))
+SLOW_MAIL = encode(message.Mail([b'<slow@b>']))
+MACRO = encode(message.Macro(b'M', [b'i', b'Q1']))
+HEADER = encode(message.Header(b'X-Reject', b'yes'))
+EOM = encode(message.BodyEob())
+QUIT = encode(message.Quit())
+
+
+class Upstream(MilterProtocol):
+    def onConnect(self, hostname, family, port, address):
+        self.factory.sessions.append(address)
+        return CONTINUE
+
+    def onMail(self, args):
+        if args[0] == b'<slow@b>':
+            self.pending = defer.Deferred()
+            return self.pending
+        return CONTINUE
+
+    def onHeader(self, name, value):
+        if name == b'X-Reject':
+            return REJECT
+        return CONTINUE
+
+    def onEom(self):
+        self.addHeader(b'X-Scanned', b'yes')
+        return ACCEPT
+
+
+class Pipe(proto_helpers.StringTransport):
+    # in memory transport writing to the protocol at the other end
+
+    peer = None
+
+    def write(self, data):
+        self.peer.protocol.dataReceived(data)
+
+    def writeSequence(self, seq):
+        self.write(b''.join(seq))
+
+    def loseConnection(self):
+        if self.disconnecting:
+            return
+        self.disconnecting = self.peer.disconnecting = True
+        for transport in (self, self.peer):
+            transport.protocol.connectionLost(
+                    Failure(error.ConnectionDone()))
+
+
+class PipeEndpoint(object):
+    def __init__(self):
+        self.factory = MilterFactory(actions=constants.SMFIF_ADDHDRS)
+        self.factory.protocol = Upstream
+        self.factory.sessions = []
+        self.down = False
+        self.connections = []
+
+    def connect(self, factory):
+        if self.down:
+            return defer.fail(error.ConnectionRefusedError())
+        client = factory.buildProtocol(None)
+        server = self.factory.buildProtocol(None)
+        clientTransport, serverTransport = Pipe(), Pipe()
+        clientTransport.peer = serverTransport
+        serverTransport.peer = clientTransport
+        clientTransport.protocol = client
+        serverTransport.protocol = server
+        server.makeConnection(serverTransport)
+        client.makeConnection(clientTransport)
+        self.connections.append(server)
+        return defer.succeed(client)
+
+
+class ProxyTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.endpoints = [PipeEndpoint(), PipeEndpoint()]
+        self.pool = MilterClientPool(self.endpoints, clock=self.clock)
+        self.factory = MilterProxyFactory(self.pool)
+
+    def connect(self):
+        proto = self.factory.buildProtocol(None)
+        proto.makeConnection(proto_helpers.StringTransport())
+        return proto
+
+    def replies(self, proto):
+        value = proto.transport.value()
+        proto.transport.clear()
+        return list(MilterDecoder().feed(value).decode())
+
+    def test_session_is_forwarded(self):
+        proto = self.connect()
+        proto.dataReceived(OPTNEG + CONNECT + MAIL + EOM)
+        optneg, connect, mail, addHeader, eom = self.replies(proto)
+        # the upstream milter only wants connect, mail, header and eom
+        self.assertEquals(optneg.actions, constants.SMFIF_ADDHDRS)
+        self.assertTrue(optneg.protocol & constants.SMFIP_NOHELO
+                        or optneg.protocol & constants.SMFIP_NR_HELO)
+        self.assertEquals([connect, mail, eom], [CONTINUE, CONTINUE, ACCEPT])
+        self.assertEquals(addHeader,
+                          message.AddHeader(b'X-Scanned', b'yes'))
+
+        proto.dataReceived(MAIL + HEADER)
+        self.assertEquals(self.replies(proto)[-1], REJECT)
+
+    def test_connections_are_reused(self):
+        for _ in range(3):
+            proto = self.connect()
+            proto.dataReceived(OPTNEG + CONNECT + QUIT)
+            proto.connectionLost(Failure(error.ConnectionDone()))
+        self.assertEquals(self.pool.connections, 1)
+        self.assertEquals(self.pool.reused, 2)
+        upstream = [e for e in self.endpoints if e.connections][0]
+        self.assertEquals(upstream.factory.sessions, [b'10.0.0.1'] * 3)
+
+    def test_least_loaded_backend(self):
+        clients = [self.successResultOf(self.pool.acquire())
+                   for _ in range(4)]
+        self.assertEquals([b.active for b in self.pool.backends], [2, 2])
+        for client in clients:
+            self.pool.release(client)
+        self.assertEquals([len(b.idle) for b in self.pool.backends], [2, 2])
+
+    def test_failover_and_health_checks(self):
+        self.endpoints[0].down = True
+        for _ in range(2):
+            client = self.successResultOf(self.pool.acquire())
+            self.assertTrue(client.backend.endpoint is self.endpoints[1])
+            self.pool.release(client)
+        self.assertFalse(self.pool.backends[0].healthy)
+
+        self.endpoints[0].down = False
+        self.pool.start()
+        self.addCleanup(self.pool.stop)
+        self.assertTrue(self.pool.backends[0].healthy)
+        self.assertEquals(len(self.pool.backends[0].idle), 1)
+
+    def test_no_backend_available(self):
+        for endpoint in self.endpoints:
+            endpoint.down = True
+        self.failureResultOf(self.pool.acquire(), NoBackendAvailable)
+
+        proto = self.connect()
+        proto.dataReceived(OPTNEG + CONNECT + MACRO)
+        self.assertEquals(self.replies(proto)[1:], [TEMPFAIL])
+        self.assertEquals(len(self.flushLoggedErrors(NoBackendAvailable)), 1)
+        # the commands without a reply just continue
+        self.assertEquals(proto.onMacro(b'M', [b'i', b'Q1']), CONTINUE)
+        self.assertEquals(proto.onAbort(), CONTINUE)
+
+    def test_upstream_lost(self):
+        proto = self.connect()
+        proto.dataReceived(OPTNEG + CONNECT)
+        proto.upstream.transport.loseConnection()
+        proto.dataReceived(MAIL)
+        self.assertEquals(self.replies(proto)[-1], TEMPFAIL)
+        self.assertEquals(sum(b.active for b in self.pool.backends), 0)
+
+    def upstreamOf(self, proto):
+        return [server for e in self.endpoints for server in e.connections
+                if server.transport.peer.protocol is proto.upstream][0]
+
+    def test_upstream_timeout(self):
+        proto = self.connect()
+        proto.dataReceived(OPTNEG + CONNECT + SLOW_MAIL)
+        backend = proto.upstream.backend
+        self.clock.advance(59)
+        self.assertEquals(self.replies(proto)[1:], [CONTINUE])
+        self.clock.advance(1)
+        self.assertEquals(self.replies(proto), [TEMPFAIL])
+        self.assertFalse(backend.healthy)
+        self.assertEquals(len(self.flushLoggedErrors(defer.CancelledError)),
+                          1)
+        # the session goes on without upstream
+        proto.dataReceived(MAIL)
+        self.assertEquals(self.replies(proto), [TEMPFAIL])
+
+    def test_upstream_progress_is_relayed(self):
+        proto = self.connect()
+        proto.dataReceived(OPTNEG + CONNECT + SLOW_MAIL)
+        upstream = self.upstreamOf(proto)
+        self.replies(proto)
+        self.clock.advance(50)
+        upstream.progress()
+        self.assertEquals(self.replies(proto), [PROGRESS])
+        # and restarts the timeout
+        self.clock.advance(50)
+        upstream.pending.callback(CONTINUE)
+        self.assertEquals(self.replies(proto), [CONTINUE])
+        self.assertTrue(proto.upstream.backend.healthy)
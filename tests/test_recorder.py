@@ -0,0 +1,181 @@
+import os
+
+from twisted.internet import defer, error, task
+from twisted.python.failure import Failure
+from twisted.test import proto_helpers
+from twisted.trial import unittest
+
+from txmilter import MilterFactory
+from txmilter import MilterProtocol
+from txmilter import message
+from txmilter.codec import MilterEncoder
+from txmilter.protocol import ACCEPT, CONTINUE, REJECT
+from txmilter.recorder import MAGIC
+from txmilter.recorder import SessionRecorder
+from txmilter.replay import Replayer
+from txmilter.replay import RecordingError
+from txmilter.replay import readRecording
+
+
+encode = MilterEncoder().encode
+
+OPTNEG = encode(message.Optneg(6, 2**9 - 1, 2**21 - 1))
+HELO = encode(message.Helo(b'me'))
+MAIL = encode(message.Mail([b'<a@b>']))
+EOM = encode(message.BodyEob())
+
+
+class Milter(MilterProtocol):
+    def onHelo(self, helo):
+        return CONTINUE
+
+    def onMail(self, args):
+        if args[0] == b'<spam@b>':
+            return REJECT
+        return CONTINUE
+
+    def onEom(self):
+        self.addHeader(b'X-Seen', b'yes')
+        return ACCEPT
+
+
+class Slow(Milter):
+    def onHelo(self, helo):
+        return task.deferLater(self.factory.clock, 0.5, lambda: CONTINUE)
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        self.now += 0.5
+        return self.now
+
+
+class RecorderTest(unittest.TestCase):
+    def setUp(self):
+        self.path = self.mktemp()
+        self.recorder = SessionRecorder(self.path, clock=Clock())
+        self.addCleanup(self.recorder.close)
+        self.factory = MilterFactory(recorder=self.recorder)
+        self.factory.protocol = Milter
+
+    def session(self, *chunks):
+        proto = self.factory.buildProtocol(None)
+        proto.makeConnection(proto_helpers.StringTransport())
+        for chunk in chunks:
+            proto.dataReceived(chunk)
+        proto.connectionLost(Failure(error.ConnectionDone()))
+        return proto.transport.value()
+
+    def test_sessions_are_recorded(self):
+        sent = self.session(OPTNEG + HELO[:3], HELO[3:] + MAIL, EOM)
+        self.session(HELO)
+        first, second = readRecording([self.path])
+        self.assertEquals((first.id, second.id), (0, 1))
+        # each record is half a second after the previous one
+        self.assertEquals(first.received, [(0.5, OPTNEG + HELO[:3]),
+                                           (1.5, HELO[3:] + MAIL),
+                                           (3.0, EOM)])
+        self.assertEquals(b''.join(data for _, data in first.sent), sent)
+        self.assertTrue(first.complete)
+
+    def test_sampling(self):
+        self.recorder.sampleRate = 0
+        self.session(HELO)
+        self.assertFalse(os.path.exists(self.path))
+        self.assertEquals((self.recorder.sessions,
+                           self.recorder.recorded), (1, 0))
+
+    def test_rotation(self):
+        self.recorder.maxSize = 100
+        self.recorder.maxFiles = 2
+        for _ in range(10):
+            self.session(OPTNEG + HELO)
+        self.assertTrue(self.recorder.rotations > 2)
+        paths = [self.path + '.2', self.path + '.1', self.path]
+        self.assertFalse(os.path.exists(self.path + '.3'))
+        for path in paths:
+            with open(path, 'rb') as f:
+                self.assertTrue(f.read().startswith(MAGIC))
+        sessions = readRecording(paths)
+        self.assertTrue(sessions)
+        self.assertEquals(sessions[-1].id, 9)
+
+    def test_truncated_and_invalid_logs(self):
+        self.session(OPTNEG, HELO)
+        self.recorder.close()
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        with open(self.path, 'wb') as f:
+            f.write(data[:-10])
+        session, = readRecording([self.path])
+        self.assertFalse(session.complete)
+        with open(self.path, 'wb') as f:
+            f.write(b'garbage')
+        self.assertRaises(RecordingError, readRecording, [self.path])
+
+
+class ReplayTest(unittest.TestCase):
+    def setUp(self):
+        path = self.mktemp()
+        recorder = SessionRecorder(path, clock=Clock())
+        factory = MilterFactory(recorder=recorder)
+        factory.protocol = Milter
+        for mail in (MAIL, encode(message.Mail([b'<spam@b>']))):
+            proto = factory.buildProtocol(None)
+            proto.makeConnection(proto_helpers.StringTransport())
+            proto.dataReceived(OPTNEG)
+            proto.dataReceived(HELO + mail + EOM)
+            proto.connectionLost(Failure(error.ConnectionDone()))
+        recorder.close()
+        self.sessions = readRecording([path])
+        self.clock = task.Clock()
+        self.factory = MilterFactory()
+        self.factory.protocol = Milter
+        self.factory.clock = self.clock
+
+    def test_replay_as_fast_as_possible(self):
+        replayer = Replayer(self.factory, clock=self.clock)
+        results = self.successResultOf(replayer.replayAll(self.sessions))
+        self.assertEquals([r.matches for r in results], [True, True])
+        self.assertEquals([r.elapsed for r in results], [0, 0])
+
+    def test_replay_at_original_timing(self):
+        self.factory.protocol = Slow
+        replayer = Replayer(self.factory, realtime=True, speed=2,
+                            clock=self.clock)
+        session = self.sessions[0]
+        d = replayer.replay(session)
+        self.assertEquals(self.clock.getDelayedCalls()[0].getTime(),
+                          session.received[0][0] / 2)
+        self.clock.pump([0.25] * 10)
+        result = self.successResultOf(d)
+        self.assertTrue(result.matches)
+        self.assertEquals(result.elapsed, session.duration / 2)
+
+    def test_mismatching_replies(self):
+        self.factory.protocol = type('Accepting', (Milter,),
+                                     {'onMail': lambda self, args: ACCEPT})
+        replayer = Replayer(self.factory, clock=self.clock)
+        results = self.successResultOf(replayer.replayAll(self.sessions))
+        self.assertEquals([r.matches for r in results], [False, False])
+
+    def test_pending_handlers_are_waited_for(self):
+        self.factory.protocol = Slow
+        replayer = Replayer(self.factory, clock=self.clock)
+        d = replayer.replay(self.sessions[0])
+        self.assertNoResult(d)
+        self.clock.pump([0.1] * 6)
+        self.assertTrue(self.successResultOf(d).matches)
+
+    def test_hung_handlers_are_given_up_on(self):
+        self.factory.protocol = type('Hung', (Milter,), {
+                'onHelo': lambda self, helo: defer.Deferred()})
+        replayer = Replayer(self.factory, drainTimeout=1, clock=self.clock)
+        d = replayer.replay(self.sessions[0])
+        self.assertNoResult(d)
+        self.clock.advance(1)
+        self.assertFalse(self.successResultOf(d).matches)
+        self.assertFalse(self.clock.getDelayedCalls())
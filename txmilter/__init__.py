@@ -1,3 +1,3 @@
-from protocol import MilterProtocol
-from protocol import MilterFactory
-from message import MilterMessage
+from .protocol import MilterProtocol
+from .protocol import MilterFactory
+from .message import MilterMessage
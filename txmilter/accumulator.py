@@ -0,0 +1,187 @@
+from .protocol import CONTINUE
+from .protocol import noreply
+
+
+class MessageState(object):
+    """ What the MTA sent about the current message: envelope, headers and,
+        optionally, body.
+
+        Header lookups are case insensitive and go through an index of the
+        headers by name, only built when first needed.
+    """
+    __slots__ = ('sender', 'mailArgs', 'recipients', 'rcptArgs', 'headers',
+                 'bodyChunks', 'bodySize', '_index')
+
+    def __init__(self, sender=None, mailArgs=()):
+        self.sender = sender
+        self.mailArgs = list(mailArgs)
+        self.recipients = []
+        # ESMTP arguments of each recipient
+        self.rcptArgs = []
+        # (name, value) in the order they were received
+        self.headers = []
+        self.bodyChunks = []
+        self.bodySize = 0
+        # lowercase name -> positions in headers
+        self._index = None
+
+    def addRecipient(self, args):
+        self.recipients.append(args[0] if args else None)
+        self.rcptArgs.append(args[1:])
+
+    def addHeader(self, name, value):
+        if self._index is not None:
+            self._index.setdefault(name.lower(), []).append(len(self.headers))
+        self.headers.append((name, value))
+
+    def _headerIndex(self):
+        if self._index is None:
+            index = {}
+            for pos, (name, _) in enumerate(self.headers):
+                index.setdefault(name.lower(), []).append(pos)
+            self._index = index
+        return self._index
+
+    def headerPositions(self, name):
+        """ Return the positions in headers of the headers called name """
+        return self._headerIndex().get(name.lower(), [])
+
+    def getHeaders(self, name):
+        """ Return the values of all the headers called name """
+        headers = self.headers
+        return [headers[pos][1] for pos in self.headerPositions(name)]
+
+    def getHeader(self, name, default=None):
+        """ Return the value of the first header called name """
+        positions = self.headerPositions(name)
+        if not positions:
+            return default
+        return self.headers[positions[0]][1]
+
+    def __contains__(self, name):
+        return bool(self.headerPositions(name))
+
+    def headerIndex(self, pos):
+        """ Return the index identifying the header at position pos for
+            chgHeader(): the 1-based occurrence of its name """
+        return self.headerPositions(self.headers[pos][0]).index(pos) + 1
+
+    @property
+    def body(self):
+        return b''.join(self.bodyChunks)
+
+
+def _connect(self, msg):
+    self.hostname = msg.hostname
+    self.family = msg.family
+    self.port = msg.port
+    self.address = msg.address
+
+
+def _helo(self, msg):
+    self.helo = msg.helo
+
+
+def _mail(self, msg):
+    self.message = MessageState(msg.args[0] if msg.args else None,
+                                msg.args[1:])
+
+
+def _rcpt(self, msg):
+    if self.message is not None:
+        self.message.addRecipient(msg.args)
+
+
+def _header(self, msg):
+    if self.message is not None:
+        self.message.addHeader(msg.name, msg.value)
+
+
+def _body(self, msg):
+    if self.message is not None:
+        self.message.bodySize += len(msg.buf)
+        if self.collectBody:
+            self.message.bodyChunks.append(msg.buf.tobytes())
+
+
+def _abort(self, msg):
+    self.message = None
+
+
+def _quitNc(self, msg):
+    self.hostname = self.family = self.port = self.address = None
+    self.helo = None
+    self.message = None
+
+
+# command -> function recording it
+_RECORDERS = {'SMFIC_CONNECT': _connect,
+              'SMFIC_HELO': _helo,
+              'SMFIC_MAIL': _mail,
+              'SMFIC_RCPT': _rcpt,
+              'SMFIC_HEADER': _header,
+              'SMFIC_BODY': _body,
+              'SMFIC_ABORT': _abort,
+              'SMFIC_QUIT_NC': _quitNc,
+             }
+
+
+class MessageAccumulatorMixin(object):
+    """ Opt-in MilterProtocol mixin gathering what the MTA sends about a
+        session and its messages.
+
+        The client is in hostname, family, port, address and helo, and the
+        current message (from MAIL FROM up to the next message or abort) in
+        self.message, a MessageState. Body chunks are only kept if
+        collectBody is set, and are only sent by the MTA if onBody is
+        overridden.
+
+        The connect, helo, mail, rcpt and header handlers of the mixin ask
+        the MTA not to wait for their reply; override them to reply
+        otherwise. Everything is recorded in commandReceived(), before the
+        handlers run, so the mixin also works in a txmilter.chain filter;
+        override commandReceived() calling the base method, not _dispatch.
+
+        Use it as: class MyMilter(MessageAccumulatorMixin, MilterProtocol).
+    """
+
+    collectBody = False
+
+    hostname = None
+    family = None
+    port = None
+    address = None
+    helo = None
+    message = None
+
+    @noreply
+    def onConnect(self, hostname, family, port, address):
+        return CONTINUE
+
+    @noreply
+    def onHelo(self, helo):
+        return CONTINUE
+
+    @noreply
+    def onMail(self, args):
+        return CONTINUE
+
+    @noreply
+    def onRcpt(self, args):
+        return CONTINUE
+
+    @noreply
+    def onHeader(self, name, value):
+        return CONTINUE
+
+    def changeHeader(self, pos, value):
+        """ Change the value of the header at position pos in
+            self.message.headers; an empty value deletes it. """
+        name = self.message.headers[pos][0]
+        return self.chgHeader(self.message.headerIndex(pos), name, value)
+
+    def commandReceived(self, msg):
+        record = _RECORDERS.get(msg.cmd)
+        if record is not None:
+            record(self, msg)
+        super(MessageAccumulatorMixin, self).commandReceived(msg)
@@ -0,0 +1,74 @@
+""" Admission control: shedding load instead of collapsing under it.
+
+    A MilterFactory created with an AdmissionControl bounds the sessions it
+    serves, the handlers running and the bytes of the commands received
+    and not handled yet, per session and in total. Commands beyond the
+    limits do not reach their handler: verdict is replied straight away.
+
+        admission = AdmissionControl(maxSessions=500, maxInFlight=2000,
+                                     maxSessionBuffered=4 * 1024 * 1024,
+                                     verdict=CONTINUE)
+        factory = MilterFactory(admission=admission)
+
+    Sessions beyond maxSessions are shed as a whole, starting from connect:
+    with TEMPFAIL or ACCEPT the MTA stops there, with CONTINUE the mail
+    goes through unfiltered. The option negotiation and the commands
+    without reply (macros, abort, quit) always reach their handlers.
+
+    self.shed counts the shed commands by reason, and self.shedSessions
+    the sessions shed; MetricsInstrumentation exports them too.
+"""
+from .protocol import TEMPFAIL
+
+
+# why commands are shed
+SHED_REASONS = ('sessions', 'session_inflight', 'inflight',
+                'session_buffered', 'buffered')
+
+
+class AdmissionControl(object):
+    """ Limits on the load of a MilterFactory (None: no limit), and the
+        verdict replied to the commands beyond them (TEMPFAIL, CONTINUE or
+        ACCEPT) """
+
+    def __init__(self, maxSessions=None, maxSessionInFlight=None,
+                 maxInFlight=None, maxSessionBuffered=None, maxBuffered=None,
+                 verdict=TEMPFAIL):
+        self.maxSessions = maxSessions
+        self.maxSessionInFlight = maxSessionInFlight
+        self.maxInFlight = maxInFlight
+        self.maxSessionBuffered = maxSessionBuffered
+        self.maxBuffered = maxBuffered
+        self.verdict = verdict
+        # sessions admitted, handlers running and bytes held, in total
+        self.sessions = 0
+        self.inFlight = 0
+        self.buffered = 0
+        self.shed = dict.fromkeys(SHED_REASONS, 0)
+        self.shedSessions = 0
+
+    def admitSession(self, proto):
+        """ Return whether the new session proto can be served """
+        if self.maxSessions is not None and self.sessions >= self.maxSessions:
+            self.shedSessions += 1
+            return False
+        self.sessions += 1
+        return True
+
+    def sessionEnded(self, proto, admitted):
+        if admitted:
+            self.sessions -= 1
+
+    def check(self, proto):
+        """ Return why the next command of proto must be shed, or None """
+        if (self.maxSessionInFlight is not None
+                and proto._inFlight >= self.maxSessionInFlight):
+            return 'session_inflight'
+        if self.maxInFlight is not None and self.inFlight >= self.maxInFlight:
+            return 'inflight'
+        if (self.maxSessionBuffered is not None
+                and proto._buffered > self.maxSessionBuffered):
+            return 'session_buffered'
+        if self.maxBuffered is not None and self.buffered > self.maxBuffered:
+            return 'buffered'
+        return None
@@ -0,0 +1,139 @@
+""" Milter server on asyncio (Python 3).
+
+    AsyncMilterProtocol is the asyncio counterpart of MilterProtocol, using
+    the same codec and the same on* handlers. Handlers can be coroutine
+    functions, awaiting asyncio clients directly:
+
+        class MyMilter(AsyncMilterProtocol):
+            async def onMail(self, args):
+                if await blocklist.contains(args[0]):
+                    return REJECT
+                return CONTINUE
+
+        loop = asyncio.get_event_loop()
+        factory = AsyncMilterFactory(MyMilter, actions=SMFIF_ADDHDRS)
+        server = loop.run_until_complete(
+            loop.create_server(factory, '127.0.0.1', 8888))
+        loop.run_forever()
+
+    Only public asyncio APIs are used, so it runs on uvloop too. The session
+    core is MilterProtocol's (txmilter.protocol.MilterSession): handlers run
+    as soon as their command arrives, their replies are sent in command
+    order and the protocol options are negotiated the same way.
+    Instrumentation, admission control, recording, offloading and handler
+    deadlines are only available on the Twisted server.
+"""
+import asyncio
+import functools
+import inspect
+import itertools
+import logging
+
+from .codec import MilterCodecError
+from .codec import MilterEncoder
+from .protocol import HANDLERS
+from .protocol import MilterSession
+
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncMilterProtocol(MilterSession, asyncio.Protocol):
+    """ Milter session on an asyncio transport. The on* handlers, the
+        modification methods and the reply queue are the ones of
+        MilterProtocol (see MilterSession); handlers may return an
+        awaitable, whose result is the reply.
+
+        There is no handler deadline: the MTA waits for the reply to a
+        coroutine that never returns until its own timeout. Reading from
+        the MTA is paused while the transport cannot keep up with the
+        replies.
+    """
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self._startSession()
+        # tasks of the pending coroutine handlers
+        self._tasks = set()
+
+    def connection_lost(self, exc):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks.clear()
+        self._stopSession()
+
+    def pause_writing(self):
+        self.transport.pause_reading()
+
+    def resume_writing(self):
+        self.transport.resume_reading()
+
+    def data_received(self, data):
+        try:
+            for msg in self.decoder.feed(data).decode():
+                if msg is not None:
+                    self._received(msg)
+        except MilterCodecError:
+            logger.exception('invalid data in milter session %s', self.id)
+            self.transport.abort()
+
+    def _dispatch(self, msg, queuedAt=None, size=None):
+        self.commandReceived(msg)
+        method = self._handlers.get(msg.cmd, self._unknownHandler)
+        if method is None:
+            return
+        slot = [False, None, msg.cmd, None, None]
+        self._replies.append(slot)
+        try:
+            result = method(*msg)
+        except Exception:
+            logger.exception('error while handling %s', msg.cmd)
+            result = self._failed(msg.cmd)
+        if inspect.isawaitable(result):
+            task = asyncio.ensure_future(result)
+            self._tasks.add(task)
+            task.add_done_callback(functools.partial(self._taskDone, slot))
+        else:
+            self._handlerDone(result, slot)
+
+    def _taskDone(self, slot, task):
+        if task not in self._tasks:
+            # cancelled when the connection was lost
+            return
+        self._tasks.discard(task)
+        exc = task.exception()
+        if exc is not None:
+            logger.error('error while handling %s', slot[2],
+                         exc_info=(type(exc), exc, exc.__traceback__))
+            self._handlerDone(self._failed(slot[2]), slot)
+        else:
+            self._handlerDone(task.result(), slot)
+
+    def _writeSequence(self, seq):
+        self.transport.writelines(seq)
+
+    def _logMsg(self, text):
+        logger.warning('%s', text)
+
+
+class AsyncMilterFactory(object):
+    """ Protocol factory for loop.create_server(), building protocol (an
+        AsyncMilterProtocol subclass) sessions requesting actions and
+        protocols from the MTA """
+
+    def __init__(self, protocol=AsyncMilterProtocol, actions=0, protocols=0):
+        self.protocol = protocol
+        self.actions = actions
+        self.protocols = protocols
+        self.version = 6
+        self.encoder = MilterEncoder()
+        self.handlerMap = dict(HANDLERS)
+        self.idCounter = itertools.count()
+
+    def getId(self):
+        return next(self.idCounter)
+
+    def __call__(self):
+        proto = self.protocol()
+        proto.factory = self
+        return proto
@@ -0,0 +1,140 @@
+import tempfile
+
+from zope.interface import implementer
+from twisted.internet.interfaces import IConsumer, IPushProducer
+
+from . import compat
+from .protocol import CONTINUE, SKIP
+
+
+@implementer(IPushProducer)
+class BodyProducer(object):
+    """ Produces the body of a message to a consumer.
+
+        When the consumer asks to pause, the milter transport is paused so
+        that no more data is read from the MTA until the consumer catches
+        up.
+    """
+
+    def __init__(self, transport, consumer):
+        self.transport = transport
+        self.consumer = consumer
+        self.paused = False
+        self.stopped = False
+        consumer.registerProducer(self, True)
+
+    def pauseProducing(self):
+        if not self.paused:
+            self.paused = True
+            self.transport.pauseProducing()
+
+    def resumeProducing(self):
+        if self.paused:
+            self.paused = False
+            self.transport.resumeProducing()
+
+    def stopProducing(self):
+        """ The consumer does not want the rest of the body """
+        self.stopped = True
+        self.resumeProducing()
+
+    def write(self, data):
+        if not self.stopped:
+            self.consumer.write(data)
+
+    def finish(self):
+        """ The whole body has been written """
+        self.resumeProducing()
+        self.consumer.unregisterProducer()
+
+
+@implementer(IConsumer)
+class BodySpool(object):
+    """ Consumer keeping a message body in memory up to threshold bytes, and
+        in a temporary file past that.
+
+        Once the body is complete, file is rewound and ready to be read.
+    """
+
+    def __init__(self, threshold):
+        self.file = tempfile.SpooledTemporaryFile(max_size=threshold)
+        self.size = 0
+        self.producer = None
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def unregisterProducer(self):
+        self.producer = None
+        self.file.seek(0)
+
+    def write(self, data):
+        if not compat.PY3 and isinstance(data, memoryview):
+            data = data.tobytes()
+        self.file.write(data)
+        self.size += len(data)
+
+    def close(self):
+        self.file.close()
+
+
+class BodyStreamMixin(object):
+    """ Opt-in MilterProtocol mixin streaming message bodies to a consumer.
+
+        The body of each message is written, chunk by chunk, to the
+        IConsumer returned by bodyConsumer(), which is available as
+        self.body from the first body chunk to the end of the message
+        (onEom included). The default consumer is a BodySpool holding at
+        most spoolThreshold bytes in memory.
+
+        If the consumer pauses its producer, the transport is paused until
+        it resumes, so a slow consumer never makes the body pile up in
+        memory. If it stops its producer, the MTA is told to skip the rest
+        of the body.
+
+        Use it as: class MyMilter(BodyStreamMixin, MilterProtocol), and do
+        not override onBody.
+    """
+
+    spoolThreshold = 1024 * 1024
+
+    body = None
+    _bodyProducer = None
+
+    def bodyConsumer(self):
+        """ Return the IConsumer for the body of the current message. """
+        return BodySpool(self.spoolThreshold)
+
+    def onBody(self, buf):
+        if self._bodyProducer is None:
+            self.body = self.bodyConsumer()
+            self._bodyProducer = BodyProducer(self.transport, self.body)
+        self._bodyProducer.write(buf)
+        if self._bodyProducer.stopped:
+            return SKIP
+        return CONTINUE
+
+    def commandReceived(self, msg):
+        cmd = msg.cmd
+        if cmd == 'SMFIC_BODYEOB':
+            if self._bodyProducer is not None:
+                self._bodyProducer.finish()
+                self._bodyProducer = None
+        elif cmd in ('SMFIC_ABORT', 'SMFIC_QUIT', 'SMFIC_QUIT_NC',
+                     'SMFIC_MAIL'):
+            # a new message (or no message at all) follows
+            self._discardBody()
+        super(BodyStreamMixin, self).commandReceived(msg)
+
+    def connectionLost(self, reason):
+        self._discardBody()
+        return super(BodyStreamMixin, self).connectionLost(reason)
+
+    def _discardBody(self):
+        if self._bodyProducer is not None:
+            self._bodyProducer.finish()
+            self._bodyProducer = None
+        close = getattr(self.body, 'close', None)
+        if close is not None:
+            close()
+        self.body = None
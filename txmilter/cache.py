@@ -0,0 +1,149 @@
+""" Caching the verdicts of milter handlers.
+
+    Handlers doing expensive lookups on data coming back again and again
+    (client addresses, senders, recipients) can share their results between
+    sessions:
+
+        rbl = VerdictCache(maxSize=100000, ttl=300,
+                           verdictTtls={'SMFIR_TEMPFAIL': 30})
+
+        class MyMilter(MilterProtocol):
+            @cached(rbl)
+            def onConnect(self, hostname, family, port, address):
+                return lookup(address).addCallback(...)
+
+    Concurrent calls for the same key share a single call of the handler.
+    Only the result of the handler is cached: modifications it requests
+    are not replayed.
+"""
+import collections
+import functools
+
+from twisted.internet import defer
+from twisted.python.failure import Failure
+
+
+def _connectKey(hostname, family, port, address):
+    return address
+
+
+def _heloKey(helo):
+    return helo.lower()
+
+
+def _envelopeKey(args):
+    return args[0].lower() if args else None
+
+
+# default key functions, by handler name
+KEYS = {'onConnect': _connectKey,
+        'onHelo': _heloKey,
+        'onMail': _envelopeKey,
+        'onRcpt': _envelopeKey,
+       }
+
+
+class VerdictCache(object):
+    """ LRU cache of at most maxSize results, each one kept for ttl seconds
+        (or verdictTtls[result.cmd] seconds, if there).
+
+        Failures are cached for negativeTtl seconds, if not None. hits,
+        misses (calls made) and coalesced (calls which waited for an
+        identical pending one) count the lookups.
+    """
+
+    def __init__(self, maxSize=10000, ttl=300, negativeTtl=None,
+                 verdictTtls=None, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.clock = clock
+        self.maxSize = maxSize
+        self.ttl = ttl
+        self.negativeTtl = negativeTtl
+        self.verdictTtls = verdictTtls or {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        # key -> (expires at, result)
+        self._entries = collections.OrderedDict()
+        # key -> Deferreds waiting for the pending call
+        self._pending = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, func, *args, **kwargs):
+        """ Return a Deferred firing with the cached result for key, calling
+            func(*args, **kwargs) to get it if needed. """
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            if entry[0] > self.clock.seconds():
+                self._entries[key] = entry
+                self.hits += 1
+                if isinstance(entry[1], Failure):
+                    return defer.fail(entry[1])
+                return defer.succeed(entry[1])
+        waiting = self._pending.get(key)
+        if waiting is not None:
+            self.coalesced += 1
+            d = defer.Deferred()
+            waiting.append(d)
+            return d
+        self.misses += 1
+        waiting = self._pending[key] = []
+        d = defer.maybeDeferred(func, *args, **kwargs)
+        d.addBoth(self._store, key)
+        if not d.called:
+            # the caller also waits for the pending call
+            mine = defer.Deferred()
+            waiting.append(mine)
+            return mine
+        return d
+
+    def _store(self, result, key):
+        waiting = self._pending.pop(key, [])
+        if isinstance(result, Failure):
+            ttl = self.negativeTtl
+        else:
+            ttl = self.verdictTtls.get(getattr(result, 'cmd', None),
+                                       self.ttl)
+        if ttl:
+            self._entries[key] = (self.clock.seconds() + ttl, result)
+            while len(self._entries) > self.maxSize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        for d in waiting:
+            if isinstance(result, Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+        if waiting and isinstance(result, Failure):
+            # handled by the waiting Deferreds
+            return None
+        return result
+
+    def invalidate(self, key=None):
+        """ Forget the result for key, or all of them """
+        if key is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(key, None)
+
+
+def cached(cache, key=None):
+    """ Decorator caching the result of a MilterProtocol handler in cache.
+
+        key is called with the arguments of the handler and returns the
+        cache key; by default it is the client address for onConnect, the
+        helo name for onHelo and the address for onMail and onRcpt.
+    """
+    def decorator(method):
+        keyFunc = key or KEYS[method.__name__]
+        name = method.__name__
+
+        @functools.wraps(method)
+        def wrapper(self, *args):
+            return cache.get((name, keyFunc(*args)), method, self, *args)
+        return wrapper
+    return decorator
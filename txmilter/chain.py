@@ -0,0 +1,247 @@
+""" Running several milters behind a single MTA connection.
+
+    Each frame is decoded once and handed to all the filters of the chain,
+    so the MTA sends every header and body chunk once instead of once per
+    milter:
+
+        factory = MilterChainFactory([DkimFactory(), SpamFactory(),
+                                      DisclaimerFactory()])
+
+    The filters are plain MilterProtocol subclasses, built by their own
+    factories; their commandReceived() is called with every command, so
+    mixins like MessageAccumulatorMixin work in a chain. Their handlers run
+    concurrently, and their verdicts are combined into the reply of the
+    chain: the most restrictive one wins (REJECT, then DISCARD, then
+    TEMPFAIL). A filter replying ACCEPT is not
+    called anymore until the end of the message (or of the connection, if
+    it accepted it at connect or helo), and a filter replying SKIP does not
+    get the rest of the body; the chain replies ACCEPT or SKIP itself when
+    no filter is left. A filter whose handler fails counts as replying its
+    failureVerdict (TEMPFAIL by default): set it to CONTINUE for the chain
+    to go on without that filter.
+
+    Modifications requested at end of message by all the filters are sent
+    with the reply, in filter order. Filters do not see each other's
+    modifications; when several of them replace the body, only the last
+    replacement is kept. The progressInterval and callbackDeadline of the
+    filters are not used: set the ones of the chain instead.
+"""
+import functools
+import operator
+
+from twisted.internet import defer
+from twisted.python import log
+
+from . import constants
+from . import message
+from .protocol import ACCEPT
+from .protocol import CONTINUE
+from .protocol import NO_REPLY_CMDS
+from .protocol import OPTIONAL_CALLBACKS
+from .protocol import SKIP
+from .protocol import MilterFactory
+from .protocol import MilterProtocol
+
+
+# verdict -> how restrictive it is: the chain replies the highest one
+SEVERITY = {'SMFIR_CONTINUE': 0,
+            'SMFIR_CONN_FAIL': 1,
+            'SMFIR_SHUTDOWN': 1,
+            'SMFIR_TEMPFAIL': 2,
+            'SMFIR_DISCARD': 3,
+            'SMFIR_REJECT': 4,
+           }
+
+# protocol options the chain only requests when all the filters do: the
+# ones skipping a callback or its reply
+_ALL_FILTERS_OPTIONS = functools.reduce(
+        operator.or_, (nocb | noreply
+                       for _, nocb, noreply in OPTIONAL_CALLBACKS.values()))
+
+# commands starting a new message, for which the filters which accepted
+# the previous one are called again
+_MESSAGE_CMDS = frozenset(['SMFIC_MAIL', 'SMFIC_ABORT'])
+
+# commands whose ACCEPT covers the whole connection
+_SESSION_CMDS = frozenset(['SMFIC_CONNECT', 'SMFIC_HELO'])
+
+
+def severity(verdict):
+    """ Return how restrictive verdict is (see SEVERITY); reply codes
+        count as a reject or a tempfail depending on their class """
+    cmd = getattr(verdict, 'cmd', None)
+    if cmd == 'SMFIR_REPLYCODE':
+        code = verdict.data['smtpcode'][:1]
+        return SEVERITY['SMFIR_REJECT' if code == b'5' else 'SMFIR_TEMPFAIL']
+    return SEVERITY.get(cmd, 0)
+
+
+def mergeSymlists(symlists):
+    """ Merge the macro lists asked by each filter (stage -> names): a
+        stage is only restricted when all the filters restrict it """
+    merged = {}
+    if not symlists:
+        return merged
+    for stage in set.intersection(*[set(s) for s in symlists]):
+        names = []
+        for lists in symlists:
+            names.extend(n for n in lists[stage] if n not in names)
+        merged[stage] = names
+    return merged
+
+
+class MilterChainProtocol(MilterProtocol):
+    """ Dispatches the commands of the MTA to the filters of the factory.
+
+        self.filters are the protocols of the filters, connected to the
+        transport of the chain (progress keepalives they send go straight
+        to the MTA).
+    """
+
+    def connectionMade(self):
+        MilterProtocol.connectionMade(self)
+        self.filters = []
+        for factory in self.factory.filters:
+            proto = factory.buildProtocol(None)
+            proto.makeConnection(self.transport)
+            self.filters.append(proto)
+        # filter -> the command it replied ACCEPT to, and the filters which
+        # replied SKIP to a body chunk
+        self._accepted = {}
+        self._skipped = set()
+        # filter -> commands it asked not to receive
+        self._ignored = dict((f, frozenset()) for f in self.filters)
+        for cmd in self.factory.handlerMap:
+            self._handlers[cmd] = functools.partial(self._fanOut, cmd)
+        self._handlers['SMFIC_OPTNEG'] = self.onOptneg
+        self._unknownHandler = None
+
+    def connectionLost(self, reason):
+        for proto in self.filters:
+            proto.connectionLost(reason)
+        MilterProtocol.connectionLost(self, reason)
+
+    def commandReceived(self, msg):
+        MilterProtocol.commandReceived(self, msg)
+        for proto in self.filters:
+            proto.commandReceived(msg)
+
+    def onOptneg(self, version, actions, protocol):
+        """ Negotiate the options with each filter, and with the MTA the
+            union of what they asked """
+        self._mta_protocols = protocol
+        self._mta_actions = actions
+        self._mta_version = version
+        actions = self.factory.actions
+        protocols = self.factory.protocols
+        common = _ALL_FILTERS_OPTIONS
+        symlists = []
+        for proto in self.filters:
+            reply = proto.onOptneg(version, self._mta_actions, protocol)
+            actions |= reply.actions & ~constants.SMFIF_SETSYMLIST
+            protocols |= reply.protocol & ~_ALL_FILTERS_OPTIONS
+            common &= reply.protocol
+            symlists.append(getattr(reply, 'symlists', None) or {})
+            self._ignored[proto] = frozenset(
+                    cmd for cmd, nocb, _ in OPTIONAL_CALLBACKS.values()
+                    if reply.protocol & nocb)
+        self.protocols = (protocols | common) & self._mta_protocols
+        self._noReplyCmds = NO_REPLY_CMDS.union(
+                cmd for cmd, _, noreply in OPTIONAL_CALLBACKS.values()
+                if self.protocols & noreply)
+        actions = self.actions = actions & self._mta_actions
+        self._symlists = mergeSymlists(symlists)
+        if self._symlists and self._mta_actions & constants.SMFIF_SETSYMLIST:
+            return message.OptnegSymlist(self.factory.version,
+                                         actions | constants.SMFIF_SETSYMLIST,
+                                         self.protocols, self._symlists)
+        return message.Optneg(self.factory.version, actions, self.protocols)
+
+    def _fanOut(self, cmd, *args):
+        if cmd == 'SMFIC_MACRO':
+            self.macros.update(*args)
+        elif cmd == 'SMFIC_ABORT':
+            self.macros.clear(b'M')
+        elif cmd == 'SMFIC_QUIT_NC':
+            self.macros.clear()
+        self._forget(cmd)
+        if cmd in NO_REPLY_CMDS:
+            # every filter gets them, accepted or not
+            targets = self.filters
+        else:
+            targets = [f for f in self.filters
+                       if f not in self._accepted and f not in self._skipped
+                       and cmd not in self._ignored[f]]
+        called = []
+        calls = []
+        for proto in targets:
+            method = proto._handlers.get(cmd, proto._unknownHandler)
+            if method is not None:
+                called.append(proto)
+                calls.append(defer.maybeDeferred(method, *args))
+        d = defer.DeferredList(calls, consumeErrors=True)
+        d.addCallback(self._combine, cmd, called)
+        return d
+
+    def _forget(self, cmd):
+        # call again the filters which accepted or skipped what is over
+        if cmd == 'SMFIC_QUIT_NC':
+            self._accepted.clear()
+        elif cmd in _MESSAGE_CMDS:
+            for proto, acceptedAt in list(self._accepted.items()):
+                if acceptedAt not in _SESSION_CMDS:
+                    del self._accepted[proto]
+        if cmd in _MESSAGE_CMDS or cmd == 'SMFIC_BODYEOB':
+            self._skipped.clear()
+
+    def _combine(self, results, cmd, targets):
+        verdict = CONTINUE
+        for proto, (success, result) in zip(targets, results):
+            if not success:
+                log.err(result, 'error while handling %s in %s'
+                        % (cmd, proto.__class__.__name__))
+                result = proto._failed(cmd)
+            replied = getattr(result, 'cmd', None)
+            if replied == 'SMFIR_ACCEPT':
+                self._accepted[proto] = cmd
+            elif replied == 'SMFIR_SKIP' and cmd == 'SMFIC_BODY':
+                self._skipped.add(proto)
+            elif severity(result) > severity(verdict):
+                verdict = result
+        if cmd == 'SMFIC_BODYEOB':
+            self._collectModifications()
+        if cmd in NO_REPLY_CMDS or severity(verdict):
+            return verdict
+        if len(self._accepted) == len(self.filters):
+            return ACCEPT
+        if cmd == 'SMFIC_BODY' and not any(
+                f not in self._accepted and f not in self._skipped
+                and cmd not in self._ignored[f] for f in self.filters):
+            return SKIP
+        return CONTINUE
+
+    def _collectModifications(self):
+        bodies = 0
+        for proto in reversed(self.filters):
+            modifications = proto._takeModifications()
+            if bodies and any(isinstance(m, list) for m in modifications):
+                log.msg('dropping the body replaced by %s: a later filter '
+                        'replaced it too' % proto.__class__.__name__)
+                modifications = [m for m in modifications
+                                 if not isinstance(m, list)]
+            bodies += any(isinstance(m, list) for m in modifications)
+            self._modifications[:0] = modifications
+
+
+class MilterChainFactory(MilterFactory):
+    """ Factory of a chain of the milters built by filters, a list of
+        MilterFactory. actions and protocols are requested from the MTA on
+        top of what the filters ask. """
+
+    protocol = MilterChainProtocol
+
+    def __init__(self, filters, actions=0, protocols=0,
+                 instrumentation=None, admission=None, recorder=None):
+        MilterFactory.__init__(self, actions, protocols, instrumentation,
+                               admission, recorder)
+        self.filters = list(filters)
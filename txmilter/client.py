@@ -0,0 +1,126 @@
+import collections
+
+from twisted.internet.protocol import Protocol
+from twisted.internet import defer
+
+from . import constants
+from . import message
+from .codec import MilterEncoder
+from .codec import MilterDecoder
+from .protocol import NO_REPLY_CMDS
+from .protocol import OPTIONAL_CALLBACKS
+
+
+# replies that do not answer a command but modify the message at eom
+MODIFICATION_CMDS = frozenset(['SMFIR_ADDRCPT', 'SMFIR_DELRCPT',
+                               'SMFIR_ADDRCPT_PAR', 'SMFIR_REPLBODY',
+                               'SMFIR_CHGFROM', 'SMFIR_ADDHEADER',
+                               'SMFIR_CHGHEADER', 'SMFIR_QUARANTINE'])
+
+ALL_ACTIONS = (constants.SMFIF_ADDHDRS | constants.SMFIF_CHGBODY
+               | constants.SMFIF_ADDRCPT | constants.SMFIF_DELRCPT
+               | constants.SMFIF_CHGHDRS | constants.SMFIF_QUARANTINE
+               | constants.SMFIF_CHGFROM | constants.SMFIF_ADDRCPT_PAR
+               | constants.SMFIF_SETSYMLIST)
+
+ALL_PROTOCOLS = 2**21 - 1
+
+
+class MilterClientError(Exception):
+    """ Error talking to a milter """
+
+
+class MilterClientProtocol(Protocol):
+    """ The MTA side of the milter protocol.
+
+        send() writes a command and returns a Deferred firing with the reply
+        of the milter, or with None for the commands the milter does not
+        reply to. Modifications sent by the milter at the end of a message
+        are collected in self.modifications. self.disconnected fires when
+        the connection is lost.
+    """
+
+    # called when the milter asks to wait longer for a reply, if not None
+    onProgress = None
+
+    def connectionMade(self):
+        self.encoder = MilterEncoder()
+        self.decoder = MilterDecoder()
+        # negotiated options
+        self.version = None
+        self.actions = 0
+        self.protocols = 0
+        self.modifications = []
+        self.bytesSent = 0
+        self._pending = collections.deque()
+        self._noReplyCmds = NO_REPLY_CMDS
+        self._skippedCmds = frozenset()
+        self.disconnected = defer.Deferred()
+
+    def negotiate(self, version=6, actions=ALL_ACTIONS,
+                  protocols=ALL_PROTOCOLS):
+        """ Send the option negotiation, offering actions and protocols """
+        return self.send(message.Optneg(version, actions, protocols))
+
+    def send(self, msg):
+        cmd = msg.cmd
+        if cmd in self._skippedCmds:
+            # the milter asked not to receive this command
+            return defer.succeed(None)
+        if cmd == 'SMFIC_BODYEOB':
+            self.modifications = []
+        data = self.encoder.encode(msg)
+        self.bytesSent += len(data)
+        if cmd in self._noReplyCmds:
+            self.transport.write(data)
+            return defer.succeed(None)
+        d = defer.Deferred()
+        # registered first: the reply may come while writing
+        self._pending.append((cmd, d))
+        self.transport.write(data)
+        return d
+
+    def quitNewConnection(self):
+        """ End the session, keeping the connection (and the negotiated
+            options) for a new one """
+        return self.send(message.QuitNc())
+
+    @property
+    def busy(self):
+        """ Whether some replies are still expected """
+        return bool(self._pending)
+
+    def dataReceived(self, data):
+        self.decoder.feed(data)
+        for reply in self.decoder.decode():
+            if reply.cmd == 'SMFIR_PROGRESS':
+                if self.onProgress is not None:
+                    self.onProgress()
+                continue
+            if reply.cmd in MODIFICATION_CMDS:
+                self.modifications.append(reply)
+                continue
+            if not self._pending:
+                raise MilterClientError('unexpected reply %r' % (reply,))
+            cmd, d = self._pending.popleft()
+            if cmd == 'SMFIC_OPTNEG':
+                self._negotiated(reply)
+            d.callback(reply)
+
+    def _negotiated(self, reply):
+        self.version = reply.version
+        self.actions = reply.actions
+        self.protocols = reply.protocol
+        self._noReplyCmds = NO_REPLY_CMDS.union(
+                cmd for cmd, _, noreply in OPTIONAL_CALLBACKS.values()
+                if self.protocols & noreply)
+        self._skippedCmds = frozenset(
+                cmd for cmd, nocb, _ in OPTIONAL_CALLBACKS.values()
+                if self.protocols & nocb)
+
+    def connectionLost(self, reason):
+        self.connected = 0
+        pending, self._pending = self._pending, collections.deque()
+        for _, d in pending:
+            d.errback(reason)
+        self.disconnected.callback(None)
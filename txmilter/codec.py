@@ -1,32 +1,122 @@
 import struct
 
+from . import compat
 from . import constants
+from . import message
 from .message import MilterMessage
 
 
+if compat.PY3:
+    # slicing a memoryview does not copy the bytes
+    _view = memoryview
+else:
+    # bytes cannot be joined from memoryviews on Python 2
+    def _view(b):
+        return b.tobytes() if isinstance(b, memoryview) else bytes(b)
+
+
 class MilterCodecError(Exception):
     """ Encoder/Decoder error """
 
 
 class MilterEncoder(object):
+    # command name -> _encode_* function, filled in by _buildTables()
+    _encodeTable = {}
+
     def encode(self, msg):
-        if msg.cmd not in constants.VALID_CMDS:
+        if msg.wire is not None:
+            return msg.wire
+        try:
+            method = self._encodeTable[msg.cmd]
+        except KeyError:
             raise MilterCodecError('invalid command %s' % msg.cmd)
-        method = getattr(self, '_encode_%s' % msg.cmd.lower())
-        return method(msg)
+        return method(self, msg)
+
+    def encodeReplBody(self, body, chunkSize=constants.MILTER_CHUNK_SIZE):
+        """ Encode the SMFIR_REPLBODY frames replacing the message body.
+
+            body can be a string, an iterable of strings or a file object.
+            Returns a list of alternating frame headers and payloads, to be
+            written with transport.writeSequence(). The payloads are views
+            on the strings of body (only small strings are joined), so they
+            must not be modified until written; a file object is read
+            whole.
+        """
+        seq = []
+        for frames in self.iterReplBody(body, chunkSize):
+            seq.extend(frames)
+        return seq
+
+    def iterReplBody(self, body, chunkSize=constants.MILTER_CHUNK_SIZE):
+        """ Like encodeReplBody(), but yield the frames of each chunk as
+            a [header, payload] list, reading a file object a chunk at a
+            time as they are asked for. """
+        empty = True
+        for chunk in self._bodyChunks(body, chunkSize):
+            empty = False
+            yield [struct.pack('!Ic', len(chunk) + 1, b'b'), chunk]
+        if empty:
+            yield [struct.pack('!Ic', 1, b'b')]
+
+    def _bodyChunks(self, body, size):
+        """ Yield body in chunks of size bytes, as views on its strings
+            where possible """
+        if hasattr(body, 'read'):
+            chunk = body.read(size)
+            while chunk:
+                yield self._encode_buf(chunk)
+                chunk = body.read(size)
+            return
+
+        if isinstance(body, (bytes, compat.text_type, bytearray, memoryview)):
+            body = [body]
+        # small chunks are coalesced, large ones are split
+        pending = []
+        pending_size = 0
+        for chunk in body:
+            chunk = self._bodyView(chunk)
+            if pending:
+                pending.append(chunk)
+                pending_size += len(chunk)
+                if pending_size < size:
+                    continue
+                chunk = _view(b''.join(pending))
+                pending = []
+            full = len(chunk) - len(chunk) % size
+            for i in range(0, full, size):
+                yield chunk[i:i + size]
+            if full < len(chunk):
+                pending.append(chunk[full:])
+            pending_size = len(chunk) - full
+        if pending:
+            yield b''.join(pending)
+
+    def _bodyView(self, b):
+        # a view on the bytes of b, sliced without copying them
+        if not isinstance(b, (memoryview, bytearray)):
+            b = compat.to_bytes(b)
+            if not isinstance(b, bytes):
+                raise MilterCodecError('expected string but got %r' % (b,))
+        return _view(b)
 
     def _pack(self, cmd, *args):
-        data = ''.join(args)
-        return '%s%s' % (struct.pack('!Ic', len(data) + 1, cmd), data)
+        data = b''.join(args)
+        return struct.pack('!Ic', len(data) + 1, cmd) + data
 
     def _encode_str(self, s):
-        if not isinstance(s, basestring):
-            raise MilterCodecError('expected string but got %s' % s)
-        return '%s\0' %s
+        s = compat.to_bytes(s)
+        if not isinstance(s, bytes):
+            raise MilterCodecError('expected string but got %r' % (s,))
+        return s + b'\0'
 
     def _encode_buf(self, b):
-        if not isinstance(b, basestring):
-            raise MilterCodecError('expected string but got %s' % b)
+        if isinstance(b, memoryview):
+            return b.tobytes()
+        if isinstance(b, bytearray):
+            return bytes(b)
+        b = compat.to_bytes(b)
+        if not isinstance(b, bytes):
+            raise MilterCodecError('expected string but got %r' % (b,))
         return b
 
     def _encode_u32(self, n):
@@ -43,155 +133,241 @@ class MilterEncoder(object):
 
     def _encode_char(self, c):
         try:
-            return struct.pack('c', c)
+            return struct.pack('c', compat.to_bytes(c))
         except struct.error:
-            raise MilterCodecError('error packing char %s' % c)
+            raise MilterCodecError('error packing char %r' % (c,))
 
     def _encode_3chars(self, s):
-        if not isinstance(s, basestring) or len(s) != 3:
-            raise MilterCodecError('expected string  of length 3 but got %s'
-                                   % s)
+        s = compat.to_bytes(s)
+        if not isinstance(s, bytes) or len(s) != 3:
+            raise MilterCodecError('expected string  of length 3 but got %r'
+                                   % (s,))
         return struct.pack('3s', s)
 
     def _encode_char_array(self, l):
         if len(l) == 0:
             raise MilterCodecError('got empty string array')
-        return ''.join(self._encode_str(i) for i in l)
+        return b''.join(self._encode_str(i) for i in l)
 
     def _encode_smfic_abort(self, msg):
-        return self._pack('A')
+        return self._pack(b'A')
 
     def _encode_smfic_body(self, msg):
-        return self._pack('B', self._encode_buf(msg.data.get('buf')))
+        return self._pack(b'B', self._encode_buf(msg.data.get('buf')))
 
     def _encode_smfic_connect(self, msg):
-        family = msg.data.get('family').value
-        return self._pack('C', self._encode_str(msg.data.get('hostname')),
+        data = msg.data
+        family = data.get('family').value
+        if data.get('port') is None:
+            return self._pack(b'C', self._encode_str(data.get('hostname')),
+                                   self._encode_char(family))
+        return self._pack(b'C', self._encode_str(data.get('hostname')),
                                self._encode_char(family),
-                               self._encode_u16(msg.data.get('port')),
-                               self._encode_str(msg.data.get('address')))
+                               self._encode_u16(data.get('port')),
+                               self._encode_str(data.get('address')))
 
     def _encode_smfic_macro(self, msg):
-        # TODO
-        raise NotImplementedError
+        data = msg.data
+        return self._pack(b'D', self._encode_char(data.get('cmdcode')),
+                               *[self._encode_str(i)
+                                 for i in data.get('nameval')])
 
     def _encode_smfic_bodyeob(self, msg):
-        return self._pack('E')
+        return self._pack(b'E')
 
     def _encode_smfic_helo(self, msg):
-        return self._pack('H', self._encode_str(msg.data.get('helo')))
+        return self._pack(b'H', self._encode_str(msg.data.get('helo')))
 
     def _encode_smfic_quit_nc(self, msg):
-        return self._pack('K')  # TODO: check this
+        return self._pack(b'K')  # TODO: check this
 
     def _encode_smfic_header(self, msg):
-        return self._pack('L', self._encode_str(msg.data.get('name')),
-                               self._encode_str(msg.data.get('value')))
+        data = msg.data
+        return self._pack(b'L', self._encode_str(data.get('name')),
+                               self._encode_str(data.get('value')))
 
     def _encode_smfic_mail(self, msg):
-        return self._pack('M', self._encode_char_array(msg.data.get('args')))
+        return self._pack(b'M', self._encode_char_array(msg.data.get('args')))
 
     def _encode_smfic_eoh(self, msg):
-        return self._pack('N')
+        return self._pack(b'N')
 
     def _encode_smfic_optneg(self, msg):
-        return self._pack('O', self._encode_u32(msg.data.get('version')),
-                               self._encode_u32(msg.data.get('actions')),
-                               self._encode_u32(msg.data.get('protocol')))
+        data = msg.data
+        symlists = data.get('symlists') or {}
+        return self._pack(b'O', self._encode_u32(data.get('version')),
+                               self._encode_u32(data.get('actions')),
+                               self._encode_u32(data.get('protocol')),
+                               *[self._encode_u32(stage)
+                                 + self._encode_str(b' '.join(
+                                     compat.to_bytes(n)
+                                     for n in symlists[stage]))
+                                 for stage in sorted(symlists)])
 
     def _encode_smfic_quit(self, msg):
-        return self._pack('Q')
+        return self._pack(b'Q')
 
     def _encode_smfic_rcpt(self, msg):
-        return self._pack('R', self._encode_char_array(msg.data.get('args')))
+        return self._pack(b'R', self._encode_char_array(msg.data.get('args')))
 
     def _encode_smfic_data(self, msg):
-        return self._pack('T')
+        return self._pack(b'T')
 
     def _encode_smfic_unknown(self, msg):
-        return self._pack('U')
+        return self._pack(b'U', self._encode_str(msg.data.get('data')))
 
     def _encode_smfir_addrcpt(self, msg):
-        return self._pack('+', self._encode_str(msg.data.get('rcpt')))
+        return self._pack(b'+', self._encode_str(msg.data.get('rcpt')))
 
     def _encode_smfir_delrcpt(self, msg):
-        return self._pack('-', self._encode_str(msg.data.get('rcpt')))
+        return self._pack(b'-', self._encode_str(msg.data.get('rcpt')))
 
     def _encode_smfir_addrcpt_par(self, msg):
-        return self._pack('2', self._encode_str(msg.data.get('rcpt')),
-                               self._encode_str(msg.data.get('esmpt_arg')))
+        data = msg.data
+        return self._pack(b'2', self._encode_str(data.get('rcpt')),
+                               self._encode_str(data.get('esmpt_arg')))
 
     def _encode_smfir_shutdown(self, msg):
-        return self._pack('4')
+        return self._pack(b'4')
 
     def _encode_smfir_accept(self, msg):
-        return self._pack('a')
+        return self._pack(b'a')
 
     def _encode_smfir_replbody(self, msg):
-        return self._pack('b', self._encode_buf(msg.data.get('buf')))
+        return self._pack(b'b', self._encode_buf(msg.data.get('buf')))
 
     def _encode_smfir_continue(self, msg):
-        return self._pack('c')
+        return self._pack(b'c')
 
     def _encode_smfir_discard(self, msg):
-        return self._pack('d')
+        return self._pack(b'd')
 
     def _encode_smfir_chgfrom(self, msg):
-        return self._pack('e', self._encode_str(msg.data.get('from')),
-                               self._encode_str(msg.data.get('esmtp_arg')))
+        data = msg.data
+        if data.get('esmtp_arg') is None:
+            # like libmilter, only the sender without ESMTP arguments
+            return self._pack(b'e', self._encode_str(data.get('from')))
+        return self._pack(b'e', self._encode_str(data.get('from')),
+                               self._encode_str(data.get('esmtp_arg')))
 
     def _encode_smfir_conn_fail(self, msg):
-        return self._pack('f')
+        return self._pack(b'f')
 
     def _encode_smfir_addheader(self, msg):
-        return self._pack('h', self._encode_str(msg.data.get('name')),
-                               self._encode_str(msg.data.get('value')))
+        data = msg.data
+        return self._pack(b'h', self._encode_str(data.get('name')),
+                               self._encode_str(data.get('value')))
 
     def _encode_smfir_chgheader(self, msg):
-        return self._pack('m',self._encode_u32(msg.data.get('index')),
-                              self._encode_str(msg.data.get('name')),
-                              self._encode_str(msg.data.get('value')))
+        data = msg.data
+        return self._pack(b'm',self._encode_u32(data.get('index')),
+                              self._encode_str(data.get('name')),
+                              self._encode_str(data.get('value')))
 
     def _encode_smfir_progress(self, msg):
-        return self._pack('p')
+        return self._pack(b'p')
 
     def _encode_smfir_quarantine(self, msg):
-        return self._pack('q', self._encode_str(msg.data.get('reason')))
+        return self._pack(b'q', self._encode_str(msg.data.get('reason')))
 
     def _encode_smfir_reject(self, msg):
-        return self._pack('r')
+        return self._pack(b'r')
 
     def _encode_smfir_skip(self, msg):
-        return self._pack('s')
+        return self._pack(b's')
 
     def _encode_smfir_tempfail(self, msg):
-        return self._pack('t')
+        return self._pack(b't')
 
     def _encode_smfir_replycode(self, msg):
-        return self._pack('y', self._encode_3chars(msg.data.get('smtpcode')),
-                               ' ',
-                               self._encode_str(msg.data.get('text')))
+        data = msg.data
+        return self._pack(b'y', self._encode_3chars(data.get('smtpcode')),
+                               b' ',
+                               self._encode_str(data.get('text')))
+
+
+class ConstantReply(MilterMessage):
+    """ A reply without payload whose wire encoding is computed once.
+
+        Instances are immutable, so they can be shared by all the
+        connections and written to the transport as they are.
+    """
+
+    def __init__(self, cmd):
+        if cmd not in constants.VALID_CMDS:
+            raise ValueError('invalid command %s' % cmd)
+        object.__setattr__(self, 'cmd', cmd)
+        object.__setattr__(self, 'wire', MilterEncoder().encode(self))
+
+    @property
+    def data(self):
+        return {}
+
+    def __setattr__(self, name, value):
+        raise AttributeError('%s is immutable' % self.__class__.__name__)
 
 
 class MilterDecoder(object):
+    """ Incremental decoder for milter frames.
+
+        Incoming data is appended to a single growable buffer which is
+        consumed through a read offset, so extracting frames costs
+        O(bytes received) no matter how the stream is fragmented. The
+        consumed prefix is only discarded once it is large enough to make
+        the move worthwhile.
+
+        A frame that cannot be decoded (invalid length, command or data)
+        raises MilterCodecError and is left in the buffer: the stream is
+        not to be decoded any further.
+    """
+
+    # minimum size of the consumed prefix before the buffer gets compacted
+    compactThreshold = 64 * 1024
+    # frames announcing a larger size are rejected instead of being
+    # buffered (1 MiB is the most libmilter can be told to accept)
+    maxFrameSize = 1024 * 1024
+
+    # commands whose payload is handed out as a memoryview on the buffer
+    # instead of being copied
+    _zeroCopyCmds = frozenset(['SMFIC_BODY', 'SMFIR_REPLBODY'])
+
+    # command byte -> (_decode_* function, zero copy), filled in by
+    # _buildTables()
+    _decodeTable = [None] * 256
+
     def __init__(self):
-        self._data = []
-        self._buf = ''
+        self._buf = bytearray()
+        self._pos = 0
 
     def feed(self, data):
-        self._data.append(data)
+        pos = self._pos
+        if pos and (pos == len(self._buf)
+                    or (pos >= self.compactThreshold
+                        and pos >= len(self._buf) - pos)):
+            self._compact()
+        try:
+            self._buf.extend(data)
+        except BufferError:
+            # somebody still holds a view on the current buffer (e.g. a body
+            # chunk), so it cannot be resized: move on to a fresh one
+            self._buf = self._buf[self._pos:]
+            self._pos = 0
+            self._buf.extend(data)
         return self
 
-    def _decode(self, buf, fmt):
+    def _compact(self):
         try:
-            fmt_len = struct.calcsize(fmt)
-            if len(buf) < fmt_len:
-                return None, buf
-            else:
-                return (struct.unpack(fmt, buf[:fmt_len])[0],
-                        buf[fmt_len:])
-        except Exception:
-            raise MilterCodecError('error while decoding data ("%r")' % buf)
+            del self._buf[:self._pos]
+        except BufferError:
+            self._buf = self._buf[self._pos:]
+        self._pos = 0
+
+    def _decode(self, buf, fmt):
+        fmt_len = struct.calcsize(fmt)
+        if len(buf) < fmt_len:
+            raise MilterCodecError('not enough data to decode %s (%r)'
+                                   % (fmt, buf))
+        return struct.unpack(fmt, buf[:fmt_len])[0], buf[fmt_len:]
 
     def decode(self):
         # a milter message is
@@ -199,204 +375,226 @@ class MilterDecoder(object):
         # char      cmd           Command/response code
         # char      data[len-1]   Code-specific data (may be empty)
 
-        while True:
-            length, rest = self._decode(''.join(self._data), '!I')
-            if length is None or length == 0:
-                break
+        buf = self._buf
+        view = memoryview(buf)
+        end = len(buf)
 
-            cmd, rest = self._decode(rest, 'c')
-            if cmd is None:
-                break
+        while end - self._pos >= 5:
+            pos = self._pos
+            length = struct.unpack_from('!I', buf, pos)[0]
+            if length == 0 or length > self.maxFrameSize:
+                raise MilterCodecError('invalid frame length %d' % length)
 
-            data_len = length - 1
-            if len(rest) < data_len:
+            if end - pos - 4 < length:
                 break
 
-            self._data = [rest[data_len:]]
-            data = rest[:data_len]
-
-            yield self._create_message(cmd, data)
-
-    def _create_message(self, cmd, data):
-        decoded_data = {}
-        cmds = { 'A': 'SMFIC_ABORT',
-                 'B': 'SMFIC_BODY',
-                 'C': 'SMFIC_CONNECT',
-                 'D': 'SMFIC_MACRO',
-                 'E': 'SMFIC_BODYEOB',
-                 'H': 'SMFIC_HELO',
-                 'K': 'SMFIC_QUIT_NC',
-                 'L': 'SMFIC_HEADER',
-                 'M': 'SMFIC_MAIL',
-                 'N': 'SMFIC_EOH',
-                 'O': 'SMFIC_OPTNEG',
-                 'R': 'SMFIC_RCPT',
-                 'T': 'SMFIC_DATA',
-                 'Q': 'SMFIC_QUIT',
-                 'U': 'SMFIC_UNKNOWN',
-                 '+': 'SMFIR_ADDRCPT',
-                 '-': 'SMFIR_DELRCPT',
-                 '2': 'SMFIR_ADDRCPT_PAR',
-                 '4': 'SMFIR_SHUTDOWN',
-                 'a': 'SMFIR_ACCEPT',
-                 'b': 'SMFIR_REPLBODY',
-                 'c': 'SMFIR_CONTINUE',
-                 'd': 'SMFIR_DISCARD',
-                 'e': 'SMFIR_CHGFROM',
-                 'f': 'SMFIR_CONN_FAIL',
-                 'h': 'SMFIR_ADDHEADER',
-                 'm': 'SMFIR_CHGHEADER',
-                 'p': 'SMFIR_PROGRESS',
-                 'q': 'SMFIR_QUARANTINE',
-                 'r': 'SMFIR_REJECT',
-                 's': 'SMFIR_SKIP',
-                 't': 'SMFIR_TEMPFAIL',
-                 'y': 'SMFIR_REPLYCODE',
-                }
-        command = cmds.get(cmd, None)
-        if command is None:
-            raise MilterCodecError('got invalid command %s' % cmd)
-
-        method = getattr(self, '_decode_%s_data' % command.lower())
-        decoded_data = method(data)
-
-        return MilterMessage(command, decoded_data)
+            entry = self._decodeTable[buf[pos + 4]]
+            if entry is None:
+                raise MilterCodecError('got invalid command %s'
+                                       % chr(buf[pos + 4]))
+            method, zero_copy = entry
+            data = view[pos + 5:pos + 4 + length]
+            if not zero_copy:
+                data = data.tobytes()
+
+            msg = method(self, data)
+            # the frame is consumed once decoded
+            self._pos = pos + 4 + length
+            yield msg
 
     def _decode_buf(self, data):
         return data
 
     def _decode_str(self, data):
-        return data.split('\0', 1)
+        return data.split(b'\0', 1)
+
+    def _decode_cstr(self, data):
+        # a NUL terminated string, and the data following it
+        parts = data.split(b'\0', 1)
+        if len(parts) != 2:
+            raise MilterCodecError('unterminated string %r' % (data,))
+        return parts
 
     def _decode_char(self, data):
         return data
 
     def _decode_strs(self, data, ignore_emtpy=True):
         if ignore_emtpy:
-            return list(i for i in data.split('\0') if i)
+            return list(i for i in data.split(b'\0') if i)
         else:
-            return data.split('\0')
+            return data.split(b'\0')
 
     def _decode_u16(self, data):
-        try:
-            return ( struct.unpack('!H', data[:2])[0], data[2:] )
-        except:
+        if len(data) < 2:
             raise MilterCodecError('invalid u16 data')
+        return struct.unpack('!H', data[:2])[0], data[2:]
 
-    def _decode_smfic_abort_data(self, data):
-        return {}
+    def _decode_smfic_abort(self, data):
+        return message.Abort()
 
-    def _decode_smfic_body_data(self, data):
-        return {'buf': self._decode_buf(data)}
+    def _decode_smfic_body(self, data):
+        return message.Body(self._decode_buf(data))
 
-    def _decode_smfic_connect_data(self, data):
-        hostname, rest = self._decode_str(data)
+    def _decode_smfic_connect(self, data):
+        hostname, rest = self._decode_cstr(data)
         if not rest:
             raise MilterCodecError('not enough data for connect command')
 
-        family, rest = self._decode_char(rest[0]), rest[1:]
+        family, rest = self._decode_char(rest[:1]), rest[1:]
         family = constants.ProtocolFamily.lookupByValue(family)
+        if family is constants.ProtocolFamily.SMFIA_UNKNOWN and not rest:
+            # the MTA does not know the address of the client
+            return message.Connect(hostname, family, None, None)
 
         port, rest = self._decode_u16(rest)
 
         if not rest:
             raise MilterCodecError('not enough data for connect command')
-        address, _ = self._decode_str(rest)
+        address, _ = self._decode_cstr(rest)
 
-        return dict(hostname=hostname, family=family, port=port,
-                    address=address)
+        return message.Connect(hostname, family, port, address)
 
-    def _decode_smfic_macro_data(self, data):
-        # TODO
-        cmdcode, rest = self._decode_char(data[0]), data[1:]
-        nameval = self._decode_strs(rest)
-        return {'cmdcode': cmdcode, 'nameval': nameval}
+    def _decode_smfic_macro(self, data):
+        cmdcode, rest = self._decode_char(data[:1]), data[1:]
+        # values can be empty
+        nameval = self._decode_strs(rest, ignore_emtpy=False)[:-1]
+        if len(nameval) % 2:
+            raise MilterCodecError('invalid data for macro command')
+        return message.Macro(cmdcode, nameval)
 
-    def _decode_smfic_bodyeob_data(self, data):
-        return {}
+    def _decode_smfic_bodyeob(self, data):
+        return message.BodyEob()
 
-    def _decode_smfic_helo_data(self, data):
-        return {'helo': self._decode_str(data)[0]}
+    def _decode_smfic_helo(self, data):
+        return message.Helo(self._decode_str(data)[0])
 
-    def _decode_smfic_header_data(self, data):
+    def _decode_smfic_header(self, data):
         args = self._decode_strs(data, ignore_emtpy=False)
         if len(args) < 2:
             raise MilterCodecError('invalid data for header response')
-        return dict(name=args[0], value=args[1])
+        return message.Header(args[0], args[1])
 
-    def _decode_smfic_mail_data(self, data):
-        return {'args': self._decode_strs(data)}
+    def _decode_smfic_mail(self, data):
+        return message.Mail(self._decode_strs(data))
 
-    def _decode_smfic_eoh_data(self, data):
-        return {}
+    def _decode_smfic_eoh(self, data):
+        return message.Eoh()
 
-    def _decode_smfic_rcpt_data(self, data):
-        return {'args': self._decode_strs(data)}
+    def _decode_smfic_rcpt(self, data):
+        return message.Rcpt(self._decode_strs(data))
 
-    def _decode_smfic_quit_data(self, data):
-        return {}
+    def _decode_smfic_quit(self, data):
+        return message.Quit()
 
-    def _decode_smfir_addrcpt_data(self, data):
-        return {'rcpt': self._decode_str(data)[0]}
+    def _decode_smfic_quit_nc(self, data):
+        return message.QuitNc()
 
-    def _decode_smfir_delrcpt_data(self, data):
-        return {'rcpt': self._decode_str(data)[0]}
+    def _decode_smfic_unknown(self, data):
+        return message.Unknown(self._decode_str(data)[0])
 
-    def _decode_smfir_accept_data(self, data):
-        return {}
+    def _decode_smfir_addrcpt(self, data):
+        return message.AddRcpt(self._decode_str(data)[0])
 
-    def _decode_smfir_replbody_data(self, data):
-        return {'buf': self._decode_buf(data)}
+    def _decode_smfir_delrcpt(self, data):
+        return message.DelRcpt(self._decode_str(data)[0])
 
-    def _decode_smfir_continue_data(self, data):
-        return {}
+    def _decode_smfir_addrcpt_par(self, data):
+        args = self._decode_strs(data, ignore_emtpy=False)
+        if len(args) < 2:
+            raise MilterCodecError('invalid data for addrcpt_par response')
+        return message.AddRcptPar(args[0], args[1])
 
-    def _decode_smfir_discard_data(self, data):
-        return {}
+    def _decode_smfir_shutdown(self, data):
+        return message.Shutdown()
 
-    def _decode_smfir_addheader_data(self, data):
-        args = self._decode_strs(data)
-        if len(args) != 2:
+    def _decode_smfir_accept(self, data):
+        return message.Accept()
+
+    def _decode_smfir_replbody(self, data):
+        return message.ReplBody(self._decode_buf(data))
+
+    def _decode_smfir_continue(self, data):
+        return message.Continue()
+
+    def _decode_smfir_discard(self, data):
+        return message.Discard()
+
+    def _decode_smfir_chgfrom(self, data):
+        args = self._decode_strs(data, ignore_emtpy=False)
+        if len(args) < 2:
+            raise MilterCodecError('invalid data for chgfrom response')
+        # without ESMTP arguments, only the sender is sent
+        return message.ChgFrom(args[0], args[1] if len(args) > 2 else None)
+
+    def _decode_smfir_conn_fail(self, data):
+        return message.ConnFail()
+
+    def _decode_smfir_addheader(self, data):
+        args = self._decode_strs(data, ignore_emtpy=False)
+        if len(args) < 2:
             raise MilterCodecError('invalid data for addheader response')
-        return {'name': args[0], 'value': args[1]}
+        return message.AddHeader(args[0], args[1])
 
-    def _decode_smfir_chgheader_data(self, data):
+    def _decode_smfir_chgheader(self, data):
         index, rest = self._decode(data, '!I')
-        args = self._decode_strs(rest)
-        if len(args) != 2:
+        # an empty value deletes the header
+        args = self._decode_strs(rest, ignore_emtpy=False)
+        if len(args) < 2:
             raise MilterCodecError('invalid data for chgheader response')
-        return {'index': index, 'name': args[0], 'value': args[1]}
+        return message.ChgHeader(index, args[0], args[1])
 
-    def _decode_smfir_progress_data(self, data):
-        return {}
+    def _decode_smfir_progress(self, data):
+        return message.Progress()
 
-    def _decode_smfir_quarantine_data(self, data):
+    def _decode_smfir_quarantine(self, data):
         args = self._decode_strs(data)
         if len(args) != 1:
             raise MilterCodecError('invalid data for quarantine response')
-        return {'reason': args[0]}
+        return message.Quarantine(args[0])
 
-    def _decode_smfir_reject_data(self, data):
-        return {}
+    def _decode_smfir_reject(self, data):
+        return message.Reject()
 
-    def _decode_smfir_tempfail_data(self, data):
-        return {}
+    def _decode_smfir_skip(self, data):
+        return message.Skip()
+
+    def _decode_smfir_tempfail(self, data):
+        return message.Tempfail()
 
-    def _decode_smfir_replycode_data(self, data):
+    def _decode_smfir_replycode(self, data):
         code, rest = self._decode(data, '3s')
         space, rest = self._decode(rest, 'c')
         args = self._decode_strs(rest)
         if len(args) != 1:
             raise MilterCodecError('invalid data for replycode response')
-        return {'smtpcode': code, 'text': args[0]}
+        return message.ReplyCode(code, args[0])
 
-    def _decode_smfic_optneg_data(self, data):
+    def _decode_smfic_optneg(self, data):
         version, rest = self._decode(data, '!I')
         actions, rest = self._decode(rest, '!I')
         protocol, rest = self._decode(rest, '!I')
-        return {'version': version, 'actions': actions, 'protocol': protocol}
-
-    def _decode_smfic_data_data(self, data):
-        return {}
-
-
+        if not rest:
+            return message.Optneg(version, actions, protocol)
+        symlists = {}
+        while rest:
+            stage, rest = self._decode(rest, '!I')
+            names, rest = self._decode_cstr(rest)
+            symlists[stage] = names.split()
+        return message.OptnegSymlist(version, actions, protocol, symlists)
+
+    def _decode_smfic_data(self, data):
+        return message.Data()
+
+
+def _buildTables():
+    """ Build the per-command dispatch tables of the encoder and decoder, so
+        that no lookup by name is needed while processing frames. """
+    for cmd, code in constants.CMD_CODES.items():
+        name = cmd.lower()
+        MilterEncoder._encodeTable[cmd] = vars(MilterEncoder)[
+                                                    '_encode_%s' % name]
+        MilterDecoder._decodeTable[ord(code)] = (
+                vars(MilterDecoder)['_decode_%s' % name],
+                cmd in MilterDecoder._zeroCopyCmds)
+
+_buildTables()
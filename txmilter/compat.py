@@ -0,0 +1,39 @@
+""" Python 2/3 compatibility helpers.
+
+    On the wire everything is bytes: these helpers convert text to bytes
+    when encoding and bytes to text when it is explicitly asked for.
+"""
+import sys
+import time
+
+
+PY3 = sys.version_info[0] >= 3
+
+if PY3:
+    text_type = str
+    binary_type = bytes
+    # lets undecodable bytes survive a bytes -> text -> bytes round trip
+    TEXT_ERRORS = 'surrogateescape'
+else:
+    text_type = unicode  # noqa: F821
+    binary_type = str
+    TEXT_ERRORS = 'strict'
+
+# the best clock to measure durations
+timer = getattr(time, 'perf_counter', time.time)
+
+
+def to_bytes(s, encoding='utf-8'):
+    """ Return s encoded as bytes; bytes are returned as they are """
+    if isinstance(s, text_type):
+        return s.encode(encoding, TEXT_ERRORS)
+    return s
+
+
+def to_text(b, encoding='utf-8'):
+    """ Return b decoded as text; text is returned as it is """
+    if isinstance(b, memoryview):
+        b = b.tobytes()
+    if isinstance(b, (binary_type, bytearray)):
+        return b.decode(encoding, TEXT_ERRORS)
+    return b
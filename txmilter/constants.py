@@ -1,5 +1,10 @@
-from twisted.python.constants import Values
-from twisted.python.constants import ValueConstant
+try:
+    from constantly import Values
+    from constantly import ValueConstant
+except ImportError:
+    # Twisted < 16.0 ships its own copy
+    from twisted.python.constants import Values
+    from twisted.python.constants import ValueConstant
 
 
 # actions
@@ -9,6 +14,9 @@ SMFIF_ADDRCPT = 2**2
 SMFIF_DELRCPT = 2**3
 SMFIF_CHGHDRS = 2**4
 SMFIF_QUARANTINE = 2**5
+SMFIF_CHGFROM = 2**6
+SMFIF_ADDRCPT_PAR = 2**7
+SMFIF_SETSYMLIST = 2**8
 
 # protocols
 SMFIP_NOCONNECT = 1
@@ -35,26 +43,75 @@ SMFIP_NR_BODY = 2**19
 SMFIP_HDR_LEADSPC = 2**20
 
 
-VALID_CMDS = set(['SMFIC_ABORT', 'SMFIC_BODY', 'SMFIC_CONNECT',
-                  'SMFIC_MACRO', 'SMFIC_BODYEOB', 'SMFIC_HELO',
-                  'SMFIC_QUIT_NC', 'SMFIC_HEADER', 'SMFIC_MAIL',
-                  'SMFIC_EOH', 'SMFIC_OPTNEG', 'SMFIC_RCPT', 'SMFIC_DATA',
-                  'SMFIC_QUIT', 'SMFIC_UNKNOWN',
-                  'SMFIR_ADDRCPT', 'SMFIR_DELRCPT', 'SMFIR_ADDRCPT_PAR',
-                  'SMFIR_ACCEPT', 'SMFIR_REPLBODY', 'SMFIR_CONTINUE',
-                  'SMFIR_DISCARD', 'SMFIR_CHGFROM', 'SMFIR_CONN_FAIL',
-                  'SMFIR_ADDHEADER', 'SMFIR_CHGHEADER', 'SMFIR_PROGRESS',
-                  'SMFIR_QUARANTINE', 'SMFIR_REJECT', 'SMFIR_SKIP',
-                  'SMFIR_TEMPFAIL', 'SMFIR_REPLYCODE', 'SMFIR_SHUTDOWN',
-                 ])
+# macro stages
+SMFIM_CONNECT = 0
+SMFIM_HELO = 1
+SMFIM_ENVFROM = 2
+SMFIM_ENVRCPT = 3
+SMFIM_DATA = 4
+SMFIM_EOM = 5
+SMFIM_EOH = 6
+
+# command code of the macros (SMFIC_MACRO cmdcode) -> macro stage
+MACRO_STAGES = {b'C': SMFIM_CONNECT,
+                b'H': SMFIM_HELO,
+                b'M': SMFIM_ENVFROM,
+                b'R': SMFIM_ENVRCPT,
+                b'T': SMFIM_DATA,
+                b'N': SMFIM_EOH,
+                b'E': SMFIM_EOM,
+               }
+
+
+# maximum size of the body chunks exchanged with the MTA
+MILTER_CHUNK_SIZE = 65535
+
+
+# command and response codes on the wire
+CMD_CODES = {'SMFIC_ABORT': b'A',
+             'SMFIC_BODY': b'B',
+             'SMFIC_CONNECT': b'C',
+             'SMFIC_MACRO': b'D',
+             'SMFIC_BODYEOB': b'E',
+             'SMFIC_HELO': b'H',
+             'SMFIC_QUIT_NC': b'K',
+             'SMFIC_HEADER': b'L',
+             'SMFIC_MAIL': b'M',
+             'SMFIC_EOH': b'N',
+             'SMFIC_OPTNEG': b'O',
+             'SMFIC_RCPT': b'R',
+             'SMFIC_DATA': b'T',
+             'SMFIC_QUIT': b'Q',
+             'SMFIC_UNKNOWN': b'U',
+             'SMFIR_ADDRCPT': b'+',
+             'SMFIR_DELRCPT': b'-',
+             'SMFIR_ADDRCPT_PAR': b'2',
+             'SMFIR_SHUTDOWN': b'4',
+             'SMFIR_ACCEPT': b'a',
+             'SMFIR_REPLBODY': b'b',
+             'SMFIR_CONTINUE': b'c',
+             'SMFIR_DISCARD': b'd',
+             'SMFIR_CHGFROM': b'e',
+             'SMFIR_CONN_FAIL': b'f',
+             'SMFIR_ADDHEADER': b'h',
+             'SMFIR_CHGHEADER': b'm',
+             'SMFIR_PROGRESS': b'p',
+             'SMFIR_QUARANTINE': b'q',
+             'SMFIR_REJECT': b'r',
+             'SMFIR_SKIP': b's',
+             'SMFIR_TEMPFAIL': b't',
+             'SMFIR_REPLYCODE': b'y',
+            }
+
+VALID_CMDS = set(CMD_CODES)
 
 
 class ProtocolFamily(Values):
     """ Protocol return codes for callbacks """
-    SMFIA_UNKNOWN = ValueConstant('U')
-    SMFIA_UNIX = ValueConstant('L')
-    SMFIA_INET = ValueConstant('4')
-    SMFIA_INET6 = ValueConstant('6')
+    SMFIA_UNKNOWN = ValueConstant(b'U')
+    SMFIA_UNIX = ValueConstant(b'L')
+    SMFIA_INET = ValueConstant(b'4')
+    SMFIA_INET6 = ValueConstant(b'6')
 
     @classmethod
     def lookupByName(cls, name):
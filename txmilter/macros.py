@@ -0,0 +1,77 @@
+from . import compat
+
+
+# the macro stages (command codes) in session order: the macros of a stage
+# replace the ones of the same and of the following stages; the ones sent
+# for other commands (e.g. unknown ones) go with the message
+_STAGE_ORDER = [b'C', b'H', b'M', b'R', b'T', b'L', b'N', b'B', b'E']
+_MESSAGE_STAGE = _STAGE_ORDER.index(b'M')
+
+
+def macroName(name):
+    """ Return the wire form of a macro name: names longer than one
+        character are in braces, e.g. {client_addr} """
+    name = compat.to_bytes(name)
+    if len(name) > 1 and not name.startswith(b'{'):
+        name = b'{' + name + b'}'
+    return name
+
+
+class MacroStore(object):
+    """ The macros sent by the MTA during a session, by stage (the command
+        code they were sent for).
+
+        Lookups go through a single dict merging all the stages, where the
+        macros of the latest stage win, so they are O(1).
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self._values = {}
+
+    def update(self, cmdcode, nameval):
+        """ Set the macros of stage cmdcode from a flat list of names and
+            values, forgetting the ones of the following stages """
+        self._clear(cmdcode)
+        self.stages[cmdcode] = dict(zip(nameval[::2], nameval[1::2]))
+        self._merge()
+
+    def clear(self, cmdcode=b'C'):
+        """ Forget the macros of stage cmdcode and of the following ones
+            (all of them by default). Clearing the message stage (b'M') or
+            an earlier one forgets the macros of the other commands too,
+            so only the connection and helo ones are left. """
+        self._clear(cmdcode)
+        self._merge()
+
+    def _clear(self, cmdcode):
+        if cmdcode in _STAGE_ORDER:
+            index = _STAGE_ORDER.index(cmdcode)
+            for code in _STAGE_ORDER[index:]:
+                self.stages.pop(code, None)
+            if index <= _MESSAGE_STAGE:
+                for code in list(self.stages):
+                    if code not in _STAGE_ORDER:
+                        del self.stages[code]
+        else:
+            self.stages.pop(cmdcode, None)
+
+    def _merge(self):
+        values = {}
+        for code, macros in self.stages.items():
+            if code not in _STAGE_ORDER:
+                values.update(macros)
+        for code in _STAGE_ORDER:
+            values.update(self.stages.get(code, ()))
+        self._values = values
+
+    def get(self, name, default=None):
+        """ Return the value of the macro name, e.g. 'i' or
+            '{client_addr}' (the braces can be omitted) """
+        return self._values.get(macroName(name), default)
+
+    def __contains__(self, name):
+        return macroName(name) in self._values
+
+    def __len__(self):
+        return len(self._values)
@@ -1,7 +1,40 @@
+import collections
+
+from . import compat
 from . import constants
 
 
-class MilterMessage(object):
+class Message(object):
+    """ Base class of all the milter messages.
+
+        A message has a cmd (one of constants.VALID_CMDS) and a data dict
+        with its arguments.
+    """
+    __slots__ = ()
+
+    # precomputed wire encoding, if any
+    wire = None
+
+    def __eq__(self, other):
+        if not isinstance(other, Message):
+            return NotImplemented
+        return self.cmd == other.cmd and self.data == other.data
+
+    def __ne__(self, other):
+        eq = self.__eq__(other)
+        if eq is NotImplemented:
+            return eq
+        return not eq
+
+
+class MilterMessage(Message):
+    """ Generic message keeping its arguments in a dict.
+
+        The decoder produces the lighter per-command message types defined
+        below; this class is kept for compatibility and can be used for any
+        command.
+    """
+
     def __init__(self, cmd, data=None):
         if cmd not in constants.VALID_CMDS:
             raise ValueError('invalid command %s' % cmd)
@@ -13,16 +46,103 @@ class MilterMessage(object):
 
     __repr__ = __str__
 
-    def __eq__(self, other):
-        return (self.cmd == other.cmd
-                and (sorted(self.data.iteritems())
-                     == sorted(other.data.iteritems())
-                    )
-               )
 
-    def __ne__(self, other):
-        return (self.cmd != other.cmd
-                or (sorted(self.data.iteritems())
-                    != sorted(other.data.iteritems())
-                   )
-               )
+class TypedMessage(Message):
+    """ Base class of the per-command message types.
+
+        Typed messages are namedtuples: their fields are in the same order
+        as the arguments of the corresponding MilterProtocol handler, so
+        they can be dispatched with handler(*msg).
+    """
+    __slots__ = ()
+
+    # keys of the data dict, when they differ from the field names
+    _dataKeys = None
+
+    @property
+    def data(self):
+        return dict(zip(self._dataKeys or self._fields, self))
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__,
+                           ', '.join('%s=%r' % (f, v)
+                                     for f, v in zip(self._fields, self)))
+
+    __str__ = __repr__
+
+    def __hash__(self):
+        return hash((self.cmd, tuple(self)))
+
+    def text(self, field, encoding='utf-8'):
+        """ Return field decoded as text.
+
+            Fields hold the bytes received from the wire and are only
+            decoded when asked for. Lists of strings (e.g. Mail.args) are
+            decoded item by item.
+        """
+        value = getattr(self, field)
+        if isinstance(value, list):
+            return [compat.to_text(v, encoding) for v in value]
+        return compat.to_text(value, encoding)
+
+
+def _messageType(name, cmd, fields=(), dataKeys=None):
+    base = collections.namedtuple(name, fields)
+    attrs = {'__slots__': (), '__module__': __name__, 'cmd': cmd,
+             '_dataKeys': dataKeys,
+             '__doc__': '%s message%s' % (cmd, fields and ' (%s)'
+                                          % ', '.join(fields) or '')}
+    return type(name, (TypedMessage, base), attrs)
+
+
+# commands
+Abort = _messageType('Abort', 'SMFIC_ABORT')
+Body = _messageType('Body', 'SMFIC_BODY', ['buf'])
+Connect = _messageType('Connect', 'SMFIC_CONNECT',
+                       ['hostname', 'family', 'port', 'address'])
+Macro = _messageType('Macro', 'SMFIC_MACRO', ['cmdcode', 'nameval'])
+BodyEob = _messageType('BodyEob', 'SMFIC_BODYEOB')
+Helo = _messageType('Helo', 'SMFIC_HELO', ['helo'])
+QuitNc = _messageType('QuitNc', 'SMFIC_QUIT_NC')
+Header = _messageType('Header', 'SMFIC_HEADER', ['name', 'value'])
+Mail = _messageType('Mail', 'SMFIC_MAIL', ['args'])
+Eoh = _messageType('Eoh', 'SMFIC_EOH')
+Optneg = _messageType('Optneg', 'SMFIC_OPTNEG',
+                      ['version', 'actions', 'protocol'])
+# the reply of a milter to the option negotiation may also carry the lists
+# of the macros it needs, as a dict macro stage -> list of names
+OptnegSymlist = _messageType('OptnegSymlist', 'SMFIC_OPTNEG',
+                             ['version', 'actions', 'protocol', 'symlists'])
+Rcpt = _messageType('Rcpt', 'SMFIC_RCPT', ['args'])
+Data = _messageType('Data', 'SMFIC_DATA')
+Quit = _messageType('Quit', 'SMFIC_QUIT')
+Unknown = _messageType('Unknown', 'SMFIC_UNKNOWN', ['data'])
+
+# responses
+AddRcpt = _messageType('AddRcpt', 'SMFIR_ADDRCPT', ['rcpt'])
+DelRcpt = _messageType('DelRcpt', 'SMFIR_DELRCPT', ['rcpt'])
+AddRcptPar = _messageType('AddRcptPar', 'SMFIR_ADDRCPT_PAR',
+                          ['rcpt', 'esmtp_arg'],
+                          dataKeys=['rcpt', 'esmpt_arg'])
+Shutdown = _messageType('Shutdown', 'SMFIR_SHUTDOWN')
+Accept = _messageType('Accept', 'SMFIR_ACCEPT')
+ReplBody = _messageType('ReplBody', 'SMFIR_REPLBODY', ['buf'])
+Continue = _messageType('Continue', 'SMFIR_CONTINUE')
+Discard = _messageType('Discard', 'SMFIR_DISCARD')
+ChgFrom = _messageType('ChgFrom', 'SMFIR_CHGFROM', ['from_', 'esmtp_arg'],
+                       dataKeys=['from', 'esmtp_arg'])
+ConnFail = _messageType('ConnFail', 'SMFIR_CONN_FAIL')
+AddHeader = _messageType('AddHeader', 'SMFIR_ADDHEADER', ['name', 'value'])
+ChgHeader = _messageType('ChgHeader', 'SMFIR_CHGHEADER',
+                         ['index', 'name', 'value'])
+Progress = _messageType('Progress', 'SMFIR_PROGRESS')
+Quarantine = _messageType('Quarantine', 'SMFIR_QUARANTINE', ['reason'])
+Reject = _messageType('Reject', 'SMFIR_REJECT')
+Skip = _messageType('Skip', 'SMFIR_SKIP')
+Tempfail = _messageType('Tempfail', 'SMFIR_TEMPFAIL')
+ReplyCode = _messageType('ReplyCode', 'SMFIR_REPLYCODE', ['smtpcode', 'text'])
+
+
+# command name -> message type
+MESSAGE_TYPES = dict((t.cmd, t) for t in TypedMessage.__subclasses__()
+                     if t is not OptnegSymlist)
@@ -0,0 +1,335 @@
+""" Instrumentation of milter sessions and an in-process metrics registry.
+
+    A MilterFactory created with an Instrumentation gets notified of the
+    life of its sessions: decoded frames, callbacks, replies and bytes
+    exchanged. MetricsInstrumentation records them as counters and latency
+    histograms in a MetricsRegistry, which can be exported in the
+    Prometheus text format, e.g. through MetricsResource:
+
+        factory = MilterFactory(instrumentation=MetricsInstrumentation())
+        listenMetrics(9100)
+"""
+import bisect
+
+from twisted.python import log
+from twisted.web.resource import Resource
+from twisted.web.server import Site
+
+from . import compat
+
+
+# default latency buckets, in seconds
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0,
+                   5.0, 10.0, 30.0, 60.0)
+
+
+def _formatLabels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value)
+                                          .replace('\\', '\\\\')
+                                          .replace('"', '\\"')
+                                          .replace('\n', '\\n'))
+                             for name, value in pairs)
+
+
+def _formatValue(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter(object):
+    """ A monotonically increasing value, per label values """
+    kind = 'counter'
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+
+    def inc(self, amount=1, labels=()):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def get(self, labels=()):
+        return self.values.get(labels, 0)
+
+    def samples(self):
+        for labels, value in sorted(self.values.items()):
+            yield self.name, _formatLabels(self.labelnames, labels), value
+
+
+class Gauge(Counter):
+    """ A value which can go up and down, per label values """
+    kind = 'gauge'
+
+    def dec(self, amount=1, labels=()):
+        self.inc(-amount, labels)
+
+    def set(self, value, labels=()):
+        self.values[labels] = value
+
+
+class Histogram(object):
+    """ Distribution of observed values in cumulative buckets, per label
+        values """
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # labels -> [per bucket counts..., +Inf count, sum]
+        self.values = {}
+
+    def observe(self, value, labels=()):
+        counts = self.values.get(labels)
+        if counts is None:
+            counts = self.values[labels] = [0] * (len(self.buckets) + 2)
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def count(self, labels=()):
+        counts = self.values.get(labels)
+        return sum(counts[:-1]) if counts else 0
+
+    def samples(self):
+        for labels, counts in sorted(self.values.items()):
+            total = 0
+            for bound, count in zip(self.buckets + (float('inf'),),
+                                    counts[:-1]):
+                total += count
+                yield (self.name + '_bucket',
+                       _formatLabels(self.labelnames, labels,
+                                     [('le', _formatValue(bound))]),
+                       total)
+            yield (self.name + '_sum',
+                   _formatLabels(self.labelnames, labels), counts[-1])
+            yield (self.name + '_count',
+                   _formatLabels(self.labelnames, labels), total)
+
+
+class MetricsRegistry(object):
+    """ A collection of named metrics """
+
+    def __init__(self):
+        self.metrics = {}
+
+    def _register(self, cls, name, *args, **kwargs):
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = self.metrics[name] = cls(name, *args, **kwargs)
+        elif not isinstance(metric, cls):
+            raise ValueError('metric %s already registered as %s'
+                             % (name, metric.kind))
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self._register(Counter, name, help, labelnames)
+
+    def gauge(self, name, help, labelnames=()):
+        return self._register(Gauge, name, help, labelnames)
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram, name, help, labelnames, buckets)
+
+    def snapshot(self):
+        """ Return the metrics as a JSON serializable list, to be merged in
+            another registry (e.g. of another process) """
+        return [[metric.kind, metric.name, metric.help,
+                 list(metric.labelnames), list(getattr(metric, 'buckets', ())),
+                 [[list(labels), value]
+                  for labels, value in metric.values.items()]]
+                for metric in self.metrics.values()]
+
+    def merge(self, snapshot, gauges=True):
+        """ Add the values of a snapshot() to these metrics """
+        for kind, name, help, labelnames, buckets, values in snapshot:
+            if kind == 'histogram':
+                metric = self.histogram(name, help, labelnames, buckets)
+            elif kind == 'gauge' and not gauges:
+                continue
+            else:
+                metric = getattr(self, kind)(name, help, labelnames)
+            for labels, value in values:
+                labels = tuple(labels)
+                if kind == 'histogram':
+                    counts = metric.values.setdefault(
+                            labels, [0] * (len(metric.buckets) + 2))
+                    for i, count in enumerate(value):
+                        counts[i] += count
+                else:
+                    metric.inc(value, labels)
+
+    def exposition(self):
+        """ Return the metrics in the Prometheus text format """
+        lines = []
+        for name in sorted(self.metrics):
+            metric = self.metrics[name]
+            lines.append('# HELP %s %s' % (name, metric.help))
+            lines.append('# TYPE %s %s' % (name, metric.kind))
+            for sample, labels, value in metric.samples():
+                lines.append('%s%s %s' % (sample, labels,
+                                          _formatValue(value)))
+        return '\n'.join(lines) + '\n'
+
+
+# the default registry
+REGISTRY = MetricsRegistry()
+
+
+class Instrumentation(object):
+    """ Instrumentation hooks called by MilterProtocol; they all do nothing
+        here. Durations are in seconds. """
+
+    def sessionStarted(self, proto):
+        pass
+
+    def sessionEnded(self, proto):
+        pass
+
+    def bytesReceived(self, proto, count):
+        pass
+
+    def bytesSent(self, proto, count):
+        pass
+
+    def frameDecoded(self, proto, cmd, duration):
+        pass
+
+    def callbackStarted(self, proto, cmd, queueWait):
+        """ The handler for cmd is about to run, after waiting queueWait
+            seconds for the previous replies (see
+            MilterProtocol.barrierCmds). """
+
+    def callbackFinished(self, proto, cmd, duration, failed):
+        """ The handler for cmd (or the Deferred it returned) finished. """
+
+    def replySent(self, proto, cmd, reply):
+        """ reply, the result of the handler for cmd, has been sent. """
+
+    def progressSent(self, proto, cmd):
+        """ A keepalive was sent while the handler for cmd was pending. """
+
+    def deadlineExpired(self, proto, cmd):
+        """ The handler for cmd missed its deadline (see
+            MilterProtocol.callbackDeadline). """
+
+    def commandShed(self, proto, cmd, reason):
+        """ cmd was replied without running its handler, because of the
+            limits of the admission control (see txmilter.admission). """
+
+
+class MetricsInstrumentation(Instrumentation):
+    """ Records the life of the milter sessions in a MetricsRegistry.
+
+        Callbacks running longer than slowCallback seconds are also logged,
+        with their session id.
+    """
+
+    def __init__(self, registry=REGISTRY, slowCallback=None):
+        self.registry = registry
+        self.slowCallback = slowCallback
+        self.sessions = registry.counter(
+                'txmilter_sessions_total', 'Milter sessions started')
+        self.activeSessions = registry.gauge(
+                'txmilter_sessions_active', 'Milter sessions in progress')
+        self.received = registry.counter(
+                'txmilter_received_bytes_total', 'Bytes received from MTAs')
+        self.sent = registry.counter(
+                'txmilter_sent_bytes_total', 'Bytes sent to MTAs')
+        self.decode = registry.histogram(
+                'txmilter_decode_seconds', 'Time spent decoding a frame',
+                buckets=(1e-6, 5e-6, 1e-5, 5e-5, 1e-4, 5e-4, 1e-3))
+        self.inFlight = registry.gauge(
+                'txmilter_callbacks_in_flight', 'Callbacks running')
+        self.queueWait = registry.histogram(
+                'txmilter_queue_wait_seconds',
+                'Time commands waited for the previous replies',
+                ['command'])
+        self.callbacks = registry.histogram(
+                'txmilter_callback_seconds', 'Duration of the callbacks',
+                ['command'])
+        self.errors = registry.counter(
+                'txmilter_callback_errors_total', 'Failed callbacks',
+                ['command'])
+        self.replies = registry.counter(
+                'txmilter_replies_total', 'Replies sent, by command',
+                ['command', 'reply'])
+        self.keepalives = registry.counter(
+                'txmilter_progress_total', 'Keepalives sent, by command',
+                ['command'])
+        self.expired = registry.counter(
+                'txmilter_deadlines_expired_total',
+                'Callbacks which missed their deadline', ['command'])
+        self.shed = registry.counter(
+                'txmilter_shed_total',
+                'Commands replied without running their callback, by '
+                'command and admission limit', ['command', 'reason'])
+
+    def sessionStarted(self, proto):
+        self.sessions.inc()
+        self.activeSessions.inc()
+
+    def sessionEnded(self, proto):
+        self.activeSessions.dec()
+
+    def bytesReceived(self, proto, count):
+        self.received.inc(count)
+
+    def bytesSent(self, proto, count):
+        self.sent.inc(count)
+
+    def frameDecoded(self, proto, cmd, duration):
+        self.decode.observe(duration)
+
+    def callbackStarted(self, proto, cmd, queueWait):
+        self.inFlight.inc()
+        self.queueWait.observe(queueWait, (cmd,))
+
+    def callbackFinished(self, proto, cmd, duration, failed):
+        self.inFlight.dec()
+        self.callbacks.observe(duration, (cmd,))
+        if failed:
+            self.errors.inc(labels=(cmd,))
+        if self.slowCallback is not None and duration > self.slowCallback:
+            log.msg('session %s: slow %s callback (%.3fs)'
+                    % (getattr(proto, 'id', None), cmd, duration))
+
+    def replySent(self, proto, cmd, reply):
+        self.replies.inc(labels=(cmd, reply.cmd))
+
+    def progressSent(self, proto, cmd):
+        self.keepalives.inc(labels=(cmd,))
+
+    def deadlineExpired(self, proto, cmd):
+        self.expired.inc(labels=(cmd,))
+
+    def commandShed(self, proto, cmd, reason):
+        self.shed.inc(labels=(cmd, reason))
+
+
+class MetricsResource(Resource):
+    """ Serves a MetricsRegistry in the Prometheus text format """
+    isLeaf = True
+
+    def __init__(self, registry=REGISTRY):
+        Resource.__init__(self)
+        self.registry = registry
+
+    def render_GET(self, request):
+        request.setHeader(b'content-type',
+                          b'text/plain; version=0.0.4; charset=utf-8')
+        return compat.to_bytes(self.registry.exposition())
+
+
+def listenMetrics(port, registry=REGISTRY, interface='127.0.0.1',
+                  reactor=None):
+    """ Serve registry over HTTP on interface:port """
+    if reactor is None:
+        from twisted.internet import reactor
+    return reactor.listenTCP(port, Site(MetricsResource(registry)),
+                             interface=interface)
@@ -0,0 +1,173 @@
+""" Running blocking or CPU bound milter handlers out of the reactor thread.
+
+    Handlers decorated with offload() run in a bounded thread pool, so a
+    slow regex scan or a synchronous lookup does not stall the other
+    sessions:
+
+        scanners = ThreadOffloadPool(size=8, maxQueue=100)
+
+        class MyMilter(MilterProtocol):
+            @offload(scanners)
+            def onEom(self):
+                if scan(self.body):
+                    self.addHeader(b'X-Spam', b'yes')
+                return ACCEPT
+
+    Their result is delivered back to the reactor thread, and the
+    modification methods (addHeader, replaceBody...) can be called from
+    them. When more than size + maxQueue handlers are pending, new ones are
+    not run and the fallback verdict (TEMPFAIL by default) is replied.
+
+    CPU bound work can go to a ProcessOffloadPool instead, submitting
+    picklable functions from the handlers:
+
+        def onEom(self):
+            d = scanners.submit(scan, self.body)
+            d.addCallback(lambda spam: REJECT if spam else ACCEPT)
+            d.addErrback(rejected, TEMPFAIL)
+            return d
+"""
+import functools
+
+from twisted.internet import defer, threads
+from twisted.python import threadpool
+
+from .protocol import TEMPFAIL
+from .protocol import _offloadState
+
+
+class PoolFull(Exception):
+    """ The pool has too many tasks pending """
+
+
+def rejected(failure, fallback=TEMPFAIL):
+    """ Errback returning fallback when a pool rejected a task """
+    failure.trap(PoolFull)
+    return fallback
+
+
+class _OffloadPool(object):
+    # at most size tasks run at the same time, and at most maxQueue more
+    # wait for their turn (no limit if None)
+
+    def __init__(self, size, maxQueue=None, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.size = size
+        self.maxQueue = maxQueue
+        # tasks running or queued
+        self.pending = 0
+        # tasks rejected since the pool was created
+        self.rejected = 0
+        self._started = False
+
+    @property
+    def full(self):
+        return (self.maxQueue is not None
+                and self.pending >= self.size + self.maxQueue)
+
+    def submit(self, func, *args, **kwargs):
+        """ Run func(*args, **kwargs) in the pool, returning a Deferred
+            firing with its result in the reactor thread. The Deferred
+            fails with PoolFull if the pool is full. """
+        if self.full:
+            self.rejected += 1
+            return defer.fail(PoolFull('%d tasks pending' % self.pending))
+        if not self._started:
+            self._started = True
+            self._start()
+            self.reactor.addSystemEventTrigger('during', 'shutdown',
+                                               self.stop)
+        self.pending += 1
+        d = self._submit(func, args, kwargs)
+        d.addBoth(self._done)
+        return d
+
+    def _done(self, result):
+        self.pending -= 1
+        return result
+
+    def stop(self):
+        """ Stop the pool, waiting for the running tasks """
+        if self._started:
+            self._started = False
+            self._stop()
+
+
+class ThreadOffloadPool(_OffloadPool):
+    """ A pool of at most size threads """
+
+    def __init__(self, size=4, maxQueue=None, name=None, reactor=None):
+        _OffloadPool.__init__(self, size, maxQueue, reactor)
+        self.threadpool = threadpool.ThreadPool(0, size, name=name)
+
+    def _start(self):
+        self.threadpool.start()
+
+    def _stop(self):
+        self.threadpool.stop()
+
+    def _submit(self, func, args, kwargs):
+        return threads.deferToThreadPool(self.reactor, self.threadpool,
+                                         self._run, func, args, kwargs)
+
+    def _run(self, func, args, kwargs):
+        _offloadState.reactor = self.reactor
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _offloadState.reactor = None
+
+
+class ProcessOffloadPool(_OffloadPool):
+    """ A pool of at most size processes (by default, one per core).
+
+        The submitted functions and their arguments and results must be
+        picklable. Requires concurrent.futures (Python 3, or the futures
+        backport on Python 2).
+    """
+
+    def __init__(self, size=None, maxQueue=None, reactor=None):
+        from concurrent import futures
+        self._executorClass = futures.ProcessPoolExecutor
+        self.executor = None
+        if size is None:
+            import multiprocessing
+            size = multiprocessing.cpu_count()
+        _OffloadPool.__init__(self, size, maxQueue, reactor)
+
+    def _start(self):
+        self.executor = self._executorClass(self.size)
+
+    def _stop(self):
+        self.executor.shutdown(wait=True)
+        self.executor = None
+
+    def _submit(self, func, args, kwargs):
+        d = defer.Deferred()
+        future = self.executor.submit(func, *args, **kwargs)
+        future.add_done_callback(
+                lambda f: self.reactor.callFromThread(self._resolve, f, d))
+        return d
+
+    def _resolve(self, future, d):
+        try:
+            result = future.result()
+        except Exception as e:
+            d.errback(e)
+        else:
+            d.callback(result)
+
+
+def offload(pool, fallback=TEMPFAIL):
+    """ Decorator running a MilterProtocol handler in a ThreadOffloadPool,
+        replying fallback when the pool is full. """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args):
+            d = pool.submit(method, self, *args)
+            d.addErrback(rejected, fallback)
+            return d
+        return wrapper
+    return decorator
@@ -0,0 +1,384 @@
+""" Pre-fork multi-process mode, to use more than one core.
+
+    A master process binds the listening socket and runs N worker
+    processes, each one accepting connections on the shared socket with
+    its own reactor and its own instance of the milter factory:
+
+        python -m txmilter.prefork --listen tcp:8888 --workers 4 \\
+            --max-sessions 10000 --metrics-port 9100 mypackage.milter.factory
+
+    The factory is given by its fully qualified name, and is either a
+    MilterFactory or a callable returning one. Workers exiting, or retiring
+    after --max-sessions sessions, are replaced. On SIGHUP the master starts
+    a new set of workers (which import the milter code again) and
+    gracefully stops the old ones: workers being stopped close the
+    listening socket and exit once their sessions are over, or after
+    --drain-timeout seconds. SIGTERM and SIGINT stop the master and its
+    workers the same way.
+
+    Workers periodically send a snapshot of their metrics to the master
+    (on a pipe of their own: their standard output is the master's), which
+    serves the sum of them with --metrics-port.
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import multiprocessing
+import os
+import signal
+import socket
+import stat
+import sys
+import time
+
+from twisted.internet import defer, error, protocol, task
+from twisted.internet.protocol import Factory
+from twisted.protocols import policies
+from twisted.python import log, reflect
+
+from . import metrics
+
+
+# file descriptor of the listening socket in the workers
+WORKER_FD = 3
+# file descriptor of the pipe the workers send their metrics to
+METRICS_FD = 4
+
+# the import path of the workers: the one of the master, made absolute
+# before anything can change the working directory
+_workerPath = os.pathsep.join(os.path.abspath(p) for p in sys.path)
+
+
+def listenSocket(address, backlog=50):
+    """ Return a listening socket for address, either tcp:PORT[:INTERFACE]
+        or unix:PATH """
+    kind, _, rest = address.partition(':')
+    if kind == 'unix':
+        if os.path.exists(rest) and stat.S_ISSOCK(os.stat(rest).st_mode):
+            os.unlink(rest)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(rest)
+    elif kind == 'tcp':
+        port, _, interface = rest.partition(':')
+        family = socket.AF_INET6 if ':' in interface else socket.AF_INET
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((interface, int(port)))
+    else:
+        raise ValueError('invalid address %r' % address)
+    sock.listen(backlog)
+    sock.setblocking(False)
+    return sock
+
+
+def loadFactory(name):
+    """ Return the factory named name, calling it if it is not a Factory """
+    obj = reflect.namedAny(name)
+    if isinstance(obj, Factory):
+        return obj
+    return obj()
+
+
+class _SessionsFactory(policies.WrappingFactory):
+    # tells the worker about the sessions starting and ending
+    def __init__(self, wrappedFactory, worker):
+        policies.WrappingFactory.__init__(self, wrappedFactory)
+        self.worker = worker
+
+    def registerProtocol(self, p):
+        policies.WrappingFactory.registerProtocol(self, p)
+        self.worker.sessionStarted()
+
+    def unregisterProtocol(self, p):
+        policies.WrappingFactory.unregisterProtocol(self, p)
+        self.worker.sessionEnded()
+
+
+class Worker(object):
+    """ Serves a milter factory in a worker process.
+
+        done fires once the worker retired: it stopped listening and its
+        sessions are over. Metrics snapshots are written to out as JSON
+        lines, every metricsInterval seconds and when done.
+    """
+
+    def __init__(self, factory, maxSessions=None, drainTimeout=30,
+                 metricsInterval=5, out=None, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.milterFactory = factory
+        self.factory = _SessionsFactory(factory, self)
+        self.maxSessions = maxSessions
+        self.drainTimeout = drainTimeout
+        self.out = out
+        self.sessions = 0
+        self.retiring = False
+        self.port = None
+        self.done = defer.Deferred()
+        self._reporter = task.LoopingCall(self.report)
+        self._reporter.clock = reactor
+        self._drainCall = None
+        if out is not None:
+            self._reporter.start(metricsInterval, now=False)
+
+    def listen(self, fd, family):
+        """ Accept connections on the listening socket fd """
+        self.port = self.reactor.adoptStreamPort(fd, family, self.factory)
+        os.close(fd)
+
+    @property
+    def registry(self):
+        instrumentation = getattr(self.milterFactory, 'instrumentation',
+                                  None)
+        return getattr(instrumentation, 'registry', metrics.REGISTRY)
+
+    def report(self):
+        if self.out is not None:
+            self.out.write(json.dumps({'sessions': self.sessions,
+                                       'metrics': self.registry.snapshot()})
+                           + '\n')
+            self.out.flush()
+
+    def sessionStarted(self):
+        self.sessions += 1
+        if self.maxSessions and self.sessions >= self.maxSessions:
+            self.retire()
+
+    def sessionEnded(self):
+        if self.retiring and not self.factory.protocols:
+            self._exit()
+
+    def retire(self):
+        """ Stop accepting connections, and exit once the current sessions
+            are over """
+        if self.retiring:
+            return
+        self.retiring = True
+        if self.port is not None:
+            self.port.stopListening()
+        if self.factory.protocols:
+            self._drainCall = self.reactor.callLater(self.drainTimeout,
+                                                     self._abort)
+        else:
+            self._exit()
+
+    def _abort(self):
+        self._drainCall = None
+        for p in list(self.factory.protocols):
+            p.transport.abortConnection()
+        self._exit()
+
+    def _exit(self):
+        if self.done.called:
+            return
+        if self._drainCall is not None:
+            self._drainCall.cancel()
+        if self._reporter.running:
+            self._reporter.stop()
+        self.report()
+        self.done.callback(self.sessions)
+
+
+class _WorkerProcess(protocol.ProcessProtocol):
+    def __init__(self, master, generation):
+        self.master = master
+        self.generation = generation
+        self.started = time.time()
+        # the transport forgets it once the process exited
+        self.pid = None
+        self.metrics = []
+        self.sessions = 0
+        self._buffer = b''
+
+    def childDataReceived(self, childFD, data):
+        if childFD != METRICS_FD:
+            return
+        lines = (self._buffer + data).split(b'\n')
+        self._buffer = lines.pop()
+        for line in lines:
+            report = json.loads(line.decode('utf-8'))
+            self.sessions = report['sessions']
+            self.metrics = report['metrics']
+
+    def terminate(self):
+        try:
+            self.transport.signalProcess('TERM')
+        except error.ProcessExitedAlready:
+            pass
+
+    def processEnded(self, reason):
+        self.master.workerExited(self, reason)
+
+
+class Master(object):
+    """ Runs and supervises the worker processes serving factoryName on
+        address (see listenSocket).
+
+        done fires once the master has been stopped and all of its workers
+        exited.
+    """
+
+    # workers living less than this are restarted after it, to avoid
+    # restarting broken workers in a loop
+    respawnDelay = 1.0
+
+    def __init__(self, factoryName, address, workers=None, maxSessions=None,
+                 drainTimeout=30, metricsInterval=5, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.factoryName = factoryName
+        self.address = address
+        self.workerCount = workers or multiprocessing.cpu_count()
+        self.maxSessions = maxSessions
+        self.drainTimeout = drainTimeout
+        self.metricsInterval = metricsInterval
+        self.workers = set()
+        self.generation = 0
+        self.stopping = False
+        self.socket = None
+        self.done = defer.Deferred()
+        # metrics of the exited workers
+        self._retired = metrics.MetricsRegistry()
+
+    def start(self):
+        # fail early if the factory cannot be loaded
+        loadFactory(self.factoryName)
+        self.socket = listenSocket(self.address)
+        for _ in range(self.workerCount):
+            self._spawn()
+
+    def _spawn(self):
+        proc = _WorkerProcess(self, self.generation)
+        args = [sys.executable, '-m', 'txmilter.prefork', '--worker',
+                '--family', str(int(self.socket.family)),
+                '--drain-timeout', str(self.drainTimeout),
+                '--metrics-interval', str(self.metricsInterval)]
+        if self.maxSessions:
+            args += ['--max-sessions', str(self.maxSessions)]
+        args.append(self.factoryName)
+        # the workers import the factory from the same path as the master
+        env = dict(os.environ, PYTHONPATH=_workerPath)
+        process = self.reactor.spawnProcess(
+                proc, sys.executable, args, env=env,
+                childFDs={1: 1, 2: 2, WORKER_FD: self.socket.fileno(),
+                          METRICS_FD: 'r'})
+        proc.pid = process.pid
+        self.workers.add(proc)
+
+    def reload(self):
+        """ Replace all the workers with new ones """
+        log.msg('reloading workers')
+        self.generation += 1
+        old = list(self.workers)
+        for _ in range(self.workerCount):
+            self._spawn()
+        for proc in old:
+            proc.terminate()
+
+    def stop(self):
+        """ Stop all the workers, once their sessions are over """
+        self.stopping = True
+        for proc in list(self.workers):
+            proc.terminate()
+        if not self.workers:
+            self._stopped()
+        return self.done
+
+    def workerExited(self, proc, reason):
+        self.workers.discard(proc)
+        self._retired.merge(proc.metrics, gauges=False)
+        if self.stopping:
+            if not self.workers:
+                self._stopped()
+        elif proc.generation == self.generation:
+            log.msg('worker %s exited after %d sessions: %s'
+                    % (proc.pid, proc.sessions,
+                       reason.getErrorMessage()))
+            if time.time() - proc.started < self.respawnDelay:
+                self.reactor.callLater(self.respawnDelay, self._respawn)
+            else:
+                self._spawn()
+
+    def _respawn(self):
+        if not self.stopping:
+            self._spawn()
+
+    def _stopped(self):
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+        if not self.done.called:
+            self.done.callback(None)
+
+    def registry(self):
+        """ Return a registry with the sum of the metrics of the workers """
+        registry = metrics.MetricsRegistry()
+        registry.merge(self._retired.snapshot())
+        for proc in self.workers:
+            registry.merge(proc.metrics)
+        registry.gauge('txmilter_workers', 'Worker processes running').set(
+                len(self.workers))
+        return registry
+
+    def exposition(self):
+        return self.registry().exposition()
+
+
+def _onSignal(reactor, signum, func):
+    signal.signal(signum, lambda *args: reactor.callFromThread(func))
+
+
+def main(reactor, *argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('factory', help='fully qualified name of the '
+                        'milter factory, or of a callable returning it')
+    parser.add_argument('--listen', default='tcp:8888',
+                        help='tcp:PORT[:INTERFACE] or unix:PATH '
+                        '(default tcp:8888)')
+    parser.add_argument('--workers', type=int,
+                        help='worker processes (default: one per core)')
+    parser.add_argument('--max-sessions', type=int,
+                        help='replace workers after this many sessions')
+    parser.add_argument('--drain-timeout', type=float, default=30,
+                        help='seconds stopping workers wait for their '
+                        'sessions (default 30)')
+    parser.add_argument('--metrics-port', type=int,
+                        help='serve the metrics of all the workers on '
+                        '127.0.0.1:PORT')
+    parser.add_argument('--metrics-interval', type=float, default=5,
+                        help=argparse.SUPPRESS)
+    parser.add_argument('--worker', action='store_true',
+                        help=argparse.SUPPRESS)
+    parser.add_argument('--family', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    log.startLogging(sys.stderr, setStdout=False)
+
+    if args.worker:
+        worker = Worker(loadFactory(args.factory), args.max_sessions,
+                        args.drain_timeout, args.metrics_interval,
+                        out=os.fdopen(METRICS_FD, 'w'), reactor=reactor)
+        worker.listen(WORKER_FD, args.family)
+        reactor.callWhenRunning(_onSignal, reactor, signal.SIGTERM,
+                                worker.retire)
+        reactor.callWhenRunning(signal.signal, signal.SIGINT,
+                                signal.SIG_IGN)
+        return worker.done
+
+    master = Master(args.factory, args.listen, args.workers,
+                    args.max_sessions, args.drain_timeout,
+                    args.metrics_interval, reactor=reactor)
+    master.start()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        reactor.callWhenRunning(_onSignal, reactor, signum, master.stop)
+    reactor.callWhenRunning(_onSignal, reactor, signal.SIGHUP,
+                            master.reload)
+    if args.metrics_port:
+        metrics.listenMetrics(args.metrics_port, master, reactor=reactor)
+    return master.done
+
+
+if __name__ == '__main__':
+    task.react(main, sys.argv[1:])
@@ -1,29 +1,235 @@
+import collections
 import itertools
+import threading
 
 from twisted.internet.protocol import Factory, Protocol
-from twisted.internet import defer
+from twisted.internet import defer, task
+from twisted.python import log
+from twisted.python.failure import Failure
 
-from .message import MilterMessage
+from . import compat
+from . import constants
+from . import message
 from .codec import MilterEncoder
 from .codec import MilterDecoder
-
-
-ACCEPT = MilterMessage(cmd='SMFIR_ACCEPT')
-CONTINUE = MilterMessage(cmd='SMFIR_CONTINUE')
-REJECT = MilterMessage(cmd='SMFIR_REJECT')
-DISCARD = MilterMessage(cmd='SMFIR_DISCARD')
-TEMPFAIL = MilterMessage(cmd='SMFIR_TEMPFAIL')
-SKIP = MilterMessage(cmd='SMFIR_SKIP')
-CONN_FAIL = MilterMessage('SMFIR_CONN_FAIL')
-SHUTDOWN = MilterMessage('SMFIR_SHUTDOWN')
-
-
-class MilterProtocol(Protocol):
-    def connectionMade(self):
+from .codec import ConstantReply
+from .macros import MacroStore
+from .macros import macroName
+
+
+ACCEPT = ConstantReply('SMFIR_ACCEPT')
+CONTINUE = ConstantReply('SMFIR_CONTINUE')
+REJECT = ConstantReply('SMFIR_REJECT')
+DISCARD = ConstantReply('SMFIR_DISCARD')
+TEMPFAIL = ConstantReply('SMFIR_TEMPFAIL')
+SKIP = ConstantReply('SMFIR_SKIP')
+CONN_FAIL = ConstantReply('SMFIR_CONN_FAIL')
+SHUTDOWN = ConstantReply('SMFIR_SHUTDOWN')
+PROGRESS = ConstantReply('SMFIR_PROGRESS')
+
+
+# commands the MTA never waits a reply for
+NO_REPLY_CMDS = frozenset(['SMFIC_MACRO', 'SMFIC_ABORT', 'SMFIC_QUIT',
+                           'SMFIC_QUIT_NC'])
+
+# handlers the MTA can be told not to call, or not to wait a reply from:
+# handler name -> (command, SMFIP_NO* flag, SMFIP_NR_* flag)
+OPTIONAL_CALLBACKS = {
+    'onConnect': ('SMFIC_CONNECT', constants.SMFIP_NOCONNECT,
+                  constants.SMFIP_NR_CONN),
+    'onHelo': ('SMFIC_HELO', constants.SMFIP_NOHELO, constants.SMFIP_NR_HELO),
+    'onMail': ('SMFIC_MAIL', constants.SMFIP_NOMAIL, constants.SMFIP_NR_MAIL),
+    'onRcpt': ('SMFIC_RCPT', constants.SMFIP_NORCPT, constants.SMFIP_NR_RCPT),
+    'onData': ('SMFIC_DATA', constants.SMFIP_NODATA, constants.SMFIP_NR_DATA),
+    'onUnknown': ('SMFIC_UNKNOWN', constants.SMFIP_NOUNKNOWN,
+                  constants.SMFIP_NR_UNKN),
+    'onHeader': ('SMFIC_HEADER', constants.SMFIP_NOHDRS,
+                 constants.SMFIP_NR_HDR),
+    'onEoh': ('SMFIC_EOH', constants.SMFIP_NOEOH, constants.SMFIP_NR_EOH),
+    'onBody': ('SMFIC_BODY', constants.SMFIP_NOBODY, constants.SMFIP_NR_BODY),
+}
+
+
+# command -> name of its handler
+HANDLERS = {'SMFIC_ABORT': 'onAbort',
+            'SMFIC_BODY': 'onBody',
+            'SMFIC_CONNECT': 'onConnect',
+            'SMFIC_MACRO': 'onMacro',
+            'SMFIC_BODYEOB': 'onEom',
+            'SMFIC_HELO': 'onHelo',
+            'SMFIC_QUIT_NC': 'onQuitNewConnection',
+            'SMFIC_HEADER': 'onHeader',
+            'SMFIC_MAIL': 'onMail',
+            'SMFIC_EOH': 'onEoh',
+            'SMFIC_OPTNEG': 'onOptneg',
+            'SMFIC_RCPT': 'onRcpt',
+            'SMFIC_DATA': 'onData',
+            'SMFIC_QUIT': 'onQuit',
+            'SMFIC_UNKNOWN': 'onUnknown',
+           }
+
+
+# modification -> action it needs to be negotiated
+MODIFICATION_ACTIONS = {'SMFIR_ADDHEADER': constants.SMFIF_ADDHDRS,
+                        'SMFIR_CHGHEADER': constants.SMFIF_CHGHDRS,
+                        'SMFIR_ADDRCPT': constants.SMFIF_ADDRCPT,
+                        'SMFIR_ADDRCPT_PAR': constants.SMFIF_ADDRCPT_PAR,
+                        'SMFIR_DELRCPT': constants.SMFIF_DELRCPT,
+                        'SMFIR_QUARANTINE': constants.SMFIF_QUARANTINE,
+                        'SMFIR_CHGFROM': constants.SMFIF_CHGFROM,
+                        'SMFIR_REPLBODY': constants.SMFIF_CHGBODY,
+                       }
+
+# replies after which the MTA ignores the modifications of the message
+_DISCARDING_VERDICTS = frozenset(['SMFIR_REJECT', 'SMFIR_TEMPFAIL',
+                                  'SMFIR_DISCARD'])
+
+
+def _modificationKey(msg):
+    # modifications with the same key override each other
+    cmd = msg.cmd
+    if cmd == 'SMFIR_CHGHEADER':
+        data = msg.data
+        return (cmd, data['name'].lower(), data['index'])
+    elif cmd in ('SMFIR_ADDRCPT', 'SMFIR_ADDRCPT_PAR', 'SMFIR_DELRCPT'):
+        return (cmd == 'SMFIR_DELRCPT', msg.data['rcpt'])
+    elif cmd in ('SMFIR_QUARANTINE', 'SMFIR_CHGFROM'):
+        return cmd
+    return None
+
+
+def coalesceModifications(modifications):
+    """ Return modifications without the ones overridden by later ones:
+        changes of the same header, additions or removals of the same
+        recipient, quarantines and sender changes. Body chunks (iterables
+        of encoded frames) and added headers are all kept. """
+    seen = set()
+    kept = []
+    for item in reversed(modifications):
+        if isinstance(item, message.Message):
+            key = _modificationKey(item)
+            if key is not None:
+                if key in seen:
+                    continue
+                seen.add(key)
+        kept.append(item)
+    kept.reverse()
+    return kept
+
+
+def noreply(func):
+    """ Decorator for handlers which always continue: the MTA is asked not
+        to wait for their reply, and none is sent. """
+    func.milter_protocol = OPTIONAL_CALLBACKS[func.__name__][2]
+    return func
+
+
+def nocallback(func):
+    """ Decorator for handlers which must not be called at all, even if
+        overridden. """
+    func.milter_protocol = OPTIONAL_CALLBACKS[func.__name__][1]
+    return func
+
+
+# (protocol class, whether macros are used) -> its protocol_mask()
+_protocolMasks = {}
+
+
+class _OffloadState(threading.local):
+    # the reactor of the pool running an offloaded handler in this thread
+    # (see txmilter.offload), if any
+    reactor = None
+
+
+_offloadState = _OffloadState()
+
+
+class _Watch(object):
+    # the keepalives and the deadline of a pending handler
+
+    keepalive = None
+    deadline = None
+
+    def stop(self):
+        if self.keepalive is not None and self.keepalive.running:
+            self.keepalive.stop()
+        if self.deadline is not None and self.deadline.active():
+            self.deadline.cancel()
+
+
+def _func(method):
+    return getattr(method, '__func__', method)
+
+
+class MilterSession(object):
+    """ What a milter session does regardless of its transport: option
+        negotiation, default handlers, modifications, macros and the queue
+        of the replies, written in command order.
+
+        Front-ends (MilterProtocol on Twisted, txmilter.aio on asyncio)
+        call _startSession() once connected, feed the decoded commands to
+        _received() and implement _dispatch(), which calls
+        commandReceived(), runs the handler of a command and passes its
+        result to _handlerDone(), as well as _writeSequence() and
+        _logMsg().
+    """
+
+    # commands whose handler only runs once the replies to all the previous
+    # commands have been sent, since they depend on the whole message (or
+    # session) having been processed
+    barrierCmds = frozenset(['SMFIC_OPTNEG', 'SMFIC_BODYEOB', 'SMFIC_ABORT',
+                             'SMFIC_QUIT', 'SMFIC_QUIT_NC'])
+    # macro stage (constants.SMFIM_*) -> names of the macros the MTA has to
+    # send for it, if it supports symbol lists (see setsymlist)
+    symbolList = None
+    # whether the macros of all the stages are wanted (see getsymval)
+    useMacros = False
+    # replied to the MTA when a handler fails
+    failureVerdict = TEMPFAIL
+
+    # instrumentation hooks and session recorder (only on Twisted)
+    _instr = None
+    _recorder = None
+
+    def _startSession(self):
         self.id = self.factory.getId()
-
-    def connectionLost(self, reason):
-        pass
+        self.decoder = MilterDecoder()
+        # negotiated protocol options, and actions (None: not negotiated)
+        self.protocols = 0
+        self.actions = None
+        # modifications to send with the reply to eom, and whether they
+        # can be requested (onEom is running)
+        self._modifications = []
+        self._inEom = False
+        self._noReplyCmds = NO_REPLY_CMDS
+        # command name -> bound handler, resolved once per connection
+        self._handlers = dict((cmd, getattr(self, name, None))
+                              for cmd, name
+                              in self.factory.handlerMap.items())
+        self._handlers['SMFIC_MACRO'] = self._macroReceived
+        self._handlers['SMFIC_BODYEOB'] = self._eomReceived
+        self._handlers['SMFIC_ABORT'] = self._abortReceived
+        self._handlers['SMFIC_QUIT_NC'] = self._quitNcReceived
+        self._unknownHandler = getattr(self, 'onUnknown', None)
+        # macros received in the session, and the ones to ask for
+        self.macros = MacroStore()
+        self._symlists = dict((stage, [macroName(n) for n in names])
+                              for stage, names
+                              in (self.symbolList or {}).items())
+        # one [done, result, command, started, size] slot per dispatched
+        # command, in command order (started is None without
+        # instrumentation, size without admission control)
+        self._replies = collections.deque()
+        # (command, queued at, size) waiting for a barrier to be lifted
+        self._backlog = collections.deque()
+        self._draining = False
+        # Deferreds of whenIdle(), fired once no command is pending
+        self._idle = []
+
+    def _stopSession(self):
+        self._replies.clear()
+        self._backlog.clear()
+        self._notifyIdle()
 
     def onConnect(self, hostname, family, port, address):
         """ Called for each connection to the MTA. """
@@ -39,10 +245,17 @@ class MilterProtocol(Protocol):
         self._mta_protocols = protocol
         self._mta_actions = actions
         self._mta_version = version
-        data = dict(version=self.factory.version,
-                    protocol=self.factory.protocols & self._mta_protocols,
-                    actions=self.factory.actions & self._mta_actions)
-        return MilterMessage(cmd='SMFIC_OPTNEG', data=data)
+        self.protocols = ((self.factory.protocols | self.protocol_mask())
+                         & self._mta_protocols)
+        self._noReplyCmds = NO_REPLY_CMDS.union(
+                cmd for cmd, _, noreply in OPTIONAL_CALLBACKS.values()
+                if self.protocols & noreply)
+        actions = self.actions = self.factory.actions & self._mta_actions
+        if self._symlists and self._mta_actions & constants.SMFIF_SETSYMLIST:
+            return message.OptnegSymlist(self.factory.version,
+                                         actions | constants.SMFIF_SETSYMLIST,
+                                         self.protocols, self._symlists)
+        return message.Optneg(self.factory.version, actions, self.protocols)
 
     def onHeader(self, name, value):
         """ Called for each header field in the message body. """
@@ -54,6 +267,9 @@ class MilterProtocol(Protocol):
 
     def onBody(self, buf):
         """ Called to supply the body of the message to the Milter by chunks.
+            buf is a memoryview on the decoder's buffer, which must not
+            be modified: use buf.tobytes() to get a copy of the chunk, as
+            keeping the view holds on to the whole buffer.
         """
         return CONTINUE
 
@@ -67,6 +283,9 @@ class MilterProtocol(Protocol):
         return CONTINUE
 
     def onMacro(self, cmdcode, nameval):
+        """ Called with the macros of the next command (cmdcode), as a flat
+            list of names and values. They are also available through
+            getsymval(). """
         return
 
     def onAbort(self):
@@ -89,110 +308,568 @@ class MilterProtocol(Protocol):
         """
         return CONTINUE
 
-    def protocol_mask(self, msg):
-        """ Return mask of SMFIP_N* protocol option bits to clear for this
-            class The @nocallback and @noreply decorators set the
-            milter_protocol function attribute to the protocol mask bit to pass
-            to libmilter, causing that callback or its reply to be skipped. """
-        return CONTINUE
-
-    def getsymval(self, msg):
-        """ Return the value of an MTA macro. """
-        return CONTINUE
+    def protocol_mask(self):
+        """ Return mask of SMFIP_N* protocol option bits to request for this
+            session. The @nocallback and @noreply decorators set the
+            milter_protocol function attribute to the protocol mask bit to
+            request, causing that callback or its reply to be skipped.
+            Handlers which are not overridden are not called at all (their
+            reply is only skipped when the macros are used: useMacros is
+            set, onMacro is overridden or symbol lists were set, so that
+            the macros of their stage are still sent), and SMFIP_SKIP is
+            requested when onBody is overridden.
+        """
+        cls = self.__class__
+        macros = bool(self.useMacros or self._symlists or _func(cls.onMacro)
+                      is not _func(MilterSession.onMacro))
+        mask = _protocolMasks.get((cls, macros))
+        if mask is None:
+            mask = 0
+            for name, (_, nocb, noreply) in OPTIONAL_CALLBACKS.items():
+                method = getattr(cls, name)
+                if hasattr(method, 'milter_protocol'):
+                    mask |= method.milter_protocol
+                elif _func(method) is _func(getattr(MilterSession, name)):
+                    mask |= noreply if macros else nocb
+            if _func(cls.onBody) is not _func(MilterSession.onBody):
+                mask |= constants.SMFIP_SKIP
+            _protocolMasks[cls, macros] = mask
+        return mask
+
+    def commandReceived(self, msg):
+        """ Called with each command of the MTA (a txmilter.message
+            instance) right before its handler runs, even if it has none
+            or the command is shed. Mixins keeping track of the session
+            override it, calling the base method. """
+
+    def whenIdle(self):
+        """ Return a Deferred firing once all the commands received so
+            far are replied, or the connection is lost. """
+        if not self._replies and not self._backlog:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self._idle.append(d)
+        return d
+
+    def getsymval(self, name):
+        """ Return the value of the MTA macro name (e.g. 'i' or
+            '{client_addr}'), or None if the MTA did not send it.
+            The MTA does not send the macros of the stages whose handler is
+            not called: set useMacros (or a symbol list, see setsymlist) to
+            get them all.
+        """
+        return self.macros.get(name)
 
     def setreply(self, msg):
         """ Set the SMTP reply code and message. """
         return CONTINUE
 
-    def setsymlist(self, msg):
-        """ Tell the MTA which macro names will be used. """
-        return CONTINUE
+    def setsymlist(self, stage, names):
+        """ Tell the MTA to only send the macros in names at stage (one of
+            constants.SMFIM_*). Must be called before the option
+            negotiation, e.g. in connectionMade(); see also symbolList.
+        """
+        self._symlists[stage] = [macroName(n) for n in names]
 
     def addHeader(self, name, value):
-        """ Add a mail header field. """
-        data = {'name': name, 'value': value}
-        return self._send(MilterMessage('SMFIR_ADDHEADER', data))
+        """ Add a mail header field.
+            This method can only be called from within onEom().
+        """
+        return self._modify(message.AddHeader(name, value))
 
     def chgHeader(self, index, name, value):
-        """ Change the value of a mail header field. """
-        data = {'name': name, 'value': value, 'index': index}
-        return self._send(MilterMessage('SMFIR_CHGHEADER', data))
+        """ Change the value of a mail header field.
+            This method can only be called from within onEom().
+        """
+        return self._modify(message.ChgHeader(index, name, value))
 
     def addRcpt(self, rcpt):
         """ Add a recipient to the message.
             This method can only be calld from within onEom().
         """
-        message = MilterMessage('SMFIR_ADDRCPT', {'rcpt': rcpt})
-        return self._send(message)
+        return self._modify(message.AddRcpt(rcpt))
 
     def delRcpt(self, rcpt):
         """ Delete a recipient from the message.
             This method can only be calld from within onEom().
         """
-        message = MilterMessage('SMFIR_DELRCPT', {'rcpt': rcpt})
-        return self._send(message)
-
-    def replacebody(self, msg):
-        """ Replace the message body. """
-        return CONTINUE
-
-    def chgfrom(self, msg):
-        """ Change the SMTP sender address. """
-        return CONTINUE
+        return self._modify(message.DelRcpt(rcpt))
+
+    def replaceBody(self, body):
+        """ Replace the message body.
+            body can be a string, an iterable of strings or a file object:
+            it is sent to the MTA in chunks of at most
+            constants.MILTER_CHUNK_SIZE bytes, along with the reply to eom.
+            Strings are sent without being copied, so they must not be
+            modified until then; a file object is read a chunk at a time
+            while the reply is sent.
+            This method can only be called from within onEom().
+        """
+        reactor = _offloadState.reactor
+        if reactor is not None:
+            reactor.callFromThread(self.replaceBody, body)
+            return
+        if not self._checkAction('SMFIR_REPLBODY'):
+            return
+        encoder = self.factory.encoder
+        if hasattr(body, 'read'):
+            self._modifications.append(encoder.iterReplBody(body))
+        else:
+            self._modifications.append(encoder.encodeReplBody(body))
+
+    def chgfrom(self, from_, esmtp_arg=None):
+        """ Change the SMTP sender address.
+            This method can only be called from within onEom().
+        """
+        return self._modify(message.ChgFrom(from_, esmtp_arg))
 
     def quarantine(self, reason):
-        """ Quarantine the message with the given reason. """
-        message = MilterMessage('SMFIR_QUARANTINE', {'reason': reason})
-        return self._send(message)
+        """ Quarantine the message with the given reason.
+            This method can only be called from within onEom().
+        """
+        return self._modify(message.Quarantine(reason))
 
-    def progress(self, msg):
-        """ Tell the MTA to wait a bit longer. """
-        return CONTINUE
+    def progress(self):
+        """ Tell the MTA to wait a bit longer.
+            Sent automatically every progressInterval seconds while onEom()
+            is pending.
+        """
+        reactor = _offloadState.reactor
+        if reactor is not None:
+            reactor.callFromThread(self._send, PROGRESS)
+        else:
+            self._send(PROGRESS)
+
+    def _macroReceived(self, cmdcode, nameval):
+        self.macros.update(cmdcode, nameval)
+        return self.onMacro(cmdcode, nameval)
+
+    def _eomReceived(self):
+        self._inEom = True
+        return self.onEom()
+
+    def _abortReceived(self):
+        # the macros and modifications of the aborted message are gone
+        self.macros.clear(b'M')
+        self._takeModifications()
+        return self.onAbort()
+
+    def _quitNcReceived(self):
+        self.macros.clear()
+        return self.onQuitNewConnection()
+
+    def _modify(self, msg):
+        # modifications are encoded right away, so that invalid arguments
+        # raise in the caller, and buffered to be sent along with the reply
+        # to eom; the ones requested by handlers offloaded to a thread are
+        # buffered from the reactor thread
+        if msg.wire is None:
+            encoded = message.MilterMessage(msg.cmd, msg.data)
+            encoded.wire = self.factory.encoder.encode(msg)
+            msg = encoded
+        reactor = _offloadState.reactor
+        if reactor is not None:
+            reactor.callFromThread(self._modify, msg)
+        elif self._checkAction(msg.cmd):
+            self._modifications.append(msg)
+
+    def _checkAction(self, cmd):
+        if not self._inEom:
+            # also the case once the reply to eom was sent, e.g. when onEom
+            # missed its deadline
+            self._logMsg('dropping %s: modifications can only be requested '
+                         'from onEom()' % cmd)
+            return False
+        if (self.actions is not None
+                and not self.actions & MODIFICATION_ACTIONS[cmd]):
+            self._logMsg('dropping %s: its action was not negotiated' % cmd)
+            return False
+        return True
+
+    def _takeModifications(self):
+        # return the buffered modifications, which cannot be requested
+        # anymore
+        modifications, self._modifications = self._modifications, []
+        self._inEom = False
+        return modifications
+
+    def _flush(self, modifications, result):
+        # send modifications followed by result
+        if getattr(result, 'cmd', None) in _DISCARDING_VERDICTS:
+            modifications = []
+        encode = self.factory.encoder.encode
+        seq = []
+        for item in coalesceModifications(modifications):
+            if isinstance(item, message.Message):
+                seq.append(encode(item))
+            elif isinstance(item, list):
+                seq.extend(item)
+            else:
+                # a body read from a file: written a chunk at a time
+                for frames in item:
+                    seq.extend(frames)
+                    self._writeFrames(seq)
+                    seq = []
+        if isinstance(result, message.Message):
+            seq.append(encode(result))
+        self._writeFrames(seq)
+
+    def _writeFrames(self, seq):
+        self._writeSequence(seq)
+        if self._instr is not None:
+            self._instr.bytesSent(self, sum(len(i) for i in seq))
+        if self._recorder is not None:
+            self._recorder.sent(self, b''.join(seq))
 
     def _send(self, msg):
-        if isinstance(msg, MilterMessage):
-            data = self.factory.encoder.encode(msg)
+        if isinstance(msg, message.Message):
+            data = msg.wire
+            if data is None:
+                data = self.factory.encoder.encode(msg)
             self.transport.write(data)
+            if self._instr is not None:
+                self._instr.bytesSent(self, len(data))
+            if self._recorder is not None:
+                self._recorder.sent(self, data)
+
+    def _handlerDone(self, result, slot):
+        slot[0] = True
+        slot[1] = result
+        if slot[3] is not None:
+            self._instr.callbackFinished(self, slot[2],
+                                         compat.timer() - slot[3], False)
+        if slot[4] is not None:
+            self._handled(slot[4])
+            slot[4] = None
+        replies = self._replies
+        while replies and replies[0][0]:
+            slot = replies.popleft()
+            self._reply(slot[2], slot[1])
+        if not replies:
+            self._drainBacklog()
+        if (self._idle and not self._draining and not self._replies
+                and not self._backlog):
+            self._notifyIdle()
+
+    def _notifyIdle(self):
+        idle, self._idle = self._idle, []
+        for d in idle:
+            d.callback(None)
+
+    def _reply(self, cmd, result):
+        """ Send the result of the handler for cmd, according to the
+            negotiated protocol options. """
+        verdict = getattr(result, 'cmd', None)
+        if cmd in self._noReplyCmds:
+            if verdict not in (None, 'SMFIR_CONTINUE'):
+                self._logMsg('dropping %s reply to %s: no reply was '
+                             'negotiated' % (verdict, cmd))
+            return
+        if verdict == 'SMFIR_SKIP' and (
+                cmd != 'SMFIC_BODY'
+                or not self.protocols & constants.SMFIP_SKIP):
+            result = CONTINUE
+        modifications = None
+        if cmd == 'SMFIC_BODYEOB':
+            modifications = self._takeModifications()
+        if modifications:
+            self._flush(modifications, result)
+        else:
+            self._send(result)
+        if self._instr is not None and isinstance(result, message.Message):
+            self._instr.replySent(self, cmd, result)
+
+    def _drainBacklog(self):
+        if self._draining:
+            return
+        self._draining = True
+        try:
+            backlog = self._backlog
+            while backlog:
+                if self._replies and backlog[0][0].cmd in self.barrierCmds:
+                    break
+                self._dispatch(*backlog.popleft())
+        finally:
+            self._draining = False
+
+    def _failed(self, cmd):
+        # the reply to cmd when its handler failed
+        if cmd in self._noReplyCmds:
+            return CONTINUE
+        return self.failureVerdict
+
+    def _received(self, msg, queuedAt=None, size=None):
+        # a command decoded from the MTA: dispatched, unless a barrier
+        # holds it back (queuedAt is then when it was, with
+        # instrumentation); used by all the front-ends
+        if self._backlog or (self._replies and msg.cmd in self.barrierCmds):
+            self._backlog.append((msg, queuedAt, size))
+        else:
+            self._dispatch(msg, None, size)
+
+    def _dispatch(self, msg, queuedAt=None, size=None):
+        """ Run the handler for msg and pass its result to _handlerDone().
+
+            Handlers run as soon as their command arrives, so several
+            asynchronous handlers can be pending at the same time; their
+            replies are always written in command order. The fields of the
+            decoded message are passed to the handler as positional
+            arguments.
+
+            queuedAt is when msg was put in the backlog, if it was, and size
+            the bytes it took on the wire (with admission control).
+        """
+        raise NotImplementedError()
+
+    def _writeSequence(self, seq):
+        """ Write the byte strings of seq to the transport """
+        raise NotImplementedError()
+
+    def _logMsg(self, text):
+        """ Log text, about something wrong in the session """
+        raise NotImplementedError()
+
+
+class MilterProtocol(MilterSession, Protocol):
+    """ Milter session on a Twisted transport """
+
+    # seconds between the SMFIR_PROGRESS keepalives sent while the handler
+    # of one of progressCmds is pending, if not None
+    progressInterval = None
+    progressCmds = frozenset(['SMFIC_BODYEOB'])
+    # seconds after which a pending handler is replied deadlineVerdict, if
+    # not None
+    callbackDeadline = None
+    deadlineVerdict = TEMPFAIL
+    # IReactorTime of the keepalives and deadlines (the reactor if None)
+    clock = None
+
+    def connectionMade(self):
+        self._startSession()
+        # instrumentation hooks (see txmilter.metrics), if any
+        self._instr = getattr(self.factory, 'instrumentation', None)
+        # load limits (see txmilter.admission), if any
+        self._admission = getattr(self.factory, 'admission', None)
+        # recorder of the bytes on the wire (see txmilter.recorder), if the
+        # session is sampled
+        recorder = getattr(self.factory, 'recorder', None)
+        if recorder is not None and recorder.sample(self):
+            self._recorder = recorder
+            recorder.opened(self)
+        else:
+            self._recorder = None
+        # handlers running, and bytes of the commands not handled yet
+        # (only counted with admission control)
+        self._inFlight = 0
+        self._buffered = 0
+        # keepalives and deadlines of the pending handlers
+        self._watches = set()
+        if self._instr is not None:
+            self._instr.sessionStarted(self)
+        # whether all the commands of the session are shed
+        self._shedSession = (self._admission is not None
+                             and not self._admission.admitSession(self))
+
+    def connectionLost(self, reason):
+        if self._admission is not None:
+            for slot in self._replies:
+                if not slot[0] and slot[4] is not None:
+                    self._handled(slot[4])
+                    slot[4] = None
+            for _, _, size in self._backlog:
+                self._release(size)
+            self._admission.sessionEnded(self, not self._shedSession)
+        self._stopSession()
+        for watch in self._watches:
+            watch.stop()
+        self._watches.clear()
+        if self._instr is not None:
+            self._instr.sessionEnded(self)
+        if self._recorder is not None:
+            self._recorder.closed(self)
 
     def dataReceived(self, data):
-        self.factory.decoder.feed(data)
-        for msg in self.factory.decoder.decode():
+        if self._recorder is not None:
+            self._recorder.received(self, data)
+        if self._instr is not None or self._admission is not None:
+            return self._monitoredDataReceived(data)
+        self.decoder.feed(data)
+        for msg in self.decoder.decode():
+            if msg is not None:
+                self._received(msg)
+
+    def _monitoredDataReceived(self, data):
+        # dataReceived, timing the decoding of each frame and counting the
+        # bytes of each command
+        instr = self._instr
+        admission = self._admission
+        timer = compat.timer
+        if instr is not None:
+            instr.bytesReceived(self, len(data))
+        decoder = self.decoder.feed(data)
+        decoded = decoder.decode()
+        pos = decoder._pos
+        while True:
+            start = timer()
+            msg = next(decoded, None)
             if msg is None:
-                continue
-            method_name = self.factory.handlerMap.get(msg.cmd, 'onUnknown')
-            method = getattr(self, method_name, None)
-            if method is not None:
-                defer.maybeDeferred(method, **msg.data).addCallback(self._send)
+                break
+            size = None
+            if admission is not None:
+                size = decoder._pos - pos
+                pos = decoder._pos
+                self._buffered += size
+                admission.buffered += size
+            if instr is not None:
+                instr.frameDecoded(self, msg.cmd, timer() - start)
+            self._received(msg, timer(), size)
+
+    def _dispatch(self, msg, queuedAt=None, size=None):
+        # see MilterSession._dispatch; handlers may return a Deferred
+        self.commandReceived(msg)
+        method = self._handlers.get(msg.cmd, self._unknownHandler)
+        if method is None:
+            self._release(size)
+            return
+        if self._admission is not None:
+            verdict = self._admit(msg.cmd)
+            if verdict is not None:
+                self._release(size)
+                slot = [False, None, msg.cmd, None, None]
+                self._replies.append(slot)
+                self._handlerDone(verdict, slot)
+                return
+            self._inFlight += 1
+            self._admission.inFlight += 1
+        instr = self._instr
+        if instr is None:
+            slot = [False, None, msg.cmd, None, size]
+        else:
+            started = compat.timer()
+            instr.callbackStarted(self, msg.cmd, queuedAt is not None
+                                  and started - queuedAt or 0.0)
+            slot = [False, None, msg.cmd, started, size]
+        self._replies.append(slot)
+        d = defer.maybeDeferred(method, *msg)
+        if not d.called and (self.progressInterval is not None
+                             or self.callbackDeadline is not None):
+            d = self._watch(d, msg.cmd)
+        d.addErrback(self._handlerFailed, msg, slot)
+        d.addCallback(self._handlerDone, slot)
+
+    def _admit(self, cmd):
+        """ Return the verdict to reply to cmd instead of running its
+            handler, if it must be shed, or None """
+        if cmd in NO_REPLY_CMDS or cmd == 'SMFIC_OPTNEG':
+            return None
+        admission = self._admission
+        if self._shedSession:
+            reason = 'sessions'
+        else:
+            reason = admission.check(self)
+            if reason is None:
+                return None
+        admission.shed[reason] += 1
+        if self._instr is not None:
+            self._instr.commandShed(self, cmd, reason)
+        if cmd in self._noReplyCmds:
+            return CONTINUE
+        return admission.verdict
+
+    def _release(self, size):
+        # the bytes of a command are not held anymore
+        if size:
+            self._buffered -= size
+            self._admission.buffered -= size
+
+    def _handled(self, size):
+        # a handler counted as in flight finished
+        self._inFlight -= 1
+        self._admission.inFlight -= 1
+        self._release(size)
+
+    def _watch(self, d, cmd):
+        """ Return a Deferred firing with the result of the pending handler
+            Deferred d, or with deadlineVerdict once callbackDeadline has
+            elapsed; keepalives are sent until then. """
+        clock = self.clock
+        if clock is None:
+            from twisted.internet import reactor as clock
+        reply = defer.Deferred()
+        watch = _Watch()
+        self._watches.add(watch)
+        if self.progressInterval is not None and cmd in self.progressCmds:
+            watch.keepalive = task.LoopingCall(self._keepalive, cmd)
+            watch.keepalive.clock = clock
+            watch.keepalive.start(self.progressInterval, now=False)
+        if self.callbackDeadline is not None:
+            watch.deadline = clock.callLater(self.callbackDeadline,
+                                             self._deadlineExpired,
+                                             reply, watch, cmd)
+
+        def finished(result):
+            watch.stop()
+            self._watches.discard(watch)
+            if not reply.called:
+                reply.callback(result)
+                return
+            if isinstance(result, Failure):
+                log.err(result, 'error while handling %s after its deadline'
+                        % cmd)
+        d.addBoth(finished)
+        return reply
+
+    def _keepalive(self, cmd):
+        self._send(PROGRESS)
+        if self._instr is not None:
+            self._instr.progressSent(self, cmd)
+
+    def _deadlineExpired(self, reply, watch, cmd):
+        watch.stop()
+        self._watches.discard(watch)
+        log.msg('%s handler did not reply in %ss: replying %s'
+                % (cmd, self.callbackDeadline, self.deadlineVerdict.cmd))
+        if self._instr is not None:
+            self._instr.deadlineExpired(self, cmd)
+        reply.callback(self.deadlineVerdict)
+
+    def _handlerFailed(self, failure, msg, slot):
+        log.err(failure, 'error while handling %s' % msg.cmd)
+        if slot[3] is not None:
+            self._instr.callbackFinished(self, msg.cmd,
+                                         compat.timer() - slot[3], True)
+            slot[3] = None
+        return self._failed(msg.cmd)
+
+    def _writeSequence(self, seq):
+        self.transport.writeSequence(seq)
+
+    def _logMsg(self, text):
+        log.msg(text)
 
 
 class MilterFactory(Factory):
 
     protocol = MilterProtocol
 
-    def __init__(self, actions=0, protocols=0):
+    def __init__(self, actions=0, protocols=0, instrumentation=None,
+                 admission=None, recorder=None):
         self.idCounter = itertools.count()
         self.actions = actions
         self.protocols = protocols
+        # a txmilter.metrics.Instrumentation, notified of the life of the
+        # sessions
+        self.instrumentation = instrumentation
+        # a txmilter.admission.AdmissionControl, shedding the commands
+        # beyond its limits
+        self.admission = admission
+        # a txmilter.recorder.SessionRecorder, recording a sample of the
+        # sessions
+        self.recorder = recorder
         self.version = 6
         self.encoder = MilterEncoder()
-        self.decoder = MilterDecoder()
 
-        self.handlerMap = dict(SMFIC_ABORT='onAbort',
-                               SMFIC_BODY='onBody',
-                               SMFIC_CONNECT='onConnect',
-                               SMFIC_MACRO='onMacro',
-                               SMFIC_BODYEOB='onEom',
-                               SMFIC_HELO='onHelo',
-                               SMFIC_QUIT_NC='onQuitNewConnection',
-                               SMFIC_HEADER='onHeader',
-                               SMFIC_MAIL='onMail',
-                               SMFIC_EOH='onEoh',
-                               SMFIC_OPTNEG='onOptneg',
-                               SMFIC_RCPT='onRcpt',
-                               SMFIC_DATA='onData',
-                               SMFIC_QUIT='onQuit',
-                               SMFIC_UNKNOWN='onUnknown',
-                              )
+        self.handlerMap = dict(HANDLERS)
 
     def getId(self):
         return next(self.idCounter)
@@ -0,0 +1,414 @@
+""" Forwarding milter sessions to upstream milters.
+
+    A MilterClientPool keeps connections to a set of upstream milters (the
+    backends), with their options already negotiated, and lends them to
+    sessions. A connection is reset with SMFIC_QUIT_NC at the end of its
+    session and kept for the next one, so the TCP handshake and option
+    negotiation are only paid once:
+
+        pool = MilterClientPool([
+            endpoints.clientFromString(reactor, 'tcp:av1.example.com:8890'),
+            endpoints.clientFromString(reactor, 'tcp:av2.example.com:8890')])
+        pool.start()
+
+        factory = MilterProxyFactory(pool)
+
+    Sessions go to the healthy backend with the fewest sessions (relative
+    to its weight). Backends failing to connect, or taking more than
+    commandTimeout seconds to reply to a command, are marked down until a
+    health check manages to connect to them again. The SMFIR_PROGRESS
+    keepalives of the backends are relayed to the MTA, and restart the
+    command timeout.
+"""
+import collections
+import itertools
+
+from twisted.internet import defer, protocol, task
+from twisted.python import log
+
+from . import message
+from .client import ALL_ACTIONS, ALL_PROTOCOLS
+from .client import MilterClientProtocol
+from .protocol import CONTINUE
+from .protocol import NO_REPLY_CMDS
+from .protocol import OPTIONAL_CALLBACKS
+from .protocol import MilterFactory
+from .protocol import MilterProtocol
+
+
+class NoBackendAvailable(Exception):
+    """ No backend of the pool could be connected to """
+
+
+class Backend(object):
+    """ An upstream milter, reached through a client endpoint """
+
+    def __init__(self, endpoint, weight=1):
+        self.endpoint = endpoint
+        self.weight = weight
+        self.healthy = True
+        # negotiated connections waiting for a session
+        self.idle = collections.deque()
+        # sessions using (or opening) a connection
+        self.active = 0
+        # connection failures in a row
+        self.failures = 0
+        self.sessions = 0
+
+    @property
+    def load(self):
+        return float(self.active) / self.weight
+
+    def __repr__(self):
+        return '<Backend %r>' % (self.endpoint,)
+
+
+class MilterClientPool(object):
+    """ Pool of connections to backends, a list of client endpoints or of
+        Backend.
+
+        Connections negotiate version, actions and protocols. At most
+        maxIdle connections per backend are kept between sessions. A
+        backend is marked down after maxFailures connection failures in a
+        row (connecting and negotiating must take less than
+        connectTimeout seconds), or when it takes more than commandTimeout
+        seconds (if not None) to reply to a command of a session. Once
+        started, a health check runs every healthInterval seconds: it opens
+        a connection to the backends without idle ones, marking them up or
+        down, and keeps it for the next session.
+    """
+
+    def __init__(self, backends, version=6, actions=ALL_ACTIONS,
+                 protocols=ALL_PROTOCOLS, maxIdle=8, maxFailures=1,
+                 connectTimeout=10, commandTimeout=60, healthInterval=10,
+                 clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.clock = clock
+        self.backends = [b if isinstance(b, Backend) else Backend(b)
+                         for b in backends]
+        self.version = version
+        self.actions = actions
+        self.protocols = protocols
+        self.maxIdle = maxIdle
+        self.maxFailures = maxFailures
+        self.connectTimeout = connectTimeout
+        self.commandTimeout = commandTimeout
+        self.healthInterval = healthInterval
+        # connections opened, and sessions served by an idle connection
+        self.connections = 0
+        self.reused = 0
+        self._factory = protocol.Factory.forProtocol(MilterClientProtocol)
+        # breaks the ties between the least loaded backends
+        self._turn = itertools.count()
+        self._health = None
+
+    def start(self):
+        """ Start the health checks """
+        self._health = task.LoopingCall(self.checkHealth)
+        self._health.clock = self.clock
+        self._health.start(self.healthInterval, now=True)
+
+    def stop(self):
+        """ Stop the health checks and close the idle connections """
+        if self._health is not None and self._health.running:
+            self._health.stop()
+        for backend in self.backends:
+            while backend.idle:
+                self._close(backend.idle.popleft())
+
+    def pick(self, exclude=()):
+        """ Return the healthy backend with the lowest load, preferring the
+            ones with idle connections, or None """
+        candidates = [b for b in self.backends
+                      if b.healthy and b not in exclude]
+        if not candidates:
+            return None
+        best = min((b.load, not b.idle) for b in candidates)
+        candidates = [b for b in candidates
+                      if (b.load, not b.idle) == best]
+        return candidates[next(self._turn) % len(candidates)]
+
+    def acquire(self):
+        """ Return a Deferred firing with a negotiated MilterClientProtocol
+            for one session, to be given back with release() """
+        return self._acquire(set())
+
+    def _acquire(self, tried):
+        backend = self.pick(tried)
+        if backend is None:
+            return defer.fail(NoBackendAvailable())
+        backend.active += 1
+        backend.sessions += 1
+        while backend.idle:
+            client = backend.idle.pop()
+            if client.connected:
+                self.reused += 1
+                return defer.succeed(client)
+
+        def failed(failure):
+            backend.active -= 1
+            self._failed(failure, backend)
+            tried.add(backend)
+            return self._acquire(tried)
+        return self._connect(backend).addErrback(failed)
+
+    def release(self, client):
+        """ Give back a connection acquired with acquire(). It is kept for
+            another session unless it is still waiting for replies. """
+        backend = client.backend
+        backend.active -= 1
+        if not client.connected:
+            return
+        if client.busy or len(backend.idle) >= self.maxIdle:
+            self._close(client)
+            return
+        client.quitNewConnection()
+        backend.idle.append(client)
+
+    def markDown(self, backend, reason):
+        """ Mark backend down, closing its idle connections, until a
+            health check connects to it again """
+        while backend.idle:
+            self._close(backend.idle.popleft())
+        if backend.healthy:
+            log.msg('milter backend %r is down: %s' % (backend, reason))
+            backend.healthy = False
+
+    def checkHealth(self):
+        """ Probe the backends without idle connections """
+        probes = []
+        for backend in self.backends:
+            if backend.idle:
+                continue
+            d = self._connect(backend)
+            d.addCallbacks(self._probed, self._failed,
+                           callbackArgs=(backend,), errbackArgs=(backend,))
+            d.addErrback(lambda _: None)
+            probes.append(d)
+        return defer.DeferredList(probes)
+
+    def _probed(self, client, backend):
+        if len(backend.idle) >= self.maxIdle:
+            self._close(client)
+        else:
+            backend.idle.append(client)
+
+    def _connect(self, backend):
+        d = self._negotiated(backend)
+        timeout = self.clock.callLater(self.connectTimeout, d.cancel)
+
+        def done(result):
+            if timeout.active():
+                timeout.cancel()
+            return result
+        return d.addBoth(done)
+
+    @defer.inlineCallbacks
+    def _negotiated(self, backend):
+        client = yield backend.endpoint.connect(self._factory)
+        try:
+            yield client.negotiate(self.version, self.actions,
+                                   self.protocols)
+        except Exception:
+            client.transport.loseConnection()
+            raise
+        client.backend = backend
+        client.disconnected.addCallback(self._lost, client)
+        self.connections += 1
+        backend.failures = 0
+        if not backend.healthy:
+            log.msg('milter backend %r is up' % (backend,))
+            backend.healthy = True
+        defer.returnValue(client)
+
+    def _failed(self, failure, backend):
+        backend.failures += 1
+        if backend.healthy and backend.failures >= self.maxFailures:
+            self.markDown(backend, failure.getErrorMessage())
+
+    def _lost(self, _, client):
+        try:
+            client.backend.idle.remove(client)
+        except ValueError:
+            pass
+
+    def _close(self, client):
+        client.send(message.Quit())
+        client.transport.loseConnection()
+
+
+class MilterProxyProtocol(MilterProtocol):
+    """ Forwards the session of the MTA to an upstream milter through a
+        connection of the pool of the factory, replying what it replies and
+        passing on its modifications.
+
+        The options negotiated with the MTA are the ones the upstream
+        milter asked for, as far as the MTA offers them. When no backend
+        is available, the upstream connection is lost or the upstream
+        milter does not reply in time, failureVerdict is replied (CONTINUE
+        for the commands without a reply).
+    """
+
+    def connectionMade(self):
+        MilterProtocol.connectionMade(self)
+        self.upstream = None
+        self._closed = False
+        # upstream reply Deferred -> the call timing it out
+        self._timeouts = {}
+
+    def connectionLost(self, reason):
+        self._closed = True
+        for call in self._timeouts.values():
+            call.cancel()
+        self._timeouts.clear()
+        self._release(aborted=True)
+        MilterProtocol.connectionLost(self, reason)
+
+    def onOptneg(self, version, actions, protocol):
+        d = self.factory.pool.acquire()
+        d.addCallbacks(self._negotiate, self._noUpstream,
+                       callbackArgs=(version, actions, protocol),
+                       errbackArgs=(version, actions, protocol))
+        return d
+
+    def _negotiate(self, upstream, version, actions, protocol):
+        self.upstream = upstream
+        if self._closed:
+            self._release(aborted=True)
+            return None
+        upstream.onProgress = self._upstreamProgress
+        self._mta_protocols = protocol
+        self._mta_actions = actions
+        self._mta_version = version
+        self.protocols = upstream.protocols & protocol
+        self._noReplyCmds = NO_REPLY_CMDS.union(
+                cmd for cmd, _, noreply in OPTIONAL_CALLBACKS.values()
+                if self.protocols & noreply)
+        self.actions = upstream.actions & actions
+        return message.Optneg(self.factory.version, self.actions,
+                              self.protocols)
+
+    def _noUpstream(self, failure, version, actions, protocol):
+        log.err(failure, 'no upstream milter for session %s' % self.id)
+        return MilterProtocol.onOptneg(self, version, actions, protocol)
+
+    def _forward(self, msg):
+        upstream = self.upstream
+        if upstream is not None and not upstream.connected:
+            log.msg('upstream milter of session %s is gone' % self.id)
+            self._release()
+            upstream = None
+        if upstream is None:
+            return self._failed(msg.cmd)
+        d = upstream.send(msg)
+        timeout = self.factory.pool.commandTimeout
+        if not d.called and timeout is not None:
+            self._timeouts[d] = self.factory.pool.clock.callLater(
+                    timeout, self._timedOut, d, msg.cmd, upstream)
+            d.addBoth(self._untimed, d)
+        d.addCallbacks(self._replied, self._upstreamFailed,
+                       callbackArgs=(msg.cmd, upstream),
+                       errbackArgs=(msg.cmd,))
+        return d
+
+    def _untimed(self, result, d):
+        call = self._timeouts.pop(d, None)
+        if call is not None and call.active():
+            call.cancel()
+        return result
+
+    def _timedOut(self, d, cmd, upstream):
+        self.factory.pool.markDown(
+                upstream.backend, 'no reply to %s in %ss'
+                % (cmd, self.factory.pool.commandTimeout))
+        d.cancel()
+        upstream.transport.loseConnection()
+
+    def _upstreamProgress(self):
+        # the upstream milter is still working on a command
+        for call in self._timeouts.values():
+            call.reset(self.factory.pool.commandTimeout)
+        self.progress()
+
+    def _replied(self, reply, cmd, upstream):
+        if cmd == 'SMFIC_BODYEOB':
+            for modification in upstream.modifications:
+                if modification.cmd == 'SMFIR_REPLBODY':
+                    self.replaceBody(modification.buf)
+                else:
+                    self._modify(modification)
+        if reply is None:
+            return CONTINUE
+        return reply
+
+    def _upstreamFailed(self, failure, cmd):
+        log.err(failure, 'upstream milter failed handling %s' % cmd)
+        self._release()
+        return self._failed(cmd)
+
+    def _release(self, aborted=False):
+        upstream, self.upstream = self.upstream, None
+        if upstream is None:
+            return
+        upstream.onProgress = None
+        if aborted and upstream.connected and not upstream.busy:
+            upstream.send(message.Abort())
+        self.factory.pool.release(upstream)
+
+    def onConnect(self, hostname, family, port, address):
+        return self._forward(message.Connect(hostname, family, port,
+                                             address))
+
+    def onHelo(self, helo):
+        return self._forward(message.Helo(helo))
+
+    def onMail(self, args):
+        return self._forward(message.Mail(args))
+
+    def onRcpt(self, args):
+        return self._forward(message.Rcpt(args))
+
+    def onData(self):
+        return self._forward(message.Data())
+
+    def onUnknown(self, data):
+        return self._forward(message.Unknown(data))
+
+    def onHeader(self, name, value):
+        return self._forward(message.Header(name, value))
+
+    def onEoh(self):
+        return self._forward(message.Eoh())
+
+    def onBody(self, buf):
+        return self._forward(message.Body(buf))
+
+    def onEom(self):
+        return self._forward(message.BodyEob())
+
+    def onMacro(self, cmdcode, nameval):
+        return self._forward(message.Macro(cmdcode, nameval))
+
+    def onAbort(self):
+        return self._forward(message.Abort())
+
+    def onQuitNewConnection(self):
+        return self._forward(message.QuitNc())
+
+    def onQuit(self):
+        self._release()
+        return CONTINUE
+
+
+class MilterProxyFactory(MilterFactory):
+    """ Factory forwarding the sessions to the backends of pool, a
+        MilterClientPool """
+
+    protocol = MilterProxyProtocol
+
+    def __init__(self, pool, actions=0, protocols=0, instrumentation=None,
+                 admission=None, recorder=None):
+        MilterFactory.__init__(self, actions, protocols, instrumentation,
+                               admission, recorder)
+        self.pool = pool
@@ -0,0 +1,131 @@
+""" Recording milter sessions as they went on the wire.
+
+    A MilterFactory created with a SessionRecorder appends the bytes it
+    receives from the MTA and the bytes it replies, with their time, to a
+    binary log, for txmilter.replay to play them back:
+
+        recorder = SessionRecorder('/var/lib/milter/sessions.rec',
+                                   sampleRate=0.01, maxSize=64 * 1024 * 1024)
+        factory = MilterFactory(recorder=recorder)
+
+    Only a sampleRate fraction of the sessions is recorded. When the log
+    grows past maxSize it is rotated, the way logrotate does: the previous
+    logs are kept as path.1 (the most recent) to path.N, at most maxFiles
+    of them. Each process must record to its own log.
+
+    The log starts with MAGIC, followed by records of a header (see
+    RECORD) and data:
+
+        kind     1 byte, one of OPEN, RECEIVED, SENT and CLOSE
+        session  4 bytes, the id of the session in its process
+        time     8 bytes, a double, seconds since the epoch
+        length   4 bytes, of the data following the header
+
+    The data are the chunks of bytes as read from and written to the
+    transport, so replaying them also reproduces how frames were split.
+"""
+import os
+import random
+import struct
+import time
+
+from twisted.python import log
+
+
+MAGIC = b'TXMREC\x01\n'
+RECORD = struct.Struct('!cIdI')
+
+# kinds of records
+OPEN = b'O'
+RECEIVED = b'<'
+SENT = b'>'
+CLOSE = b'C'
+
+
+class SessionRecorder(object):
+    """ Appends a sample of the sessions to the log at path (see the
+        module docstring). Recording stops if the log cannot be written.
+    """
+
+    def __init__(self, path, sampleRate=1.0, maxSize=64 * 1024 * 1024,
+                 maxFiles=4, clock=time.time, seed=None):
+        self.path = path
+        self.sampleRate = sampleRate
+        self.maxSize = maxSize
+        self.maxFiles = maxFiles
+        self.clock = clock
+        self._random = random.Random(seed).random
+        self._file = None
+        # bytes in the current log
+        self.size = 0
+        # sessions seen and recorded, and logs rotated
+        self.sessions = 0
+        self.recorded = 0
+        self.rotations = 0
+        self.failed = False
+
+    def sample(self, proto):
+        """ Return whether the new session proto is to be recorded """
+        self.sessions += 1
+        if self.failed or self._random() >= self.sampleRate:
+            return False
+        self.recorded += 1
+        return True
+
+    def opened(self, proto):
+        self._write(OPEN, proto.id, b'')
+
+    def received(self, proto, data):
+        self._write(RECEIVED, proto.id, data)
+
+    def sent(self, proto, data):
+        self._write(SENT, proto.id, data)
+
+    def closed(self, proto):
+        self._write(CLOSE, proto.id, b'')
+        if self._file is not None:
+            self._file.flush()
+
+    def close(self):
+        """ Flush and close the log """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _write(self, kind, session, data):
+        if self.failed:
+            return
+        try:
+            if self._file is None:
+                self._open()
+            elif self.size >= self.maxSize:
+                self._rotate()
+            self._file.write(RECORD.pack(kind, session & 0xffffffff,
+                                         self.clock(), len(data)))
+            self._file.write(data)
+        except EnvironmentError:
+            log.err(None, 'cannot record milter sessions to %s' % self.path)
+            self.failed = True
+            self.close()
+            return
+        self.size += RECORD.size + len(data)
+
+    def _open(self):
+        self._file = open(self.path, 'ab')
+        self.size = self._file.tell()
+        if not self.size:
+            self._file.write(MAGIC)
+            self.size = len(MAGIC)
+
+    def _rotate(self):
+        self.close()
+        for n in range(self.maxFiles - 1, 0, -1):
+            older = '%s.%d' % (self.path, n)
+            if os.path.exists(older):
+                os.rename(older, '%s.%d' % (self.path, n + 1))
+        if self.maxFiles:
+            os.rename(self.path, self.path + '.1')
+        else:
+            os.remove(self.path)
+        self.rotations += 1
+        self._open()
@@ -0,0 +1,290 @@
+""" Replaying recorded milter sessions.
+
+    Feeds the sessions recorded by a txmilter.recorder.SessionRecorder to
+    the protocol of a milter factory, in memory, either as fast as possible
+    or at the pace they were recorded at, and checks its replies against
+    the recorded ones:
+
+        python -m txmilter.replay mypackage.milter.factory \\
+            sessions.rec.2 sessions.rec.1 sessions.rec --check
+
+    Rotated logs are to be given oldest first, so that the sessions going
+    on at a rotation are put back together.
+"""
+from __future__ import division, print_function
+
+import argparse
+import sys
+import time
+
+from twisted.internet import defer, error, task
+from twisted.python import log
+from twisted.python.failure import Failure
+
+from .codec import MilterDecoder
+from .recorder import CLOSE, MAGIC, OPEN, RECEIVED, RECORD, SENT
+
+
+class RecordingError(Exception):
+    """ The file is not a recording of milter sessions """
+
+
+class RecordedSession(object):
+    """ A recorded session: the chunks of bytes received (from the MTA) and
+        sent (by the milter), as (seconds since the start, data) """
+
+    def __init__(self, id, started):
+        self.id = id
+        self.started = started
+        self.received = []
+        self.sent = []
+        # seconds from the start to the end, None if not recorded
+        self.duration = None
+
+    @property
+    def complete(self):
+        return self.duration is not None
+
+    def __repr__(self):
+        return '<RecordedSession %d at %.6f>' % (self.id, self.started)
+
+
+def readRecording(paths):
+    """ Return the sessions recorded in the logs at paths, in the order
+        they started. Sessions whose start is not in the logs are left
+        out; a truncated record at the end of a log is ignored. """
+    sessions = []
+    current = {}
+    for path in paths:
+        with open(path, 'rb') as f:
+            data = f.read()
+        if not data.startswith(MAGIC):
+            raise RecordingError('%s is not a milter sessions recording'
+                                 % path)
+        pos = len(MAGIC)
+        while pos + RECORD.size <= len(data):
+            kind, id, when, length = RECORD.unpack_from(data, pos)
+            pos += RECORD.size
+            if pos + length > len(data):
+                break
+            chunk = data[pos:pos + length]
+            pos += length
+            if kind == OPEN:
+                # ids start over when the milter is restarted
+                current[id] = RecordedSession(id, when)
+                sessions.append(current[id])
+                continue
+            session = current.get(id)
+            if session is None:
+                continue
+            if kind == RECEIVED:
+                session.received.append((when - session.started, chunk))
+            elif kind == SENT:
+                session.sent.append((when - session.started, chunk))
+            elif kind == CLOSE:
+                session.duration = when - session.started
+                del current[id]
+    return sessions
+
+
+def replies(data):
+    """ Return the messages in data, bytes sent by a milter, without the
+        progress notifications (they depend on timing) """
+    return [msg for msg in MilterDecoder().feed(data).decode()
+            if msg.cmd != 'SMFIR_PROGRESS']
+
+
+class ReplayTransport(object):
+    """ In memory transport of a replayed session, keeping what is written
+        to it """
+
+    disconnecting = False
+
+    def __init__(self):
+        self.written = []
+        self.paused = False
+        self._resumed = None
+
+    def write(self, data):
+        self.written.append(data)
+
+    def writeSequence(self, seq):
+        self.written.extend(seq)
+
+    def value(self):
+        return b''.join(self.written)
+
+    def loseConnection(self):
+        self.disconnecting = True
+
+    abortConnection = loseConnection
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        d, self._resumed = self._resumed, None
+        if d is not None:
+            d.callback(None)
+
+    def stopProducing(self):
+        self.loseConnection()
+
+    def resumed(self):
+        """ Return a Deferred firing once the transport is resumed """
+        if not self.paused:
+            return defer.succeed(None)
+        if self._resumed is None:
+            self._resumed = defer.Deferred()
+        return self._resumed
+
+    def getPeer(self):
+        return None
+
+    def getHost(self):
+        return None
+
+
+class ReplayResult(object):
+    """ What the milter replied to a replayed session, and how long it
+        took """
+
+    def __init__(self, session, sent, elapsed):
+        self.session = session
+        self.sent = sent
+        self.elapsed = elapsed
+
+    @property
+    def matches(self):
+        """ Whether the milter replied what it did when recorded """
+        recorded = b''.join(data for _, data in self.session.sent)
+        return replies(self.sent) == replies(recorded)
+
+
+class Replayer(object):
+    """ Replays sessions to the protocols built by factory.
+
+        With realtime, the data are fed at the times they were received,
+        speed times faster; otherwise as soon as the milter has replied to
+        the previous ones, like an MTA would. The pending handlers are
+        given drainTimeout seconds to finish, before each chunk and before
+        disconnecting.
+    """
+
+    def __init__(self, factory, realtime=False, speed=1.0, drainTimeout=10,
+                 clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.factory = factory
+        self.realtime = realtime
+        self.speed = speed
+        self.drainTimeout = drainTimeout
+        self.clock = clock
+
+    @defer.inlineCallbacks
+    def replay(self, session):
+        """ Return a Deferred firing with the ReplayResult of session """
+        clock = self.clock
+        proto = self.factory.buildProtocol(None)
+        transport = ReplayTransport()
+        proto.makeConnection(transport)
+        started = clock.seconds()
+        for offset, data in session.received:
+            if self.realtime:
+                yield self._sleep(started + offset / self.speed)
+            else:
+                yield self._idle(proto)
+            if transport.paused:
+                yield transport.resumed()
+            if transport.disconnecting:
+                break
+            proto.dataReceived(data)
+        yield self._idle(proto)
+        if self.realtime and session.complete:
+            yield self._sleep(started + session.duration / self.speed)
+        elapsed = clock.seconds() - started
+        proto.connectionLost(Failure(error.ConnectionDone()))
+        defer.returnValue(ReplayResult(session, transport.value(), elapsed))
+
+    def _idle(self, proto):
+        # proto.whenIdle(), given up on after drainTimeout seconds
+        d = proto.whenIdle()
+        if d.called:
+            return d
+        timeout = self.clock.callLater(self.drainTimeout, d.cancel)
+
+        def done(result):
+            if timeout.active():
+                timeout.cancel()
+            return result
+
+        return d.addBoth(done).addErrback(
+                lambda failure: failure.trap(defer.CancelledError))
+
+    def _sleep(self, until):
+        delay = until - self.clock.seconds()
+        if delay <= 0:
+            return defer.succeed(None)
+        return task.deferLater(self.clock, delay, lambda: None)
+
+    @defer.inlineCallbacks
+    def replayAll(self, sessions):
+        """ Replay sessions one after the other, returning a Deferred
+            firing with their ReplayResult """
+        results = []
+        for session in sessions:
+            result = yield self.replay(session)
+            results.append(result)
+        defer.returnValue(results)
+
+
+@defer.inlineCallbacks
+def main(reactor, *argv):
+    from .prefork import loadFactory
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('factory', help='fully qualified name of the '
+                        'milter factory, or of a callable returning it')
+    parser.add_argument('recording', nargs='+',
+                        help='session logs, oldest first')
+    parser.add_argument('--realtime', action='store_true',
+                        help='replay at the recorded pace')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='with --realtime, replay this many times '
+                        'faster (default 1)')
+    parser.add_argument('--session', type=int, action='append',
+                        help='only replay the sessions with this id')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='replay the sessions this many times')
+    parser.add_argument('--check', action='store_true',
+                        help='fail if the replies differ from the '
+                        'recorded ones')
+    args = parser.parse_args(argv)
+    log.startLogging(sys.stderr, setStdout=False)
+
+    sessions = readRecording(args.recording)
+    if args.session:
+        sessions = [s for s in sessions if s.id in args.session]
+    replayer = Replayer(loadFactory(args.factory), args.realtime,
+                        args.speed, clock=reactor)
+    started = time.time()
+    results = yield replayer.replayAll(sessions * args.repeat)
+    elapsed = time.time() - started
+
+    received = sum(len(data) for s in sessions for _, data in s.received)
+    received *= args.repeat
+    print('sessions: %d in %.3fs (%.1f/s, %.2f MB/s)'
+          % (len(results), elapsed, len(results) / (elapsed or 1e-9),
+             received / (elapsed or 1e-9) / 1e6))
+    mismatches = sorted(set(r.session.id for r in results
+                            if not r.matches))
+    if mismatches:
+        print('replies differing from the recorded ones: %s'
+              % ', '.join(str(id) for id in mismatches))
+        if args.check:
+            raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    task.react(main, sys.argv[1:])
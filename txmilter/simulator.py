@@ -0,0 +1,321 @@
+""" MTA simulator and load generator for milters.
+
+    Replays synthetic or recorded sessions against a milter, the way an MTA
+    would, and reports throughput and reply latencies:
+
+        python -m txmilter.simulator tcp:host=127.0.0.1:port=8888 \\
+            --sessions 1000 --concurrency 20 --size lognormal:9:1.5
+
+    The milter address is a Twisted client endpoint string, e.g.
+    tcp:host=localhost:port=8888 or unix:path=/run/milter.sock.
+"""
+from __future__ import division, print_function
+
+import argparse
+import collections
+import math
+import random
+import sys
+import time
+
+from twisted.internet import defer, endpoints, protocol, task
+
+from . import message
+from .client import ALL_ACTIONS, ALL_PROTOCOLS
+from .client import MilterClientProtocol
+from .codec import MilterDecoder
+from .constants import MILTER_CHUNK_SIZE, ProtocolFamily
+from .recorder import MAGIC
+from .replay import readRecording
+
+
+# replies ending the current message before its end
+FINAL_VERDICTS = frozenset(['SMFIR_ACCEPT', 'SMFIR_REJECT', 'SMFIR_DISCARD',
+                            'SMFIR_TEMPFAIL', 'SMFIR_REPLYCODE'])
+
+
+def parseDistribution(spec):
+    """ Parse a size distribution, returning a function rng -> int.
+
+        Supported: fixed:N, uniform:MIN:MAX, lognormal:MU:SIGMA (of the
+        natural log of the size) and choice:N1,N2,...
+    """
+    kind, _, args = spec.partition(':')
+    try:
+        if kind == 'fixed':
+            n = int(args)
+            return lambda rng: n
+        elif kind == 'uniform':
+            low, high = [int(i) for i in args.split(':')]
+            return lambda rng: rng.randint(low, high)
+        elif kind == 'lognormal':
+            mu, sigma = [float(i) for i in args.split(':')]
+            return lambda rng: int(rng.lognormvariate(mu, sigma))
+        elif kind == 'choice':
+            values = [int(i) for i in args.split(',')]
+            return lambda rng: rng.choice(values)
+    except ValueError:
+        pass
+    raise ValueError('invalid distribution %r' % spec)
+
+
+def syntheticSessions(size, rcpts, headers, seed=None):
+    """ Yield synthetic sessions, each one a list of commands.
+
+        size, rcpts and headers are distributions (see parseDistribution)
+        of the body size, number of recipients and number of headers.
+    """
+    rng = random.Random(seed)
+    n = 0
+    while True:
+        n += 1
+        msgs = [message.Optneg(6, ALL_ACTIONS, ALL_PROTOCOLS),
+                message.Connect(b'client.example.com',
+                                ProtocolFamily.SMFIA_INET,
+                                rng.randint(1024, 65535), b'192.0.2.1'),
+                message.Helo(b'client.example.com'),
+                message.Mail([b'<sender%d@example.com>' % n])]
+        msgs.extend(message.Rcpt([b'<rcpt%d@example.net>' % i])
+                    for i in range(max(rcpts(rng), 1)))
+        msgs.append(message.Data())
+        msgs.append(message.Header(b'Message-Id', b'<%d@example.com>' % n))
+        msgs.extend(message.Header(b'X-Header-%d' % i, b'value %d' % i)
+                    for i in range(headers(rng)))
+        msgs.append(message.Eoh())
+        body_size = size(rng)
+        chunk = b'x' * 76 + b'\r\n'
+        body = chunk * (body_size // len(chunk) + 1)
+        for i in range(0, body_size, MILTER_CHUNK_SIZE):
+            msgs.append(message.Body(body[i:min(i + MILTER_CHUNK_SIZE,
+                                                body_size)]))
+        msgs.extend([message.BodyEob(), message.Quit()])
+        yield msgs
+
+
+def recordedSessions(path):
+    """ Return the sessions recorded in path, as lists of commands: either
+        a log written by a txmilter.recorder.SessionRecorder, or a stream
+        of milter commands (as sent by an MTA) split at each quit. """
+    with open(path, 'rb') as f:
+        data = f.read()
+    if data.startswith(MAGIC):
+        return [_commands(b''.join(chunk for _, chunk in session.received))
+                for session in readRecording([path])]
+    sessions = []
+    current = []
+    for msg in _commands(data):
+        current.append(msg)
+        if msg.cmd in ('SMFIC_QUIT', 'SMFIC_QUIT_NC'):
+            sessions.append(current)
+            current = []
+    if current:
+        sessions.append(current)
+    return sessions
+
+
+def _commands(data):
+    # the commands in data, with body chunks copied out of the decoder
+    commands = []
+    for msg in MilterDecoder().feed(data).decode():
+        if msg.cmd == 'SMFIC_BODY':
+            msg = message.Body(msg.buf.tobytes())
+        commands.append(msg)
+    return commands
+
+
+class Histogram(object):
+    """ Latency histogram with logarithmic buckets, each one spanning a
+        1/steps power of 2 microseconds. Percentiles are the upper bound of
+        the bucket they fall in, so they are at most 2 ** (1 / steps) times
+        the exact ones; adding a sample takes constant time. """
+
+    def __init__(self, steps=8):
+        self.steps = steps
+        self.buckets = collections.Counter()
+        self.count = 0
+
+    def add(self, seconds):
+        us = seconds * 1e6
+        self.buckets[int(math.log(us, 2) * self.steps) if us >= 1 else 0] += 1
+        self.count += 1
+
+    def __len__(self):
+        return self.count
+
+    def upperBound(self, bucket):
+        """ Return the upper bound of bucket, in seconds """
+        return 2 ** ((bucket + 1) / self.steps) / 1e6
+
+    def percentile(self, pct):
+        if not self.count:
+            return None
+        rank = max(int(math.ceil(pct / 100.0 * self.count)), 1)
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return self.upperBound(bucket)
+
+    def format(self, width=40):
+        # one line per power of 2 microseconds
+        octaves = collections.Counter()
+        for bucket, count in self.buckets.items():
+            octaves[bucket // self.steps] += count
+        lines = []
+        top = max(octaves.values()) if octaves else 0
+        for octave in sorted(octaves):
+            count = octaves[octave]
+            lines.append('  %10s us %8d %s'
+                         % ('< %d' % 2 ** (octave + 1), count,
+                            '#' * int(round(count / top * width))))
+        return '\n'.join(lines)
+
+
+class Stats(object):
+    def __init__(self):
+        self.sessions = 0
+        self.failed = 0
+        self.commands = 0
+        self.bytes = 0
+        self.verdicts = collections.Counter()
+        self.latency = collections.defaultdict(Histogram)
+        self.started = time.time()
+        self.elapsed = 0
+
+    def report(self, out=sys.stdout):
+        elapsed = max(self.elapsed, 1e-9)
+        print('sessions: %d ok, %d failed in %.2fs (%.1f sessions/s)'
+              % (self.sessions, self.failed, elapsed,
+                 self.sessions / elapsed), file=out)
+        print('commands: %d (%.1f/s), %.1f KiB/s'
+              % (self.commands, self.commands / elapsed,
+                 self.bytes / 1024.0 / elapsed), file=out)
+        print('verdicts: %s' % ', '.join('%s=%d' % i for i in
+                                         sorted(self.verdicts.items())),
+              file=out)
+        for cmd in sorted(self.latency):
+            hist = self.latency[cmd]
+            print('%s: %d replies, p50 %.0f us, p90 %.0f us, p99 %.0f us'
+                  % (cmd, len(hist), hist.percentile(50) * 1e6,
+                     hist.percentile(90) * 1e6, hist.percentile(99) * 1e6),
+                  file=out)
+            print(hist.format(), file=out)
+
+
+@defer.inlineCallbacks
+def runSession(client, commands, stats):
+    """ Send the commands of a session, waiting for each reply, and quit
+        (if the session did not) once a verdict ends it """
+    skip = None
+    quitted = False
+    for msg in commands:
+        if msg.cmd == skip:
+            continue
+        start = time.time()
+        sent = client.bytesSent
+        reply = yield client.send(msg)
+        if client.bytesSent != sent:
+            stats.commands += 1
+        quitted = msg.cmd == 'SMFIC_QUIT'
+        if reply is None:
+            continue
+        stats.latency[msg.cmd].add(time.time() - start)
+        if reply.cmd == 'SMFIR_SKIP':
+            skip = msg.cmd
+        elif reply.cmd in FINAL_VERDICTS or msg.cmd == 'SMFIC_BODYEOB':
+            stats.verdicts[reply.cmd] += 1
+            if msg.cmd != 'SMFIC_RCPT':
+                break
+    if not quitted:
+        yield client.send(message.Quit())
+        stats.commands += 1
+    client.transport.loseConnection()
+
+
+class LoadGenerator(object):
+    """ Runs sessions against a milter endpoint with the given
+        concurrency. """
+
+    def __init__(self, endpoint, sessions, concurrency=1, count=None,
+                 duration=None):
+        self.endpoint = endpoint
+        self.sessions = iter(sessions)
+        self.concurrency = concurrency
+        self.count = count
+        self.duration = duration
+        self.stats = Stats()
+        self._factory = protocol.Factory.forProtocol(MilterClientProtocol)
+
+    def _next(self):
+        if self.count is not None and self.count <= 0:
+            return None
+        if (self.duration is not None
+                and time.time() - self.stats.started >= self.duration):
+            return None
+        if self.count is not None:
+            self.count -= 1
+        return next(self.sessions, None)
+
+    @defer.inlineCallbacks
+    def _worker(self):
+        commands = self._next()
+        while commands is not None:
+            client = None
+            try:
+                client = yield self.endpoint.connect(self._factory)
+                yield runSession(client, commands, self.stats)
+                self.stats.bytes += client.bytesSent
+                self.stats.sessions += 1
+            except Exception:
+                self.stats.failed += 1
+                if client is not None:
+                    client.transport.loseConnection()
+            commands = self._next()
+
+    @defer.inlineCallbacks
+    def run(self):
+        self.stats.started = time.time()
+        yield defer.gatherResults([self._worker()
+                                   for _ in range(self.concurrency)])
+        self.stats.elapsed = time.time() - self.stats.started
+        defer.returnValue(self.stats)
+
+
+def main(reactor, *argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('endpoint', help='milter client endpoint string')
+    parser.add_argument('--sessions', type=int, default=100,
+                        help='number of sessions to run (default 100)')
+    parser.add_argument('--duration', type=float,
+                        help='stop after this many seconds')
+    parser.add_argument('--concurrency', type=int, default=10,
+                        help='concurrent sessions (default 10)')
+    parser.add_argument('--size', default='fixed:4096',
+                        help='body size distribution (default fixed:4096)')
+    parser.add_argument('--rcpts', default='fixed:1',
+                        help='recipients distribution (default fixed:1)')
+    parser.add_argument('--headers', default='fixed:10',
+                        help='headers distribution (default fixed:10)')
+    parser.add_argument('--replay', metavar='FILE',
+                        help='replay the sessions recorded in FILE')
+    parser.add_argument('--seed', type=int, help='random seed')
+    args = parser.parse_args(argv)
+
+    if args.replay:
+        recorded = recordedSessions(args.replay)
+        sessions = (recorded[i % len(recorded)]
+                    for i in range(sys.maxsize))
+    else:
+        sessions = syntheticSessions(parseDistribution(args.size),
+                                     parseDistribution(args.rcpts),
+                                     parseDistribution(args.headers),
+                                     seed=args.seed)
+    endpoint = endpoints.clientFromString(reactor, args.endpoint)
+    count = None if args.duration else args.sessions
+    generator = LoadGenerator(endpoint, sessions, args.concurrency,
+                              count=count, duration=args.duration)
+    return generator.run().addCallback(lambda stats: stats.report())
+
+
+if __name__ == '__main__':
+    task.react(main, sys.argv[1:])